@@ -0,0 +1,59 @@
+######################################################################################88
+import argparse
+
+parser = argparse.ArgumentParser(
+    description = "Time the pdb readers (pdblite.pose_from_pdb and "
+    "pdblite.load_pdb_coords) on the template pdbfiles in tcrdock/db/pdb, and the "
+    "precompiled template store if it has been built (see build_template_db.py). "
+    "Prints files/sec and atoms/sec.",
+)
+
+parser.add_argument('--num_files', type=int, default=0,
+                    help='Only time this many pdbfiles (evenly spaced through the '
+                    'sorted list); the default (0) is all of them')
+parser.add_argument('--repeats', type=int, default=1,
+                    help='Number of passes over the pdbfiles (the best pass is '
+                    'reported)')
+
+args = parser.parse_args()
+
+import time
+import tcrdock
+from tcrdock.util import path_to_db
+from tcrdock.template_db import get_all_template_pdbfiles, TemplateDB
+from tcrdock.template_db import path_to_template_db
+from os.path import exists
+
+pdbfiles = get_all_template_pdbfiles()
+if args.num_files and args.num_files < len(pdbfiles):
+    step = len(pdbfiles)/args.num_files
+    pdbfiles = [pdbfiles[int(i*step)] for i in range(args.num_files)]
+fullpaths = [str(path_to_db) + '/' + x for x in pdbfiles]
+
+num_atoms = sum(len(tcrdock.pdblite.pose_from_pdb(x).xyz) for x in fullpaths)
+print('num_files:', len(fullpaths), 'num_atoms:', num_atoms)
+
+def load_coords(fullpath):
+    return tcrdock.pdblite.load_pdb_coords(
+        fullpath, allow_chainbreaks=True, allow_skipped_lines=True)
+
+def time_reader(name, reader, files):
+    best = None
+    for r in range(args.repeats):
+        start = time.time()
+        for f in files:
+            reader(f)
+        elapsed = time.time()-start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:18s} {1000*best/len(files):8.2f} ms/file '
+          f'{len(files)/best:8.1f} files/sec {num_atoms/best:11.0f} atoms/sec',
+          flush=True)
+
+time_reader('pose_from_pdb', tcrdock.pdblite.pose_from_pdb, fullpaths)
+time_reader('load_pdb_coords', load_coords, fullpaths)
+
+if exists(path_to_template_db):
+    db = TemplateDB()
+    time_reader('template_db', db.load_pose_and_tdinfo, pdbfiles)
+else:
+    print('template db not built, skipping:', path_to_template_db)
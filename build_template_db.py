@@ -0,0 +1,26 @@
+######################################################################################88
+import argparse
+
+parser = argparse.ArgumentParser(
+    description = "Precompile the template pdbfiles in tcrdock/db/pdb into a binary "
+    "store (tcrdock/db/template_db_v*/) that loads much faster than parsing the "
+    "pdbfiles. Optional: if it's missing the pdbfiles are read as before.",
+)
+
+parser.add_argument('--force', action='store_true',
+                    help='Rebuild even if the store already exists')
+parser.add_argument('--verbose', action='store_true')
+
+args = parser.parse_args()
+
+from os.path import exists
+import tcrdock.template_db
+
+path_to_template_db = tcrdock.template_db.path_to_template_db
+if (exists(path_to_template_db / 'index.json') and not args.force and
+    tcrdock.template_db.template_db_is_current(tcrdock.template_db.TemplateDB())):
+    print('template db already exists and is up to date, use --force to rebuild:',
+          path_to_template_db)
+    exit()
+
+tcrdock.template_db.build_template_db(verbose=args.verbose)
@@ -19,6 +19,18 @@ parser.add_argument('--mhc_class', type=int, required=True, choices=[1,2],
                     help='MHC class (1 or 2)')
 parser.add_argument('--organism', required=True, choices=['mouse','human'],
                     help="Source organism ('mouse' or 'human')")
+parser.add_argument('--batch_size', type=int, default=50,
+                    help='Number of pdbfiles whose sequences are BLAST-ed together '
+                    'in a single (multi-query) blastp run (default 50)')
+parser.add_argument('--num_threads', type=int, default=1,
+                    help='Number of threads for each blastp run (-num_threads)')
+parser.add_argument('--num_workers', type=int, default=1,
+                    help='Number of worker processes; batches of pdbfiles are farmed '
+                    'out to a process pool if this is >1 (default is 1)')
+parser.add_argument('--resume', action='store_true',
+                    help='Pick up an interrupted run: keep the rows already written to '
+                    'the <out_tsvfile>.in_progress.tsv file (or a finished '
+                    '--out_tsvfile) and only parse the remaining pdbfiles')
 
 args = parser.parse_args()
 
@@ -26,12 +38,13 @@ args = parser.parse_args()
 import pandas as pd
 import tcrdock
 import os
-
-dfl = []
+import sys
+import traceback
 
 tmpfile = args.out_tsvfile+'.in_progress.tsv'
+failed_tsvfile = args.out_tsvfile+'.failed.tsv'
 
-for fname in args.pdbfiles:
+def read_pose_and_chainseqs(fname):
     print('start', fname, flush=True)
     pose = tcrdock.pdblite.pose_from_pdb(fname)
     num_chains = len(pose['chains'])
@@ -53,15 +66,21 @@ for fname in args.pdbfiles:
             f'MHC-II pdbfile {fname} should have 5 chains, see --help message'
         cs = pose['chainseq'].split('/')
         mhc_aseq, mhc_bseq, pep_seq, tcr_aseq, tcr_bseq = cs
+    return pose, (mhc_aseq, mhc_bseq, pep_seq, tcr_aseq, tcr_bseq)
+
 
+def parse_pose(fname, pose, chainseqs):
+    mhc_aseq, mhc_bseq, pep_seq, tcr_aseq, tcr_bseq = chainseqs
     tdinfo = tcrdock.tcrdock_info.TCRdockInfo().from_sequences(
-        args.organism, args.mhc_class, mhc_aseq, mhc_bseq, pep_seq, tcr_aseq, tcr_bseq)
+        args.organism, args.mhc_class, mhc_aseq, mhc_bseq, pep_seq, tcr_aseq,
+        tcr_bseq)
 
     # these are the MHC and TCR reference frames (aka 'stubs')
     mhc_stub = tcrdock.mhc_util.get_mhc_stub(pose, tdinfo)
     tcr_stub = tcrdock.tcr_util.get_tcr_stub(pose, tdinfo)
 
-    dgeom = tcrdock.docking_geometry.DockingGeometry().from_stubs(mhc_stub, tcr_stub)
+    dgeom = tcrdock.docking_geometry.DockingGeometry().from_stubs(
+        mhc_stub, tcr_stub)
 
     outl = {
         'pdbfile': fname,
@@ -80,16 +99,122 @@ for fname in args.pdbfiles:
         'mhc_frame_z_axis': ','.join(str(x) for x in mhc_stub['axes'][2]),
         'mhc_frame_origin': ','.join(str(x) for x in mhc_stub['origin']),
     }
-    dfl.append(outl)
+    return outl
+
+
+def parse_batch(batch_pdbfiles):
+    ''' returns a list of (pdbfile, outl, error) tuples in batch order; one of
+    outl or error is None. A failure on one pdbfile doesn't affect the others.
+
+    SystemExit is caught too, since some of the tcrdock parsing code calls exit()
+    on errors, and that would kill a worker process
+    '''
+    results = {}
+    batch_poses = []
+    for fname in batch_pdbfiles:
+        try:
+            batch_poses.append((fname, *read_pose_and_chainseqs(fname)))
+        except (Exception, SystemExit):
+            results[fname] = (fname, None, traceback.format_exc())
+
+    # one blastp run per database for the whole batch; results are cached so
+    # the from_sequences calls below don't need to run BLAST
+    try:
+        tcrdock.tcrdock_info.prefetch_sequence_annotations(
+            args.organism, args.mhc_class,
+            [(x[0], x[1], x[3], x[4]) for _,_,x in batch_poses],
+            num_threads=args.num_threads)
+    except (Exception, SystemExit):
+        # fall back on the one-at-a-time annotation inside parse_pose
+        print('WARNING: prefetch_sequence_annotations failed:',
+              traceback.format_exc())
+
+    for fname, pose, chainseqs in batch_poses:
+        try:
+            results[fname] = (fname, parse_pose(fname, pose, chainseqs), None)
+        except (Exception, SystemExit):
+            results[fname] = (fname, None, traceback.format_exc())
+    sys.stdout.flush()
+    return [results[fname] for fname in batch_pdbfiles]
+
+
+# rows from an earlier, interrupted run
+done_pdbfiles = set()
+if args.resume:
+    if not os.path.exists(tmpfile) and os.path.exists(args.out_tsvfile):
+        os.replace(args.out_tsvfile, tmpfile)
+    if os.path.exists(tmpfile) and os.path.getsize(tmpfile):
+        # drop a partial last row, if we were killed in the middle of writing it:
+        # every complete row ends in a newline and has all the columns
+        with open(tmpfile, 'r') as data:
+            lines = data.readlines()
+        num_columns = len(lines[0].rstrip('\n').split('\t'))
+        if not lines[0].endswith('\n'): # partial header
+            lines = []
+        elif len(lines) > 1 and (
+                not lines[-1].endswith('\n') or
+                len(lines[-1].rstrip('\n').split('\t')) != num_columns):
+            print('resume: dropping partial last row:', lines[-1][:60])
+            lines = lines[:-1]
+        with open(tmpfile, 'w') as out:
+            out.writelines(lines)
+        if lines:
+            done = pd.read_table(tmpfile, dtype=str, keep_default_na=False)
+            done_pdbfiles = set(done.pdbfile)
+    print('resume: skipping', len(done_pdbfiles), 'already parsed pdbfiles')
+elif os.path.exists(tmpfile):
+    os.remove(tmpfile)
 
-    # show partial output
-    pd.DataFrame(dfl).to_csv(tmpfile, sep='\t', index=False)
+todo_pdbfiles = [x for x in dict.fromkeys(args.pdbfiles) if x not in done_pdbfiles]
+
+# smaller batches if that's needed to keep all the workers busy
+batch_size = max(1, min(args.batch_size,
+                        -(-len(todo_pdbfiles)//max(1, args.num_workers))))
+batches = [todo_pdbfiles[i:i+batch_size]
+           for i in range(0, len(todo_pdbfiles), batch_size)]
+
+# imap_in_workers returns the batches in input order
+if args.num_workers > 1:
+    print('num_workers=', args.num_workers, 'num_batches=', len(batches))
+    all_results = tcrdock.util.imap_in_workers(
+        parse_batch, batches, args.num_workers)
+else:
+    all_results = map(parse_batch, batches)
+
+# append-only and line-buffered, so partial work is saved as we go
+# without rewriting the whole file after each pdbfile
+columns = None
+if os.path.exists(tmpfile) and os.path.getsize(tmpfile):
+    columns = list(pd.read_table(tmpfile, nrows=0).columns)
+failures = []
+# dont leave the workers running if something goes wrong (a worker that dies
+# raises RuntimeError here; rerun with --resume to pick up where it left off)
+try:
+    with open(tmpfile, 'a', buffering=1) as out:
+        for batch_results in all_results:
+            for fname, outl, error in batch_results:
+                if error is not None:
+                    print('ERROR: failed to parse', fname, error, flush=True)
+                    failures.append(
+                        {'pdbfile':fname, 'error':error.strip().split('\n')[-1]})
+                    continue
+                if columns is None:
+                    columns = list(outl.keys())
+                    out.write('\t'.join(columns)+'\n')
+                pd.DataFrame([outl])[columns].to_csv(
+                    out, sep='\t', index=False, header=False)
+finally:
+    if args.num_workers > 1:
+        all_results.close() # terminates any workers that are still running
 
 # make final output
-pd.DataFrame(dfl).to_csv(args.out_tsvfile, sep='\t', index=False)
+if columns is None: # nothing parsed
+    pd.DataFrame(columns=['pdbfile']).to_csv(tmpfile, sep='\t', index=False)
+os.replace(tmpfile, args.out_tsvfile)
 print('made:', args.out_tsvfile)
 
-if os.path.exists(tmpfile):
-    os.remove(tmpfile)
-
-
+if failures:
+    pd.DataFrame(failures).to_csv(failed_tsvfile, sep='\t', index=False)
+    print('WARNING: failed to parse', len(failures), 'pdbfiles, see', failed_tsvfile)
+elif os.path.exists(failed_tsvfile):
+    os.remove(failed_tsvfile)
@@ -1,8 +1,10 @@
 ######################################################################################88
 import sys
 import os
+import gzip
 from os.path import exists
 import pickle
+import itertools
 from collections import OrderedDict
 from sys import exit
 import numpy as np
@@ -44,7 +46,9 @@ def load_pdb_coords(
     if verbose:
         print('reading:', pdbfile)
     skipped_lines = False
-    with open(pdbfile,'r') as data:
+    # template pdbfiles may be gzip'ed (see tcrdock.pdblite.dump_pdb)
+    open_pdbfile = gzip.open if pdbfile.endswith('.gz') else open
+    with open_pdbfile(pdbfile,'rt') as data:
         for line in data:
             if (line[:6] in ['ATOM  ','HETATM'] and line[17:20] != 'HOH' and
                 line[16] in ' A1'):
@@ -283,6 +287,50 @@ def predict_structure(
     return all_metrics
 
 
+def add_metrics_to_outl(outl, all_metrics, query_chainseq):
+    ''' Add the output filenames and mean plddt/pae values (overall and by chain)
+    from run_alphafold_prediction to outl, a row of the final tsv file
+    '''
+    num_res = len(query_chainseq.replace('/',''))
+    for model_name, metrics in all_metrics.items():
+        plddts = metrics['plddt']
+        paes = metrics.get('predicted_aligned_error', None)
+        filetags = 'pdb plddt ptm predicted_aligned_error'.split()
+        for tag in filetags:
+            fname = metrics.get(tag+'file', None)
+            if fname is not None:
+                outl[f'{model_name}_{tag}_file'] = fname
+
+        cs = query_chainseq.split('/')
+        chain_stops = list(itertools.accumulate(len(x) for x in cs))
+        chain_starts = [0]+chain_stops[:-1]
+        nres = chain_stops[-1]
+        assert nres == num_res
+        outl[model_name+'_plddt'] = np.mean(plddts[:nres])
+        if paes is not None:
+            outl[model_name+'_pae'] = np.mean(paes[:nres,:nres])
+        for chain1,(start1,stop1) in enumerate(zip(chain_starts, chain_stops)):
+            outl[f'{model_name}_plddt_{chain1}'] = np.mean(plddts[start1:stop1])
+
+            if paes is not None:
+                for chain2 in range(len(cs)):
+                    start2, stop2 = chain_starts[chain2], chain_stops[chain2]
+                    pae = np.mean(paes[start1:stop1,start2:stop2])
+                    outl[f'{model_name}_pae_{chain1}_{chain2}'] = pae
+    return outl
+
+
+def copy_metrics_to_outl(outl, first_outl):
+    ''' For a duplicate target (see setup_for_alphafold.py --dedup_targets): copy
+    the results columns from first_outl, the final tsv row for the target that was
+    actually modeled, to outl
+    '''
+    for col, value in first_outl.items():
+        if col not in outl.index:
+            outl[col] = value
+    return outl
+
+
 def load_model_runners(
         model_names,
         crop_size,
@@ -339,9 +387,39 @@ def load_model_runners(
     return model_runners
 
 
+def load_template_atom37(
+        template_file,
+        allow_chainbreaks=True,
+        allow_skipped_lines=True,
+):
+    ''' returns: template_full_sequence, all_positions, all_positions_mask
+
+    template_file is either a pdbfile or an atom37 .npz file written by
+    tcrdock.pdblite.save_template_npz (setup_for_alphafold.py --template_format),
+    which skips the pdb parsing
+    '''
+    if template_file.endswith('.npz'):
+        with np.load(template_file) as data:
+            return (str(data['sequence']),
+                    data['all_positions'].astype(np.float64),
+                    data['all_positions_mask'].astype(np.int64))
+
+    chains_tmp, all_resids_tmp, all_coords_tmp, all_name1s_tmp = load_pdb_coords(
+        template_file, allow_chainbreaks=allow_chainbreaks,
+        allow_skipped_lines=allow_skipped_lines,
+    )
+
+    crs_tmp = [(c,r) for c in chains_tmp for r in all_resids_tmp[c]]
+    template_full_sequence = ''.join(all_name1s_tmp[c][r] for c,r in crs_tmp)
+
+    all_positions_tmp, all_positions_mask_tmp = fill_afold_coords(
+        chains_tmp, all_resids_tmp, all_coords_tmp)
+    return template_full_sequence, all_positions_tmp, all_positions_mask_tmp
+
+
 def create_single_template_features(
         target_sequence,
-        template_pdbfile,
+        template_pdbfile, # or .npz file, see load_template_atom37
         target_to_template_alignment,
         template_name, # goes into template_domain_names, .encode()'ed
         allow_chainbreaks=True,
@@ -349,21 +427,34 @@ def create_single_template_features(
         expected_identities=None,
         expected_template_len=None,
 ):
-    num_res = len(target_sequence)
-    chains_tmp, all_resids_tmp, all_coords_tmp, all_name1s_tmp = load_pdb_coords(
-        template_pdbfile, allow_chainbreaks=allow_chainbreaks,
-        allow_skipped_lines=allow_skipped_lines,
+    template_full_sequence, all_positions_tmp, all_positions_mask_tmp = (
+        load_template_atom37(template_pdbfile, allow_chainbreaks=allow_chainbreaks,
+                             allow_skipped_lines=allow_skipped_lines))
+    return create_template_features_from_atom37(
+        target_sequence, template_full_sequence, all_positions_tmp,
+        all_positions_mask_tmp, target_to_template_alignment, template_name,
+        expected_identities=expected_identities,
+        expected_template_len=expected_template_len,
     )
 
-    crs_tmp = [(c,r) for c in chains_tmp for r in all_resids_tmp[c]]
-    num_res_tmp = len(crs_tmp)
-    template_full_sequence = ''.join(all_name1s_tmp[c][r] for c,r in crs_tmp)
+
+def create_template_features_from_atom37(
+        target_sequence,
+        template_full_sequence,
+        all_positions_tmp, # (template_len,37,3)
+        all_positions_mask_tmp, # (template_len,37)
+        target_to_template_alignment,
+        template_name, # goes into template_domain_names, .encode()'ed
+        expected_identities=None,
+        expected_template_len=None,
+):
+    ''' Same as create_single_template_features, but starting from the template
+    atom37 arrays (eg from the run_pipeline.py template bundles) rather than a file
+    '''
+    num_res = len(target_sequence)
     if expected_template_len:
         assert len(template_full_sequence) == expected_template_len
 
-    all_positions_tmp, all_positions_mask_tmp = fill_afold_coords(
-        chains_tmp, all_resids_tmp, all_coords_tmp)
-
     identities = sum(target_sequence[i] == template_full_sequence[j]
                      for i,j in target_to_template_alignment.items())
     if expected_identities:
@@ -421,7 +512,7 @@ def create_batch_for_training(
 ):
     ''' alignfile cols are:
 
-    template_pdbfile
+    template_pdbfile (or template_npzfile, see load_template_atom37)
     target_to_template_alignstring
     identities
     target_len
@@ -456,15 +547,20 @@ def create_batch_for_training(
     for l in templates_df.itertuples():
         align_full = {int(x.split(':')[0]):int(x.split(':')[1])
                       for x in l.target_to_template_alignstring.split(';')}
+        if ('template_npzfile' in templates_df and
+            not pd.isna(l.template_npzfile)):
+            template_file = l.template_npzfile
+        else:
+            template_file = l.template_pdbfile
         if debug:
             create_single_template_features(
-                target_full_sequence, l.template_pdbfile, align_full, f'temp{l.Index}',
+                target_full_sequence, template_file, align_full, f'temp{l.Index}',
                 expected_identities = l.identities,
                 expected_template_len = l.template_len)
         align = {full_pos_to_trim_pos[x]:y for x,y in align_full.items()
                  if x in target_trim_positions}
         features = create_single_template_features(
-            target_sequence, l.template_pdbfile, align, f'temp{l.Index}',
+            target_sequence, template_file, align, f'temp{l.Index}',
             expected_template_len = l.template_len)
         template_features_list.append(features)
     all_template_features = compile_template_features(template_features_list)
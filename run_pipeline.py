@@ -0,0 +1,300 @@
+######################################################################################88
+import argparse
+
+required_columns = 'organism mhc_class mhc peptide va ja cdr3a vb jb cdr3b'.split()
+
+parser = argparse.ArgumentParser(
+    description = "Set up and run the AlphaFold TCR:pMHC simulations in one go: this "
+    "does the work of setup_for_alphafold.py followed by run_prediction.py, but "
+    "the templates are built by background worker processes and streamed "
+    "through a bounded queue to the AlphaFold predictions in the main process. "
+    "So the predictions start as soon as the first target's templates are ready, "
+    "and no alignment or template files are needed.",
+    epilog = f'''The --targets_tsvfile has the same format as for setup_for_alphafold.py
+(see the --help message for that script). The final tsv file is
+<outfile_prefix>_final.tsv, as for run_prediction.py
+
+Example command line:
+
+python run_pipeline.py --targets_tsvfile examples/benchmark/single_target.tsv \\
+    --outfile_prefix test_pipeline_single --model_names model_2_ptm \\
+    --data_dir $ALPHAFOLD_DATA_DIR
+
+''',
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+)
+
+parser.add_argument('--targets_tsvfile', required=True,
+                    help='TSV formatted file with info on modeling targets')
+parser.add_argument('--outfile_prefix', required=True,
+                    help='Prefix that will be prepended to the output filenames')
+parser.add_argument('--data_dir', help='Location of AlphaFold params/ folder')
+parser.add_argument('--model_names', type=str, nargs='*', default=['model_2_ptm'])
+parser.add_argument('--model_params_files', type=str, nargs='*',
+                    help='Only needed if running with fine-tuned parameters or '
+                    'parameters in a non-default location (ie, not in the params/ '
+                    'folder in --data_dir)')
+parser.add_argument('--num_runs', type=int, default=3,
+                    help='Number of alphafold runs per target (default is 3)')
+parser.add_argument('--benchmark', action='store_true',
+                    help='Exclude sequence-similar templates (for benchmarking)')
+parser.add_argument('--exclude_pdbids_column',
+                    help='Column in the --targets_tsvfile file with comma-separated '
+                    'lists of pdbfiles to exclude from modeling')
+parser.add_argument('--new_docking', action='store_true',
+                    help='See the --help message for setup_for_alphafold.py')
+parser.add_argument('--num_workers', type=int, default=1,
+                    help='Number of worker processes for building the templates '
+                    '(default is 1)')
+parser.add_argument('--queue_size', type=int, default=4,
+                    help='Maximum number of targets whose templates are built but '
+                    'not yet modeled; the workers wait when the queue is full '
+                    '(default is 4)')
+parser.add_argument('--crop_size', type=int, default=0,
+                    help='AlphaFold crop size; should be at least as long as the '
+                    'longest target. Otherwise the models are reloaded (and '
+                    'recompiled) whenever a target comes along that is longer than '
+                    'all the previous ones')
+parser.add_argument('--save_templates', choices=['pdb','npz','both'],
+                    help='Also write the template files and alignment files (in the '
+                    'given format, see setup_for_alphafold.py --template_format) and '
+                    'a <outfile_prefix>_targets.tsv file that can be passed to '
+                    'run_prediction.py. By default nothing is written.')
+parser.add_argument('--dedup_targets', action='store_true',
+                    help='Only model one copy of any duplicate targets (see '
+                    'setup_for_alphafold.py --dedup_targets); the results are copied '
+                    'over to the other copies in the final tsv file')
+parser.add_argument('--template_cache_mb', type=float,
+                    help='Memory bound (in MB, per worker process) for the cache of '
+                    'parsed template structures; the least recently used templates '
+                    'are dropped when it fills up. Default is 1024, or the '
+                    'TCRDOCK_TEMPLATE_CACHE_MB environment variable. The '
+                    'template_pose_cache: lines in the log show how much it is '
+                    'being used.')
+parser.add_argument('--no_pdbs', action='store_true', help='Dont write out pdbs')
+parser.add_argument('--terse', action='store_true', help='Dont write out pdbs or '
+                    'matrices with alphafold confidence values')
+parser.add_argument('--no_resample_msa', action='store_true', help='Dont randomly '
+                    'resample from the MSA during recycling. Perhaps useful for '
+                    'testing...')
+
+args = parser.parse_args()
+
+import sys
+import traceback
+import multiprocessing
+import queue as queue_module
+import pandas as pd
+import tcrdock
+
+if args.benchmark:
+    setup_kwargs = dict(
+        exclude_self_peptide_docking_geometries = True,
+        min_single_chain_tcrdist = 36,
+        min_pmhc_peptide_mismatches = 3,
+        min_dgeom_peptide_mismatches = 3,
+        min_dgeom_paired_tcrdist = 48.5,
+        min_dgeom_singlechain_tcrdist = 0.5,
+    )
+else:
+    setup_kwargs = dict(
+        exclude_self_peptide_docking_geometries = False,
+        min_single_chain_tcrdist = -1,
+        min_pmhc_peptide_mismatches = -1,
+        min_dgeom_peptide_mismatches = -1,
+        min_dgeom_paired_tcrdist = -1,
+        min_dgeom_singlechain_tcrdist = -1,
+    )
+
+num_runs = 1 if args.new_docking else args.num_runs
+
+# load the modeling targets
+targets = pd.read_table(args.targets_tsvfile)
+missing = [col for col in required_columns if col not in targets.columns]
+if missing:
+    print('ERROR --targets_tsvfile is missing required columns:', missing)
+    print('see --help message for setup_for_alphafold.py for details')
+    exit()
+
+if not tcrdock.sequtil.check_genes_for_modeling(targets):
+    print(f'ERROR some of the genes in {args.targets_tsvfile} are problematic,'
+          ' see error messages above')
+    sys.exit()
+
+targets = tcrdock.sequtil.prepare_tcr_db_for_alphafold(targets).reset_index(drop=True)
+
+if args.dedup_targets:
+    duplicates = tcrdock.sequtil.get_duplicate_targets(
+        targets, num_runs, exclude_pdbids_column=args.exclude_pdbids_column)
+    print('dedup_targets: found', len(duplicates), 'duplicates out of',
+          targets.shape[0], 'targets')
+else:
+    duplicates = {}
+todo_indices = [x for x in targets.index if x not in duplicates]
+
+# the template files (if any) go next to the prediction outputs
+outdir = args.outfile_prefix+'_'
+
+
+def worker_targets(worker):
+    return todo_indices[worker::args.num_workers]
+
+
+def build_templates(worker, queue):
+    ''' producer: puts (worker, index, bundles, error) for each of this worker's
+    targets, then (worker, None, None, None) when it's done
+    '''
+    for index in worker_targets(worker):
+        targetl = targets.loc[index]
+        try:
+            bundles = tcrdock.sequtil.make_alphafold_template_bundles(
+                (index, targetl), outdir, num_runs,
+                exclude_pdbids_column = args.exclude_pdbids_column,
+                use_opt_dgeoms = args.new_docking,
+                num_targets = targets.shape[0],
+                template_format = args.save_templates,
+                **setup_kwargs,
+            )
+            queue.put((worker, index, bundles, None))
+        except (Exception, SystemExit): # make_templates_for_alphafold may call exit()
+            queue.put((worker, index, None, traceback.format_exc()))
+    queue.put((worker, None, None, None))
+
+
+if args.template_cache_mb is not None:
+    tcrdock.sequtil.set_template_pose_cache_size(args.template_cache_mb)
+
+# start the workers before importing predict_utils, so they don't inherit the
+# tensorflow/jax state
+queue = multiprocessing.Queue(maxsize=max(1, args.queue_size))
+workers = [multiprocessing.Process(target=build_templates, args=(i, queue),
+                                   daemon=True)
+           for i in range(args.num_workers)]
+for worker in workers:
+    worker.start()
+
+import predict_utils
+
+model_runners, crop_size = None, 0
+final_dfl = [] # (index, outl)
+target_dfl = [] # (index, targets.tsv row), for --save_templates
+first_target_rows = {} # for --dedup_targets, indexed by index
+first_outls = {} # ditto, indexed by targetid
+failures = []
+finished_workers = set()
+received = set() # target indices that came off the queue
+while len(finished_workers) < len(workers):
+    try:
+        item = queue.get(timeout=30)
+    except queue_module.Empty:
+        # a worker that was killed (OOM, signal, exit()) never sends its done
+        # message; its results so far are already in the queue, so once that's
+        # empty, anything missing isn't coming
+        dead = [worker for worker, process in enumerate(workers)
+                if worker not in finished_workers and not process.is_alive()]
+        if dead and not queue.empty(): # it exited after we stopped waiting
+            continue
+        for worker in dead:
+            missing = [x for x in worker_targets(worker) if x not in received]
+            print('ERROR: template worker', worker, 'died with exitcode',
+                  workers[worker].exitcode, 'missing targets:', missing, flush=True)
+            failures.extend(missing)
+            finished_workers.add(worker)
+        continue
+    worker, index, bundles, error = item
+    if index is None:
+        finished_workers.add(worker)
+        continue
+    received.add(index)
+    if error is not None:
+        print('ERROR: failed to build templates for target', index, error, flush=True)
+        failures.append(index)
+        continue
+
+    first_target_rows[index] = []
+    for bundle in bundles:
+        targetl = bundle['targetl']
+        if args.dedup_targets:
+            targetl['dedup_targetid'] = targetl.targetid
+            first_target_rows[index].append(targetl)
+        target_dfl.append((index, targetl))
+        query_chainseq = targetl.target_chainseq
+        query_sequence = query_chainseq.replace('/','')
+
+        if len(query_sequence) > crop_size:
+            crop_size = max(len(query_sequence), args.crop_size)
+            print('load_model_runners: crop_size=', crop_size, flush=True)
+            model_runners = predict_utils.load_model_runners(
+                args.model_names,
+                crop_size,
+                args.data_dir,
+                model_params_files=args.model_params_files,
+                resample_msa_in_recycling = not args.no_resample_msa,
+            )
+
+        print('START:', len(final_dfl), targetl.targetid, flush=True)
+        template_features_list = []
+        for tnum, template in enumerate(bundle['templates']):
+            template_features_list.append(
+                predict_utils.create_template_features_from_atom37(
+                    query_sequence,
+                    template['template_sequence'],
+                    template['all_positions'],
+                    template['all_positions_mask'],
+                    template['target_to_template_alignment'],
+                    f'T{tnum:03d}',
+                    expected_identities = template['identities'],
+                    expected_template_len = template['template_len'],
+                ))
+
+        all_template_features = predict_utils.compile_template_features(
+            template_features_list)
+
+        all_metrics = predict_utils.run_alphafold_prediction(
+            query_sequence=query_sequence,
+            msa=[query_sequence],
+            deletion_matrix=[[0]*len(query_sequence)],
+            chainbreak_sequence=query_chainseq,
+            template_features=all_template_features,
+            model_runners=model_runners,
+            out_prefix=f'{args.outfile_prefix}_{targetl.targetid}',
+            crop_size=crop_size,
+            dump_pdbs = not (args.no_pdbs or args.terse),
+            dump_metrics = not args.terse,
+        )
+
+        outl = predict_utils.add_metrics_to_outl(
+            targetl.copy(), all_metrics, query_chainseq)
+        final_dfl.append((index, outl))
+        first_outls[targetl.targetid] = outl
+
+for worker in workers:
+    worker.join()
+
+# fan the results out to the duplicate targets
+for index, first_index in duplicates.items():
+    if first_index not in first_target_rows:
+        failures.append(index) # the first copy failed
+        continue
+    for targetl in tcrdock.sequtil.make_duplicate_target_rows(
+            index, targets.loc[index], first_target_rows[first_index]):
+        target_dfl.append((index, targetl))
+        final_dfl.append((index, predict_utils.copy_metrics_to_outl(
+            targetl.copy(), first_outls[targetl.dedup_targetid])))
+
+# targets come off the queue in the order they were finished; sort them back into
+# input order (stable sort, so the runs for a target stay in order)
+if args.save_templates:
+    outfile = f'{args.outfile_prefix}_targets.tsv'
+    pd.DataFrame([x[1] for x in sorted(target_dfl, key=lambda x:x[0])]).to_csv(
+        outfile, sep='\t', index=False)
+    print('made:', outfile)
+
+outfile = f'{args.outfile_prefix}_final.tsv'
+pd.DataFrame([x[1] for x in sorted(final_dfl, key=lambda x:x[0])]).to_csv(
+    outfile, sep='\t', index=False)
+print('made:', outfile)
+
+if failures:
+    print('WARNING: failed to build templates for', len(failures), 'targets:',
+          sorted(failures))
@@ -71,8 +71,6 @@ args = parser.parse_args()
 import os
 import sys
 from os.path import exists
-import itertools
-import numpy as np
 import pandas as pd
 import predict_utils
 
@@ -104,9 +102,17 @@ model_runners = predict_utils.load_model_runners(
 )
 
 final_dfl = []
+dedup_outls = {} # indexed by targetid, for setup_for_alphafold.py --dedup_targets
 for counter, targetl in targets.iterrows():
     print('START:', counter, 'of', targets.shape[0])
 
+    if 'dedup_targetid' in targetl and targetl.dedup_targetid in dedup_outls:
+        print('copying results for duplicate target:', targetl.targetid, 'from',
+              targetl.dedup_targetid)
+        final_dfl.append(predict_utils.copy_metrics_to_outl(
+            targetl.copy(), dedup_outls[targetl.dedup_targetid]))
+        continue
+
     alignfile = targetl.templates_alignfile
     assert exists(alignfile)
 
@@ -137,9 +143,16 @@ for counter, targetl in targets.iterrows():
             for x in row.target_to_template_alignstring.split(';')
         }
 
+        # atom37 npz files from setup_for_alphafold.py --template_format npz/both
+        # load without any pdb parsing
+        if 'template_npzfile' in row.index and not pd.isna(row.template_npzfile):
+            template_file = row.template_npzfile
+        else:
+            template_file = row.template_pdbfile
+
         template_name = f'T{tnum:03d}' # dont think this matters
         template_features = predict_utils.create_single_template_features(
-            query_sequence, row.template_pdbfile, target_to_template_alignment,
+            query_sequence, template_file, target_to_template_alignment,
             template_name, allow_chainbreaks=True, allow_skipped_lines=True,
             expected_identities = None if args.ignore_identities else row.identities,
             expected_template_len = row.template_len,
@@ -166,33 +179,11 @@ for counter, targetl in targets.iterrows():
     )
 
 
-    outl = targetl.copy()
-    for model_name, metrics in all_metrics.items():
-        plddts = metrics['plddt']
-        paes = metrics.get('predicted_aligned_error', None)
-        filetags = 'pdb plddt ptm predicted_aligned_error'.split()
-        for tag in filetags:
-            fname = metrics.get(tag+'file', None)
-            if fname is not None:
-                outl[f'{model_name}_{tag}_file'] = fname
-
-        cs = query_chainseq.split('/')
-        chain_stops = list(itertools.accumulate(len(x) for x in cs))
-        chain_starts = [0]+chain_stops[:-1]
-        nres = chain_stops[-1]
-        assert nres == num_res
-        outl[model_name+'_plddt'] = np.mean(plddts[:nres])
-        if paes is not None:
-            outl[model_name+'_pae'] = np.mean(paes[:nres,:nres])
-        for chain1,(start1,stop1) in enumerate(zip(chain_starts, chain_stops)):
-            outl[f'{model_name}_plddt_{chain1}'] = np.mean(plddts[start1:stop1])
-
-            if paes is not None:
-                for chain2 in range(len(cs)):
-                    start2, stop2 = chain_starts[chain2], chain_stops[chain2]
-                    pae = np.mean(paes[start1:stop1,start2:stop2])
-                    outl[f'{model_name}_pae_{chain1}_{chain2}'] = pae
+    outl = predict_utils.add_metrics_to_outl(
+        targetl.copy(), all_metrics, query_chainseq)
     final_dfl.append(outl)
+    if 'dedup_targetid' in targetl:
+        dedup_outls[targetl.targetid] = outl
 
 if args.final_outfile_prefix:
     outfile_prefix = args.final_outfile_prefix
@@ -0,0 +1,36 @@
+######################################################################################88
+import argparse
+
+parser = argparse.ArgumentParser(
+    description = "Build all the BLAST databases (MHC alleles, class II chains, and "
+    "TCR V/J genes) ahead of time. Optional: they are also built on first use, "
+    "but running this once after download_blast.py means that many setup or "
+    "parsing jobs started in parallel don't all wait on the first build.",
+)
+
+parser.add_argument('--force', action='store_true',
+                    help='Rebuild even if the databases are already there')
+
+args = parser.parse_args()
+
+import tcrdock
+from tcrdock.util import path_to_db
+from tcrdock.tcrdist import parsing
+from tcrdock.tcrdist.all_genes import all_genes
+
+mhc_fastafiles = (
+    [tcrdock.mhc_util._get_mhc_allele_dbfile(organism)
+     for organism in ['human', 'mouse']] +
+    [str(path_to_db / f'both_class_2_{ab}_chains_v2.fasta') for ab in 'AB'])
+
+tcr_fastafiles = [parsing.get_blast_db_path(organism, ab, vj)
+                  for organism in all_genes for ab in 'AB' for vj in 'VJ']
+
+for fastafile in mhc_fastafiles:
+    tcrdock.blast.ensure_blast_dbs(fastafile, force=args.force)
+
+parsing.make_blast_dbs(force=args.force)
+
+for fastafile in mhc_fastafiles + tcr_fastafiles:
+    assert tcrdock.blast.check_for_blast_dbs(fastafile)
+print('blast dbs are ready:', len(mhc_fastafiles)+len(tcr_fastafiles))
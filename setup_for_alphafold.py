@@ -60,6 +60,31 @@ parser.add_argument('--new_docking', action='store_true',
                     'This only requires 1 run per target (ie, it is 3x faster than '
                     'the default) and preliminary tests of the fine-tuned version '
                     'are promising.')
+parser.add_argument('--num_workers', type=int, default=1,
+                    help='Number of worker processes for building the templates; '
+                    'targets are farmed out to a process pool if this is >1 '
+                    '(default is 1)')
+parser.add_argument('--resume', action='store_true',
+                    help='Pick up an interrupted setup run in --output_dir, skipping '
+                    'targets whose alignment files and template pdbs already exist')
+parser.add_argument('--dedup_targets', action='store_true',
+                    help='Only set up (and model) one copy of any duplicate targets, '
+                    'ie rows with the same organism, MHC, peptide, and TCR genes and '
+                    'CDR3s. The other copies stay in targets.tsv, and '
+                    'run_prediction.py copies the results over to them.')
+parser.add_argument('--template_format', choices=['pdb','npz','both'],
+                    default='pdb',
+                    help="Format of the template files: 'pdb', 'npz' (AlphaFold "
+                    "atom37 arrays, read directly by run_prediction.py without any "
+                    "pdb parsing), or 'both' (the pdbs are then just for looking at). "
+                    "Default is 'pdb'")
+parser.add_argument('--template_cache_mb', type=float,
+                    help='Memory bound (in MB, per worker process) for the cache of '
+                    'parsed template structures; the least recently used templates '
+                    'are dropped when it fills up. Default is 1024, or the '
+                    'TCRDOCK_TEMPLATE_CACHE_MB environment variable. The '
+                    'template_pose_cache: lines in the log show how much it is '
+                    'being used.')
 
 args = parser.parse_args()
 
@@ -128,4 +153,9 @@ tcrdock.sequtil.setup_for_alphafold(
     min_dgeom_singlechain_tcrdist = min_dgeom_singlechain_tcrdist,
     exclude_pdbids_column = args.exclude_pdbids_column,
     use_opt_dgeoms = args.new_docking,
+    num_workers = args.num_workers,
+    resume = args.resume,
+    template_format = args.template_format,
+    dedup_targets = args.dedup_targets,
+    template_cache_mb = args.template_cache_mb,
 )
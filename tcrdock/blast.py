@@ -1,4 +1,10 @@
+import os
 import random
+import tempfile
+import shutil
+import fcntl
+import hashlib
+from contextlib import contextmanager
 import pandas as pd
 from pathlib import Path
 from os import system, remove
@@ -16,15 +22,90 @@ blast_fields = ('evalue bitscore qaccver saccver pident length mismatch'
                 ' gapopen qstart qend qlen qseq sstart send slen sseq')
 
 def make_blast_dbs(fastafile, dbtype='prot'):
+    ''' Run makeblastdb; if it succeeds, write the marker file that
+    check_for_blast_dbs looks for. Use ensure_blast_dbs unless you're holding the
+    blast_db_lock already.
+    '''
     assert dbtype in ['prot','nucl']
 
     cmd = f'{makeblastdb_exe} -in {fastafile} -dbtype {dbtype}'
     print(cmd)
-    system(cmd)
+    status = system(cmd)
+
+    suffix = '.phr' if dbtype == 'prot' else '.nhr'
+    if status == 0 and exists(str(fastafile)+suffix):
+        marker = _blast_db_marker(fastafile)
+        with open(marker+'.tmp', 'w') as out:
+            out.write(_fasta_fingerprint(fastafile)+'\n')
+        os.replace(marker+'.tmp', marker)
+
 
+def _blast_db_marker(fastafile):
+    return str(fastafile)+'.blastdb_ok'
 
+def _fasta_fingerprint(fastafile):
+    with open(fastafile, 'rb') as data:
+        return hashlib.md5(data.read()).hexdigest()
+
+
+_ready_blast_dbs = set() # already checked in this process
 def check_for_blast_dbs(fastafile):
-    return exists(str(fastafile)+'.phr')
+    ''' True if makeblastdb finished successfully on the current contents of
+    fastafile (the marker file has the md5 of the fasta)
+    '''
+    fastafile = str(fastafile)
+    if fastafile in _ready_blast_dbs:
+        return True
+    marker = _blast_db_marker(fastafile)
+    if not (exists(marker) and exists(fastafile)):
+        return False
+    with open(marker, 'r') as data:
+        ok = data.read().strip() == _fasta_fingerprint(fastafile)
+    if ok:
+        _ready_blast_dbs.add(fastafile)
+    return ok
+
+
+@contextmanager
+def blast_db_lock(fastafile):
+    ''' Exclusive lock (fcntl.flock on <fastafile>.lock) so that only one
+    process at a time writes a given fasta file and its blast db files
+    '''
+    with open(str(fastafile)+'.lock', 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def ensure_blast_dbs(fastafile, dbtype='prot', write_fasta=None, force=False):
+    ''' Build the blast db files for fastafile, once, safely when there are many
+    processes starting up at the same time: the first one builds while holding
+    blast_db_lock, the rest wait for it and then see the finished db.
+
+    write_fasta (optional) is a function that takes a filename and writes the
+    fasta there, for fasta files that are generated rather than shipped; it's
+    written to a temporary file and renamed into place.
+
+    force=True rebuilds even if the db is already there
+    '''
+    if not force and check_for_blast_dbs(fastafile):
+        return
+    with blast_db_lock(fastafile):
+        if not force and check_for_blast_dbs(fastafile): # someone else just made it
+            return
+        _ready_blast_dbs.discard(str(fastafile))
+        if write_fasta is not None:
+            tmpfile = f'{fastafile}.{os.getpid()}.tmp'
+            write_fasta(tmpfile)
+            os.replace(tmpfile, fastafile)
+            print('made:', fastafile)
+        assert exists(fastafile), f'missing file for BLAST-ing against: {fastafile}'
+        print('ensure_blast_dbs: building blast db files for', fastafile)
+        make_blast_dbs(fastafile, dbtype)
+        assert check_for_blast_dbs(fastafile), 'Failed to create blast db files!'
+
 
 def blast_file_and_read_hits(
         fname,
@@ -37,12 +118,8 @@ def blast_file_and_read_hits(
 ):
     assert exists(dbfile), f'missing file for BLAST-ing against: {dbfile}'
 
-    # check for blast database files
-    if not check_for_blast_dbs(dbfile):
-        # maybe we haven't set up the blast files yet...
-        print('WARNING: missing blast db files, trying to create...')
-        make_blast_dbs(dbfile)
-        assert check_for_blast_dbs(dbfile), 'Failed to create blast db files!'
+    # check for blast database files; maybe we haven't set them up yet
+    ensure_blast_dbs(dbfile)
 
     outfile = fname+'.blast'
     assert clobber or not exists(outfile)
@@ -93,6 +170,54 @@ def blast_sequence_and_read_hits(
 
 
 
+def blast_sequences_and_read_hits(
+        query_sequences,
+        dbfile,
+        evalue = 1e-3,
+        num_alignments = 10000,
+        num_threads = 1,
+        verbose=False,
+):
+    ''' Batched version of blast_sequence_and_read_hits: one blastp run for all
+    the query_sequences
+
+    returns dict mapping from query sequence to the blast_hits DataFrame for that
+    query (which may be empty); duplicate query sequences are only blasted once
+
+    the temporary files go in a fresh temporary directory, not the current dir
+    '''
+    unique_seqs = list(dict.fromkeys(query_sequences)) # preserve order
+    if not unique_seqs:
+        return {}
+
+    tmpdir = tempfile.mkdtemp(prefix='tcrdock_blast_')
+    try:
+        fname = tmpdir+'/queries.fasta'
+        with open(fname, 'w') as out:
+            for ii, seq in enumerate(unique_seqs):
+                out.write(f'>q{ii}\n{seq}\n')
+
+        extra_blast_args = f'-num_threads {num_threads}' if num_threads>1 else ''
+        try:
+            blast_hits = blast_file_and_read_hits(
+                fname, dbfile, evalue, num_alignments, verbose, clobber=True,
+                extra_blast_args=extra_blast_args)
+        except pd.errors.EmptyDataError: # no hits for any query
+            blast_hits = pd.DataFrame(columns=blast_fields.split())
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    # split by query; hits keep the blastp output order
+    hits_by_query = dict(list(blast_hits.groupby(blast_hits.qaccver.astype(str),
+                                                 sort=False)))
+    all_hits = {}
+    for ii, seq in enumerate(unique_seqs):
+        hits = hits_by_query.get(f'q{ii}', blast_hits.iloc[:0])
+        all_hits[seq] = hits.assign(qaccver='tmp').reset_index(drop=True)
+    return all_hits
+
+
+
 def setup_query_to_hit_map(hit):
     ''' hit is a single row from blast_hits
 
@@ -0,0 +1,221 @@
+######################################################################################88
+''' Simple persistent (on-disk) caches for expensive, deterministic lookups
+
+Each cached value is pickled into its own file:
+
+  <cache_dir>/<name>/<key[:2]>/<key>.pkl
+
+written to a temporary file first and then os.replace'd into place, so it's safe
+to have several setup processes reading and writing the same cache at once.
+
+The cache lives in tcrdock/db/cache/ by default; set the TCRDOCK_CACHE_DIR
+environment variable to put it somewhere else, or TCRDOCK_DISK_CACHE=0 to turn
+off the disk caching entirely. It can be deleted at any time.
+
+There's also a single SQLite file (<cache_dir>/annotations.sqlite) for the many
+small results of the sequence-annotation functions (MHC allele, MHC core positions,
+TCR sequence parsing), see sqlite_load_cached and sqlite_save_cached.
+
+Keys should include db_fingerprint(...) of any db files the cached value depends
+on, so that stale entries just stop being used if those files change.
+
+LRUCache is an in-memory cache with a bound on the total size of its values, for
+things like parsed template poses that can add up over a long run.
+'''
+import os
+import hashlib
+import pickle
+import sqlite3
+from collections import OrderedDict
+from os.path import exists
+from pathlib import Path
+
+from .util import path_to_db
+
+CACHE_VERSION = 1 # bump this to invalidate everything
+
+cache_dir = Path(os.environ.get('TCRDOCK_CACHE_DIR', path_to_db / 'cache'))
+
+disk_cache_enabled = os.environ.get('TCRDOCK_DISK_CACHE', '1') != '0'
+
+
+def make_key(*args):
+    ''' args should have a deterministic repr (no sets!, use sorted tuples)
+    '''
+    return hashlib.sha1(repr((CACHE_VERSION,)+args).encode()).hexdigest()
+
+
+_db_fingerprints = {}
+def db_fingerprint(*filenames):
+    ''' md5 of the contents of the files, which should be small-ish
+    '''
+    filenames = tuple(str(x) for x in filenames)
+    if filenames not in _db_fingerprints:
+        md5 = hashlib.md5()
+        for filename in filenames:
+            with open(filename, 'rb') as data:
+                md5.update(data.read())
+        _db_fingerprints[filenames] = md5.hexdigest()
+    return _db_fingerprints[filenames]
+
+
+def _cachefile(name, key):
+    return cache_dir / name / key[:2] / f'{key}.pkl'
+
+
+def load_cached(name, key):
+    ''' returns None if not cached (so don't cache None values)
+    '''
+    if not disk_cache_enabled:
+        return None
+    cachefile = _cachefile(name, key)
+    if not exists(cachefile):
+        return None
+    try:
+        with open(cachefile, 'rb') as data:
+            return pickle.load(data)
+    except Exception as e:
+        # truncated file or something like that; just recompute
+        print('WARNING: load_cached failed:', cachefile, e)
+        return None
+
+
+def save_cached(name, key, value):
+    if not disk_cache_enabled:
+        return
+    cachefile = _cachefile(name, key)
+    try:
+        os.makedirs(cachefile.parent, exist_ok=True)
+        tmpfile = f'{cachefile}.{os.getpid()}.tmp'
+        with open(tmpfile, 'wb') as out:
+            pickle.dump(value, out, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, cachefile)
+    except OSError as e:
+        # read-only install, full disk, etc: caching is just an optimization
+        print('WARNING: save_cached failed:', cachefile, e)
+
+
+MISSING = object() # returned by sqlite_load_cached if there's no cached value
+
+_sqlite_connections = {} # indexed by pid, since we may have forked
+_sqlite_memo = {} # in-memory layer in front of the db
+
+def _get_sqlite_connection():
+    pid = os.getpid()
+    if pid not in _sqlite_connections:
+        os.makedirs(cache_dir, exist_ok=True)
+        # autocommit, and wait for other processes that are writing
+        conn = sqlite3.connect(str(cache_dir / 'annotations.sqlite'), timeout=60,
+                               isolation_level=None)
+        conn.execute('CREATE TABLE IF NOT EXISTS memo (name TEXT, key TEXT, '
+                     'value BLOB, PRIMARY KEY (name, key))')
+        _sqlite_connections[pid] = conn
+    return _sqlite_connections[pid]
+
+
+def sqlite_load_cached(name, key):
+    ''' returns MISSING if not cached (None is a valid cached value here)
+    '''
+    if (name, key) in _sqlite_memo:
+        return _sqlite_memo[(name, key)]
+    if not disk_cache_enabled:
+        return MISSING
+    try:
+        row = _get_sqlite_connection().execute(
+            'SELECT value FROM memo WHERE name=? AND key=?', (name, key)).fetchone()
+    except sqlite3.Error as e:
+        print('WARNING: sqlite_load_cached failed:', name, e)
+        return MISSING
+    if row is None:
+        return MISSING
+    value = pickle.loads(row[0])
+    _sqlite_memo[(name, key)] = value
+    return value
+
+
+def sqlite_save_cached(name, key, value):
+    _sqlite_memo[(name, key)] = value
+    if not disk_cache_enabled:
+        return
+    try:
+        _get_sqlite_connection().execute(
+            'INSERT OR REPLACE INTO memo VALUES (?,?,?)',
+            (name, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+    except (sqlite3.Error, OSError) as e:
+        print('WARNING: sqlite_save_cached failed:', name, e)
+
+
+class LRUCache:
+    ''' In-memory least-recently-used cache with a memory bound
+
+    sizeof(value) should return the (approximate) size of value in bytes. Once the
+    total goes over max_bytes the least recently used values are dropped. max_bytes
+    of None means no bound.
+
+    Keeps hit/miss/eviction counts, see stats()
+    '''
+    def __init__(self, max_bytes, sizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data = OrderedDict() # key -> (value, nbytes), most recent last
+        self.nbytes = 0
+        self.max_nbytes_seen = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        ''' returns default if key is not cached (counts as a miss)
+        '''
+        if key not in self._data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return self._data[key][0]
+
+    def put(self, key, value):
+        if key in self._data:
+            self.nbytes -= self._data.pop(key)[1]
+        nbytes = self.sizeof(value)
+        self._data[key] = (value, nbytes)
+        self.nbytes += nbytes
+        self.max_nbytes_seen = max(self.max_nbytes_seen, self.nbytes)
+        self._evict()
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def _evict(self):
+        # always keep the most recent value, even if it's too big by itself
+        while (self.max_bytes is not None and self.nbytes > self.max_bytes and
+               len(self._data) > 1):
+            _, (_, nbytes) = self._data.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        ''' dict with the counts and sizes, for tuning max_bytes
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'nbytes': self.nbytes,
+            'max_nbytes_seen': self.max_nbytes_seen,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits/lookups if lookups else 0.,
+        }
@@ -1,8 +1,8 @@
 # import numpy as np
 import sys
 # from os import system
+import os
 import os.path
-from os import system, popen
 from os.path import exists
 from pathlib import Path
 import pandas as pd
@@ -13,8 +13,8 @@ from . import util
 from . import blast
 from . import sequtil
 from . import pdblite
+from . import cache
 
-from .blast import path_to_blast_executables
 from .util import path_to_db
 from .sequtil import ALL_GENES_GAP_CHAR
 
@@ -46,7 +46,18 @@ def get_mhc_core_positions_class1(seq):
     ''' These are 0-indexed positions (unlike previous tcrdock)
 
     will have -1 if there's a parse fail
+
+    results are cached on disk (see cache.py)
     '''
+    key = cache.make_key(seq, class1_template_seq,
+                         class1_template_core_positions_0indexed)
+    core_positions = cache.sqlite_load_cached('mhc_core_positions_class1', key)
+    if core_positions is cache.MISSING:
+        core_positions = _get_mhc_core_positions_class1(seq)
+        cache.sqlite_save_cached('mhc_core_positions_class1', key, core_positions)
+    return list(core_positions)
+
+def _get_mhc_core_positions_class1(seq):
     al = sequtil.blosum_align(class1_template_seq, seq)
 
     core_positions = [
@@ -64,13 +75,59 @@ def get_mhc_core_positions_class2(
     ''' these are 0-indexed positions!!! (unlike previous tcrdock)
 
     will have -1 if there's a parse fail
+
+    results are cached on disk (see cache.py), since this means 2 BLAST runs
+    '''
+    key = _get_mhc_core_positions_class2_key(aseq, bseq)
+    core_positions = cache.sqlite_load_cached('mhc_core_positions_class2', key)
+    if core_positions is cache.MISSING:
+        core_positions = _get_mhc_core_positions_class2(aseq, bseq)
+        cache.sqlite_save_cached('mhc_core_positions_class2', key, core_positions)
+    return list(core_positions)
+
+def _get_mhc_core_positions_class2_key(aseq, bseq):
+    return cache.make_key(
+        aseq, bseq, class2_alfas_positions_0indexed,
+        cache.db_fingerprint(*[path_to_db / f'both_class_2_{ab}_chains_v2.alfas'
+                               for ab in 'AB']))
+
+def get_mhc_core_positions_class2_batch(aseqs_and_bseqs, num_threads=1):
+    ''' batched version of get_mhc_core_positions_class2: one BLAST run per chain
+    type for all the uncached (aseq, bseq) pairs
+
+    returns list of core_positions lists (and saves them in the cache)
+    '''
+    keys = [_get_mhc_core_positions_class2_key(a,b) for a,b in aseqs_and_bseqs]
+    todo = [x for x,key in zip(aseqs_and_bseqs, keys)
+            if cache.sqlite_load_cached('mhc_core_positions_class2', key)
+            is cache.MISSING]
+    if todo:
+        all_hits = {}
+        for ii, ab in enumerate('AB'):
+            dbfile = str(path_to_db / f'both_class_2_{ab}_chains_v2.fasta')
+            all_hits[ab] = blast.blast_sequences_and_read_hits(
+                [x[ii] for x in todo], dbfile, num_threads=num_threads)
+        for aseq, bseq in dict.fromkeys(todo):
+            core_positions = _get_mhc_core_positions_class2(
+                aseq, bseq, {'A':all_hits['A'][aseq], 'B':all_hits['B'][bseq]})
+            cache.sqlite_save_cached(
+                'mhc_core_positions_class2',
+                _get_mhc_core_positions_class2_key(aseq, bseq), core_positions)
+    return [get_mhc_core_positions_class2(a,b) for a,b in aseqs_and_bseqs]
+
+def _get_mhc_core_positions_class2(aseq, bseq, hits_by_chain=None):
+    ''' hits_by_chain (optional) is a dict {'A':hits, 'B':hits} of BLAST hits
+    against the class 2 chain dbs, e.g. from a batched BLAST run
     '''
     offset = 0
     core_positions = []
 
     for ab, seq in zip('AB',[aseq,bseq]):
-        dbfile = str(path_to_db / f'both_class_2_{ab}_chains_v2.fasta')
-        hits = blast.blast_sequence_and_read_hits(seq, dbfile)
+        if hits_by_chain is None:
+            dbfile = str(path_to_db / f'both_class_2_{ab}_chains_v2.fasta')
+            hits = blast.blast_sequence_and_read_hits(seq, dbfile)
+        else:
+            hits = hits_by_chain[ab]
         hit = hits.iloc[0]
         blast_align = blast.setup_query_to_hit_map(hit)
         if hit.pident<99.99:
@@ -101,24 +158,22 @@ def get_mhc_core_positions_class2(
 def _setup_class_2_alfas_blast_dbs():
     ''' Just called once during setup
     '''
-
-    makeblastdb_exe = str(path_to_blast_executables / 'makeblastdb')
-
     for ab in 'AB':
         alfas_fname = str(path_to_db / f'both_class_2_{ab}_chains_v2.alfas')
         fasta_fname = alfas_fname[:-5]+'fasta'
 
         alfas = sequtil.read_fasta(alfas_fname)
-        out = open(fasta_fname, 'w')
-        for name,alseq in alfas.items():
-            seq = alseq.replace(ALL_GENES_GAP_CHAR, '')
-            out.write(f'>{name}\n{seq}\n')
-        out.close()
+        with blast.blast_db_lock(fasta_fname):
+            tmpfile = f'{fasta_fname}.{os.getpid()}.tmp'
+            out = open(tmpfile, 'w')
+            for name,alseq in alfas.items():
+                seq = alseq.replace(ALL_GENES_GAP_CHAR, '')
+                out.write(f'>{name}\n{seq}\n')
+            out.close()
+            os.replace(tmpfile, fasta_fname)
 
-        # format the db
-        cmd = f'{makeblastdb_exe} -in {fasta_fname} -dbtype prot'
-        print(cmd)
-        system(cmd)
+            # format the db
+            blast.make_blast_dbs(fasta_fname)
 
 
 
@@ -224,18 +279,62 @@ def make_sorting_tuple(allele):
 
 
 
-def get_mhc_allele(seq, organism, return_identity=False):
+def _get_mhc_allele_dbfile(organism):
     if organism == 'human':
-        dbfile = (util.path_to_db /
-                  'hla_prot_plus_trimmed_minus_funny_w_CD1s_nr_v2.fasta')
+        return (util.path_to_db /
+                'hla_prot_plus_trimmed_minus_funny_w_CD1s_nr_v2.fasta')
     else:
         assert organism == 'mouse'
-        dbfile = (util.path_to_db /
-                  'mhc_pdb_chains_mouse_reps_reformat.fasta')
+        return (util.path_to_db /
+                'mhc_pdb_chains_mouse_reps_reformat.fasta')
 
+def get_mhc_allele(seq, organism, return_identity=False):
+    ''' BLAST seq against the MHC sequences for organism
 
-    hits = blast.blast_sequence_and_read_hits(
-        seq, dbfile, num_alignments=3)
+    results are cached on disk (see cache.py)
+    '''
+    dbfile = _get_mhc_allele_dbfile(organism)
+    key = _get_mhc_allele_key(seq, organism, dbfile)
+    mhc_and_identity = cache.sqlite_load_cached('mhc_allele', key)
+    if mhc_and_identity is cache.MISSING:
+        mhc_and_identity = _get_mhc_allele(seq, organism, dbfile)
+        cache.sqlite_save_cached('mhc_allele', key, mhc_and_identity)
+    mhc, pident = mhc_and_identity
+    if return_identity:
+        return mhc, pident
+    else:
+        return mhc
+
+def _get_mhc_allele_key(seq, organism, dbfile):
+    return cache.make_key(seq, organism, cache.db_fingerprint(dbfile))
+
+def get_mhc_alleles(seqs, organism, num_threads=1):
+    ''' batched version of get_mhc_allele: one BLAST run for all the uncached seqs
+
+    returns list of alleles (and saves them in the cache)
+    '''
+    dbfile = _get_mhc_allele_dbfile(organism)
+    todo = [seq for seq in seqs
+            if cache.sqlite_load_cached(
+                'mhc_allele', _get_mhc_allele_key(seq, organism, dbfile))
+            is cache.MISSING]
+    if todo:
+        all_hits = blast.blast_sequences_and_read_hits(
+            todo, dbfile, num_alignments=3, num_threads=num_threads)
+        for seq, hits in all_hits.items():
+            cache.sqlite_save_cached(
+                'mhc_allele', _get_mhc_allele_key(seq, organism, dbfile),
+                _get_mhc_allele(seq, organism, dbfile, hits))
+    return [get_mhc_allele(seq, organism) for seq in seqs]
+
+def _get_mhc_allele(seq, organism, dbfile, hits=None):
+    ''' returns mhc, pident
+
+    hits (optional) are the BLAST hits of seq against dbfile
+    '''
+    if hits is None:
+        hits = blast.blast_sequence_and_read_hits(
+            seq, dbfile, num_alignments=3)
     top_bitscore = max(hits.bitscore)
     top_hits = hits[hits.bitscore == top_bitscore].reset_index()
     if top_hits.shape[0]>1:# ties
@@ -252,10 +351,7 @@ def get_mhc_allele(seq, organism, return_identity=False):
     if organism == 'mouse' and len(mhc) == 3 and mhc[1] == '-':
         mhc = f'H2{mhc[0]}{mhc[2].lower()}'
 
-    if return_identity:
-        return mhc, hit.pident
-    else:
-        return mhc
+    return mhc, float(hit.pident)
 
 
 
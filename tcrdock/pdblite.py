@@ -3,12 +3,210 @@ from . import tcrdist
 import numpy as np
 import itertools as it
 from sys import exit
-from collections import Counter, OrderedDict
-import copy
+from collections import OrderedDict
+from collections.abc import Mapping
+import gzip
 
 long2short_MSE = dict(**long2short, MSE='M')
 
-def load_pdb_coords(
+class Pose(Mapping):
+    ''' Structure-of-arrays pose: all the atoms of all the residues in one array
+
+    xyz              float64 (num_atoms,3)
+    atom_names       str     (num_atoms,)   with the PDB whitespace, e.g. ' CA '
+    res_atom_bounds  int64   (num_res+1,)   atoms for residue i: [b[i], b[i+1])
+    resids           list of (chain,resid) tuples, resid is the pdb resid line[22:27]
+    sequence         string, 1-letter code
+
+    plus the index arrays atom_residue (num_atoms,) and residue_chain (num_res,)
+
+    For compatibility with the older dict poses this is a read-only Mapping with
+    the same keys: 'resids', 'coords', 'sequence', 'ca_coords', 'chains',
+    'chainseq', 'chainbounds'. pose['coords'] is a view that makes the
+    per-residue {atom:xyz} OrderedDicts on demand (the xyz are views into
+    pose.xyz).
+
+    The pdblite functions (apply_transform_Rx_plus_v, delete_chains, etc) work on
+    the arrays and return new Poses. They also accept dict poses. Use to_dict() to
+    get an old-style, modifiable dict pose.
+    '''
+    _keys = ('resids', 'coords', 'sequence', 'ca_coords', 'chains', 'chainseq',
+             'chainbounds')
+
+    def __init__(self, xyz, atom_names, res_atom_bounds, resids, sequence):
+        self.xyz = xyz
+        self.atom_names = np.asarray(atom_names, dtype='U4')
+        self.res_atom_bounds = np.asarray(res_atom_bounds, dtype=np.int64)
+        self.resids = list(resids)
+        self.sequence = sequence
+        assert len(self.resids) == len(self.sequence) == len(self.res_atom_bounds)-1
+        assert self.xyz.shape == (self.res_atom_bounds[-1], 3)
+        assert self.atom_names.shape == (self.xyz.shape[0],)
+
+        chains = [x[0] for x in it.groupby(self.resids, lambda x:x[0])]
+        assert len(set(chains)) == len(chains) # each chain comes once
+        chain_lens = [sum(1 for _ in g) for _,g in
+                      it.groupby(self.resids, lambda x:x[0])]
+        self.chains = chains
+        self.chainbounds = [0] + list(it.accumulate(chain_lens))
+        self.chainseq = '/'.join(
+            self.sequence[b:e] for b,e in zip(self.chainbounds[:-1],
+                                              self.chainbounds[1:]))
+        self.residue_chain = np.repeat(np.arange(len(chains)), chain_lens)
+        self.atom_residue = np.repeat(np.arange(len(self.resids)),
+                                      np.diff(self.res_atom_bounds))
+        self._ca_coords = None
+        self._resid2index = None
+
+    @classmethod
+    def from_dict(cls, pose):
+        ''' pose is an old-style dict pose with 'resids', 'coords', 'sequence'
+        '''
+        resids, coords = pose['resids'], pose['coords']
+        atoms = [coords[r] for r in resids]
+        counts = [len(a) for a in atoms]
+        if resids:
+            xyz = np.array([xyz for a in atoms for xyz in a.values()],
+                           dtype=np.float64).reshape(-1,3)
+        else:
+            xyz = np.zeros((0,3))
+        names = [name for a in atoms for name in a.keys()]
+        return cls(xyz, names, np.cumsum([0]+counts), resids, pose['sequence'])
+
+    def to_dict(self):
+        ''' returns an old-style dict pose, with copies of the coordinates
+        '''
+        xyz = self.xyz.copy()
+        coords = {}
+        names = self.atom_names.tolist()
+        bounds = self.res_atom_bounds.tolist()
+        for r, a0, a1 in zip(self.resids, bounds[:-1], bounds[1:]):
+            coords[r] = OrderedDict(zip(names[a0:a1], xyz[a0:a1]))
+        pose = {'resids':list(self.resids), 'coords':coords,
+                'sequence':self.sequence}
+        return update_derived_data(pose)
+
+    def _replace(self, xyz=None, resids=None):
+        return Pose(self.xyz if xyz is None else xyz, self.atom_names,
+                    self.res_atom_bounds, self.resids if resids is None else resids,
+                    self.sequence)
+
+    def select_residues(self, positions):
+        ''' returns a new Pose with just the residues at positions (0-indexed,
+        in the given order)
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+        starts = self.res_atom_bounds[positions]
+        counts = self.res_atom_bounds[positions+1] - starts
+        # atom indices for all the selected residues, in order
+        atoms = (np.repeat(starts - np.cumsum(counts) + counts, counts) +
+                 np.arange(counts.sum()))
+        return Pose(self.xyz[atoms], self.atom_names[atoms],
+                    np.concatenate([[0], np.cumsum(counts)]),
+                    [self.resids[i] for i in positions],
+                    ''.join(self.sequence[i] for i in positions))
+
+    def atom_index(self, atom_name):
+        ''' index into xyz of the first atom named atom_name in each residue,
+        -1 if missing
+        '''
+        inds = np.full(len(self.resids), -1, dtype=np.int64)
+        matches = np.nonzero(self.atom_names == atom_name)[0][::-1] # first wins
+        inds[self.atom_residue[matches]] = matches
+        return inds
+
+    @property
+    def ca_coords(self):
+        if self._ca_coords is None:
+            if self.resids:
+                inds = self.atom_index(' CA ')
+                assert np.all(inds >= 0), 'missing CA atoms'
+                self._ca_coords = self.xyz[inds]
+                self._ca_coords.flags.writeable = self.xyz.flags.writeable
+            else: # empty
+                self._ca_coords = []
+        return self._ca_coords
+
+    @property
+    def nbytes(self):
+        ''' rough memory footprint in bytes, for cache accounting: the arrays plus
+        ~120 bytes per residue for the resids tuples and ~100 per resid2index entry
+        '''
+        nbytes = sum(x.nbytes for x in [self.xyz, self.atom_names,
+                                        self.res_atom_bounds, self.residue_chain,
+                                        self.atom_residue])
+        if self._ca_coords is not None and len(self.resids):
+            nbytes += self._ca_coords.nbytes
+        nbytes += 120*len(self.resids) + 2*len(self.sequence)
+        if self._resid2index is not None:
+            nbytes += 100*len(self._resid2index)
+        return nbytes
+
+    def resid2index(self):
+        if self._resid2index is None:
+            self._resid2index = {r:i for i,r in enumerate(self.resids)}
+        return self._resid2index
+
+    # dict-pose compatibility
+    def __getitem__(self, key):
+        if key == 'coords':
+            return _PoseCoords(self)
+        elif key in self._keys:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __setitem__(self, key, value):
+        raise TypeError('Pose is read-only; use the pdblite functions or to_dict()')
+
+
+class _PoseCoords(Mapping):
+    ''' pose['coords'] for a Pose: maps (chain,resid) to OrderedDict {atom:xyz}
+    '''
+    def __init__(self, pose):
+        self.pose = pose
+
+    def __getitem__(self, r):
+        pose = self.pose
+        i = pose.resid2index()[r]
+        a0, a1 = pose.res_atom_bounds[i:i+2]
+        return OrderedDict(zip(pose.atom_names[a0:a1].tolist(), pose.xyz[a0:a1]))
+
+    def __iter__(self):
+        return iter(self.pose.resids)
+
+    def __len__(self):
+        return len(self.pose.resids)
+
+    def __contains__(self, r):
+        return r in self.pose.resid2index()
+
+
+def to_pose(pose):
+    ''' Pose from a Pose or dict pose (no copy if it's already a Pose)
+    '''
+    return pose if isinstance(pose, Pose) else Pose.from_dict(pose)
+
+
+def _fixed_columns(lines, width):
+    ''' lines is a list of bytes; returns an (N,width) array of single bytes
+    (lines are truncated/padded with spaces to width)
+    '''
+    buf = b''.join(line[:width].ljust(width) for line in lines)
+    return np.frombuffer(buf, dtype='S1').reshape(len(lines), width)
+
+def _column(cols, start, stop):
+    ''' bytes array for the columns [start,stop) of the _fixed_columns array
+    '''
+    return np.ascontiguousarray(cols[:,start:stop]).view(f'S{stop-start}').ravel()
+
+
+def read_pdb_atoms(
         pdbfile,
         allow_chainbreaks=False,
         allow_skipped_lines=False,
@@ -18,54 +216,88 @@ def load_pdb_coords(
         require_bb=False,
         ignore_altloc=True,
 ):
-    ''' returns: chains, all_resids, all_coords, all_name1s
-    '''
+    ''' Vectorized pdb reader: the ATOM/HETATM lines are sliced into fixed-width
+    columns with numpy and grouped into residues with np.unique, rather than
+    parsing line-by-line.
+
+    returns: resids, sequence, xyz, atom_names, res_atom_bounds
+
+    resids is a list of (chain, resid) tuples, each chain in a contiguous block
+    (chains, and residues within a chain, in order of first appearance)
 
-    chains = []
-    all_resids = {}
-    all_coords = {}
-    all_name1s = {}
+    the atoms for residue i are xyz[res_atom_bounds[i]:res_atom_bounds[i+1]], in
+    the order of the pdb lines
 
+    same filtering and checks as load_pdb_coords (which calls this)
+    '''
     if verbose:
         print('reading:', pdbfile)
-    skipped_lines = False
-    with open(pdbfile,'r') as data:
-        for line in data:
-            if line[:6] == 'ENDMDL':
-                #print('stopping ENDMDL:', pdbfile)
+    open_pdbfile = gzip.open if str(pdbfile).endswith('.gz') else open
+    with open_pdbfile(pdbfile,'rb') as data:
+        lines = []
+        for line in data.read().splitlines():
+            if line[:6] == b'ENDMDL':
                 break
-            if (line[:6] in ['ATOM  ','HETATM'] and line[17:20] != 'HOH' and
-                (ignore_altloc or line[16] in ' A1')):
-                if line[17:20] in long2short_MSE:
-                    resid = line[22:27]
-                    chain = line[21]
-                    if chain not in all_resids:
-                        all_resids[chain] = []
-                        all_coords[chain] = {}
-                        all_name1s[chain] = {}
-                        chains.append(chain)
-                    if line.startswith('HETATM') and line[12:16] == ' CA ':
-                        print('WARNING: HETATM', pdbfile, line[:-1])
-                    if preserve_atom_name_whitespace:
-                        atom = line[12:16]
-                    else:
-                        atom = line[12:16].strip()
-                    if resid not in all_resids[chain]:
-                        all_resids[chain].append(resid)
-                        all_coords[chain][resid] = OrderedDict()
-                        all_name1s[chain][resid] = long2short_MSE[line[17:20]]
-
-                    if atom in all_coords[chain][resid]:
-                        print('WARNING: take first xyz for atom, ignore others:',
-                              chain, resid, atom, 'altloc:', line[16],
-                              pdbfile)
-                    else:
-                        all_coords[chain][resid][atom] = np.array(
-                            [float(line[30:38]),float(line[38:46]), float(line[46:54])])
-                else:
-                    if verbose or line[12:16] == ' CA ':
-                        print('skip ATOM line:', line[:-1], pdbfile)
-                    skipped_lines = True
+            if line[:6] in (b'ATOM  ', b'HETATM'):
+                lines.append(line)
+
+    cols = _fixed_columns(lines, 54)
+    resnames = _column(cols, 17, 20)
+    mask = resnames != b'HOH'
+    if not ignore_altloc:
+        mask &= np.isin(cols[:,16], [b' ', b'A', b'1'])
+    cols, resnames = cols[mask], resnames[mask]
+    lines = [line for line,m in zip(lines, mask) if m]
+    atom_names = _column(cols, 12, 16).astype('U4')
+
+    is_aa = np.isin(resnames, [x.encode() for x in long2short_MSE])
+    skipped_lines = not np.all(is_aa)
+    for ii in np.nonzero(~is_aa)[0]:
+        if verbose or atom_names[ii] == ' CA ':
+            print('skip ATOM line:', lines[ii].decode(), pdbfile)
+    cols, resnames, atom_names = cols[is_aa], resnames[is_aa], atom_names[is_aa]
+    lines = [line for line,m in zip(lines, is_aa) if m]
+
+    for ii in np.nonzero((cols[:,0] == b'H') & (atom_names == ' CA '))[0]:
+        print('WARNING: HETATM', pdbfile, lines[ii].decode())
+
+    if not preserve_atom_name_whitespace:
+        atom_names = np.char.strip(atom_names)
+
+    # group into residues: first by chain, then by resid, each in order of
+    # first appearance
+    chain_resids = _column(cols, 21, 27) # chain + resid
+    uniq, first, inverse = np.unique(chain_resids, return_index=True,
+                                     return_inverse=True)
+    inverse = inverse.ravel()
+    chain_codes = cols[:,21]
+    uniq_chains, chain_first = np.unique(chain_codes, return_index=True)
+    chain_rank = np.argsort(np.argsort(chain_first))
+    res_chain_rank = chain_rank[np.searchsorted(uniq_chains, chain_codes[first])]
+    res_order = np.lexsort((first, res_chain_rank)) # residue ranks
+    res_rank = np.empty_like(res_order)
+    res_rank[res_order] = np.arange(len(res_order))
+    atom_res = res_rank[inverse]
+    atom_order = np.argsort(atom_res, kind='stable')
+
+    # only keep the first copy of duplicated atoms
+    atom_keys = np.char.add(chain_resids.astype('U6'), atom_names)[atom_order]
+    _, keep = np.unique(atom_keys, return_index=True)
+    if len(keep) < len(atom_order):
+        dups = np.setdiff1d(np.arange(len(atom_order)), keep)
+        for ii in atom_order[dups]:
+            print('WARNING: take first xyz for atom, ignore others:',
+                  chain_codes[ii].decode(), chain_resids[ii][1:].decode(),
+                  atom_names[ii], 'altloc:', cols[ii,16].decode(), pdbfile)
+        atom_order = atom_order[np.sort(keep)]
+
+    xyz = np.stack([_column(cols, a, a+8).astype(np.float64)[atom_order]
+                    for a in [30,38,46]], axis=1)
+    atom_names = atom_names[atom_order]
+    atom_res = atom_res[atom_order]
+    res_first = first[res_order] # first line for each residue
+    resids = [(x[:1], x[1:]) for x in chain_resids[res_first].astype('U6').tolist()]
+    name1s = [long2short_MSE[x] for x in resnames[res_first].astype('U3').tolist()]
 
     # possibly subset to residues with CA
     if preserve_atom_name_whitespace:
@@ -73,40 +305,88 @@ def load_pdb_coords(
     else:
         N, CA, C = 'N', 'CA', 'C'
     require_atoms = [N,CA,C] if require_bb else [CA] if require_CA else []
+    nres = len(resids)
     if require_atoms:
-        chains = all_resids.keys()
-        for chain in chains:
-            bad_resids = [x for x,y in all_coords[chain].items()
-                          if any(a not in y for a in require_atoms)]
-            if bad_resids:
-                print('missing one of', require_atoms, bad_resids)
-                for r in bad_resids:
-                    all_resids[chain].remove(r)
-                    del all_coords[chain][r]
-                    del all_name1s[chain][r]
-
+        has_all = np.ones(nres, dtype=bool)
+        for a in require_atoms:
+            has = np.zeros(nres, dtype=bool)
+            has[atom_res[atom_names == a]] = True
+            has_all &= has
+        if not np.all(has_all):
+            for chain in dict.fromkeys(r[0] for r in resids):
+                bad_resids = [r[1] for r,ok in zip(resids, has_all)
+                              if r[0] == chain and not ok]
+                if bad_resids:
+                    print('missing one of', require_atoms, bad_resids)
+            keep_atoms = has_all[atom_res]
+            xyz, atom_names = xyz[keep_atoms], atom_names[keep_atoms]
+            atom_res = np.cumsum(has_all)[atom_res[keep_atoms]]-1
+            resids = [r for r,ok in zip(resids, has_all) if ok]
+            name1s = [a for a,ok in zip(name1s, has_all) if ok]
+            nres = len(resids)
+
+    res_atom_bounds = np.searchsorted(atom_res, np.arange(nres+1))
 
     # check for chainbreaks
     maxdis = 1.75
-    for chain in chains:
-        for res1, res2 in zip(all_resids[chain][:-1], all_resids[chain][1:]):
-            coords1 = all_coords[chain][res1]
-            coords2 = all_coords[chain][res2]
-            if C in coords1 and N in coords2:
-                dis = np.sqrt(np.sum(np.square(coords1[C]-coords2[N])))
-                if dis>maxdis:
-                    if verbose or not allow_chainbreaks:
-                        print('ERROR chainbreak:', chain, res1, res2, dis, pdbfile)
-                    if not allow_chainbreaks:
-                        print('STOP: chainbreaks', pdbfile)
-                        #print('DONE')
-                        exit()
+    c_inds, n_inds = np.full(nres, -1), np.full(nres, -1)
+    for inds, a in [(c_inds, C), (n_inds, N)]:
+        matches = np.nonzero(atom_names == a)[0]
+        inds[atom_res[matches]] = matches
+    if nres:
+        same_chain = np.array([r1[0] == r2[0] for r1,r2 in zip(resids[:-1],
+                                                                resids[1:])],
+                              dtype=bool)
+        check = same_chain & (c_inds[:-1] >= 0) & (n_inds[1:] >= 0)
+        dists = np.sqrt(np.sum(np.square(xyz[c_inds[:-1]] - xyz[n_inds[1:]]),
+                               axis=1))
+        for i in np.nonzero(check & (dists > maxdis))[0]:
+            res1, res2 = resids[i][1], resids[i+1][1]
+            if verbose or not allow_chainbreaks:
+                print('ERROR chainbreak:', resids[i][0], res1, res2, dists[i],
+                      pdbfile)
+            if not allow_chainbreaks:
+                print('STOP: chainbreaks', pdbfile)
+                #print('DONE')
+                exit()
 
     if skipped_lines and not allow_skipped_lines:
         print('STOP: skipped lines:', pdbfile)
         #print('DONE')
         exit()
 
+    return resids, ''.join(name1s), xyz, atom_names, res_atom_bounds
+
+
+def load_pdb_coords(
+        pdbfile,
+        **kwargs,
+        #allow_chainbreaks=False,
+        #allow_skipped_lines=False,
+        #verbose=False,
+        #preserve_atom_name_whitespace=False,
+        #require_CA=False,
+        #require_bb=False,
+        #ignore_altloc=True,
+):
+    ''' returns: chains, all_resids, all_coords, all_name1s
+
+    see read_pdb_atoms for the kwargs
+    '''
+    resids, sequence, xyz, atom_names, res_atom_bounds = read_pdb_atoms(
+        pdbfile, **kwargs)
+
+    chains = list(dict.fromkeys(r[0] for r in resids))
+    all_resids = {c:[] for c in chains}
+    all_coords = {c:{} for c in chains}
+    all_name1s = {c:{} for c in chains}
+    names = atom_names.tolist()
+    bounds = res_atom_bounds.tolist()
+    for (c,r), name1, a0, a1 in zip(resids, sequence, bounds[:-1], bounds[1:]):
+        all_resids[c].append(r)
+        all_coords[c][r] = OrderedDict(zip(names[a0:a1], xyz[a0:a1]))
+        all_name1s[c][r] = name1
+
     return chains, all_resids, all_coords, all_name1s
 
 def load_pdb_coords_resids(
@@ -140,7 +420,7 @@ def load_pdb_coords_resids(
 
 
 def pose_from_pdb(filename, **kwargs):
-    ''' calls update_derived_data(pose) before returning pose
+    ''' returns a Pose
     '''
     defaults = dict(
         allow_chainbreaks=True,
@@ -150,11 +430,62 @@ def pose_from_pdb(filename, **kwargs):
         require_bb=True,
     )
     kwargs = {**defaults, **kwargs}
-    resids, coords, sequence = load_pdb_coords_resids(filename, **kwargs)
-    pose = {'resids':resids, 'coords':coords, 'sequence':sequence}
-    pose = update_derived_data(pose)
+    resids, sequence, xyz, atom_names, res_atom_bounds = read_pdb_atoms(
+        filename, **kwargs)
+
+    return Pose(xyz, atom_names, res_atom_bounds, resids, sequence)
 
-    return pose
+
+def _open_for_writing(outfile):
+    ''' gzip'ed if outfile ends with .gz
+    '''
+    if str(outfile).endswith('.gz'):
+        return gzip.open(outfile, 'wt', compresslevel=6)
+    return open(outfile, 'w')
+
+
+def format_pdb_atom_lines(pose, bfactors=None):
+    ''' returns the ATOM lines for pose (with TER lines between chains) as a
+    single string
+
+    Formats whole chains at once (one big %-format per chain), rather than atom by
+    atom. The lines are the same as save_pdb_coords has always written:
+    occupancy 1.00, bfactor 50.00 by default.
+
+    bfactors is None or a list of length = resids (all atoms in res have same)
+    '''
+    pose = to_pose(pose)
+    nres = len(pose.resids)
+    if bfactors is None:
+        bfactors = np.full(nres, 50.0)
+    else:
+        assert len(bfactors) == nres
+        bfactors = np.asarray(bfactors, dtype=np.float64)
+    atom_names = pose.atom_names
+    assert np.all(np.char.str_len(atom_names) == 4)
+    assert all(len(resid) == 5 for _,resid in pose.resids)
+
+    # element is the first letter of the atom name, H for 1HB etc
+    first = np.array([x.lstrip()[:1] for x in atom_names.tolist()], dtype='U1')
+    elements = np.where(np.char.isdigit(first), 'H', first)
+
+    #              6:12 12:16  17:20      21:27
+    res_prefixes = [f' {tcrdist.amino_acids.short_to_long[name1]} {chain}{resid}   '
+                    for (chain,resid), name1 in zip(pose.resids, pose.sequence)]
+    atom_res = pose.atom_residue
+    counters = np.arange(1, len(atom_names)+1)
+    bounds = pose.res_atom_bounds
+    line_format = 'ATOM  %6d%s%s%8.2f%8.2f%8.2f  1.00%6.2f%12s\n'
+    blocks = []
+    for cbegin, cend in zip(pose.chainbounds[:-1], pose.chainbounds[1:]):
+        a0, a1 = bounds[cbegin], bounds[cend]
+        cols = [counters[a0:a1].tolist(), atom_names[a0:a1].tolist(),
+                [res_prefixes[i] for i in atom_res[a0:a1].tolist()],
+                *pose.xyz[a0:a1].T.tolist(), bfactors[atom_res[a0:a1]].tolist(),
+                elements[a0:a1].tolist()]
+        blocks.append((line_format * (a1-a0)) % tuple(
+            it.chain.from_iterable(zip(*cols))))
+    return 'TER\n'.join(blocks)
 
 
 def save_pdb_coords(
@@ -168,48 +499,124 @@ def save_pdb_coords(
 ):
 
     ''' right now bfactors is a list of length = resids (all atoms in res have same)
+
+    outfile is gzip'ed if it ends with .gz (unless out is provided)
     '''
     assert len(sequence) == len(resids)
+    pose = Pose.from_dict({'resids':resids, 'coords':coords, 'sequence':sequence})
+    lines = format_pdb_atom_lines(pose, bfactors)
     if out is None:
-        close_file = True
-        out = open(outfile, 'w')
+        with _open_for_writing(outfile) as out:
+            out.write(lines)
     else:
-        close_file = False
-    last_chain = None
-    counter=0
-    if bfactors is None:
-        bfactors = it.repeat(50.0)
-    else:
-        assert len(bfactors) == len(resids)
-    for cr, name1, bfac in zip(resids, sequence, bfactors):
-        (chain,resid) = cr
-        name3 = tcrdist.amino_acids.short_to_long[name1]
-        if chain != last_chain and last_chain is not None:
-            out.write('TER\n')
-        last_chain = chain
-        for atom,xyz in coords[cr].items():
-            counter += 1
-            a = atom.strip()
-            assert len(atom) == 4
-            assert len(resid) == 5
-            element = 'H' if a[0].isdigit() else a[0]
-            occ=1.
-            #                   6:12      12:16   17:20    21    22:27
-            outline = (f'ATOM  {counter:6d}{atom} {name3} {chain}{resid}   '
-                       f'{xyz[0]:8.2f}{xyz[1]:8.2f}{xyz[2]:8.2f}{occ:6.2f}{bfac:6.2f}'
-                       f'{element:>12s}\n')
-            assert (outline[12:16] == atom and outline[17:20] == name3 and
-                    outline[22:27] == resid) # confirm register
-            out.write(outline)
-    if close_file:
-        out.close()
+        out.write(lines)
     if verbose:
         print('made:', outfile)
 
 
-def dump_pdb(pose, outfile, out=None):
-    save_pdb_coords(outfile, pose['resids'], pose['coords'], pose['sequence'],
-                    out=out)
+def save_pose_npz(pose, outfile):
+    ''' Binary version of the pdbfile, for fast reloading with pose_from_npz
+    '''
+    pose = to_pose(pose)
+    np.savez(
+        outfile,
+        xyz = pose.xyz,
+        atom_names = pose.atom_names,
+        res_atom_bounds = pose.res_atom_bounds,
+        res_chains = np.array([x[0] for x in pose.resids], dtype='U1'),
+        res_resids = np.array([x[1] for x in pose.resids], dtype='U5'),
+        sequence = np.array(pose.sequence),
+    )
+
+
+def pose_from_npz(filename):
+    ''' Reads a file written by save_pose_npz
+    '''
+    with np.load(filename) as data:
+        resids = list(zip(data['res_chains'].tolist(), data['res_resids'].tolist()))
+        return Pose(data['xyz'], data['atom_names'], data['res_atom_bounds'],
+                    resids, str(data['sequence']))
+
+
+def dump_pdb(pose, outfile, out=None, sidecar=False):
+    ''' outfile is gzip'ed if it ends with .gz
+
+    if sidecar, also write the binary version to outfile+'.npz' (see
+    save_pose_npz)
+    '''
+    lines = format_pdb_atom_lines(pose)
+    if out is None:
+        with _open_for_writing(outfile) as out:
+            out.write(lines)
+    else:
+        out.write(lines)
+    if sidecar:
+        save_pose_npz(pose, f'{outfile}.npz')
+
+
+# the AlphaFold 'atom37' atom order (alphafold.common.residue_constants.atom_types)
+atom37_names = (
+    'N', 'CA', 'C', 'CB', 'O', 'CG', 'CG1', 'CG2', 'OG', 'OG1', 'SG', 'CD',
+    'CD1', 'CD2', 'ND1', 'ND2', 'OD1', 'OD2', 'SD', 'CE', 'CE1', 'CE2', 'CE3',
+    'NE', 'NE1', 'NE2', 'OE1', 'OE2', 'CH2', 'NH1', 'NH2', 'OH', 'CZ', 'CZ2',
+    'CZ3', 'NZ', 'OXT'
+)
+
+def pose_to_atom37(pose, round_to_pdb_precision=True):
+    ''' returns positions float32 (num_res,37,3), mask bool (num_res,37)
+
+    atoms that aren't in atom37_names (hydrogens, etc) are ignored, as in
+    predict_utils.fill_afold_coords
+
+    if round_to_pdb_precision, the coordinates are rounded to 2 decimal places, so
+    they match what we would get by writing and then reading a pdbfile
+    '''
+    pose = to_pose(pose)
+    nres = len(pose.resids)
+    names = np.char.strip(pose.atom_names)
+    atom_index = np.full(len(names), -1)
+    for i, name in enumerate(atom37_names):
+        atom_index[names == name] = i
+    keep = atom_index >= 0
+    xyz = pose.xyz[keep]
+    if round_to_pdb_precision:
+        xyz = np.round(xyz, 2)
+    positions = np.zeros((nres, len(atom37_names), 3), dtype=np.float32)
+    mask = np.zeros((nres, len(atom37_names)), dtype=bool)
+    positions[pose.atom_residue[keep], atom_index[keep]] = xyz
+    mask[pose.atom_residue[keep], atom_index[keep]] = True
+    return positions, mask
+
+
+def save_template_npz(pose, outfile, target_to_template_alignment=None):
+    ''' Save an AlphaFold template in atom37 format, which can be read by
+    run_prediction.py in place of the template pdbfile (see
+    predict_utils.load_template_atom37)
+
+    arrays:
+      all_positions        float32 (num_res,37,3)
+      all_positions_mask   bool    (num_res,37)
+      sequence             str     the full template sequence (no chainbreaks)
+      chainseq             str     with '/' between chains
+      alignment            int     (num_aligned,2) target, template positions
+                                   (0-indexed), if target_to_template_alignment
+    '''
+    pose = to_pose(pose)
+    positions, mask = pose_to_atom37(pose)
+    if target_to_template_alignment is None:
+        alignment = np.zeros((0,2), dtype=np.int64)
+    else:
+        alignment = np.array(sorted(target_to_template_alignment.items()),
+                             dtype=np.int64).reshape(-1,2)
+    with open(outfile, 'wb') as out: # so np.savez doesn't add .npz
+        np.savez_compressed(
+            out,
+            all_positions = positions,
+            all_positions_mask = mask,
+            sequence = np.array(pose.sequence),
+            chainseq = np.array(pose.chainseq),
+            alignment = alignment,
+        )
 
 
 def check_coords_shape(pose):
@@ -221,7 +628,7 @@ def check_coords_shape(pose):
                 assert False
 
 def update_derived_data(pose):
-    ''' pose is a python dict with keys
+    ''' pose is a python dict with keys (a Pose is returned unchanged)
 
     'resids' - list of (chain,resid) tuples where resid is the pdb resid: line[22:27]
     'coords' - dict indexed by (chain,resid) tuples mapping to dicts from atom-->xyz
@@ -243,6 +650,8 @@ def update_derived_data(pose):
 
     '''
     #check_coords_shape(pose)
+    if isinstance(pose, Pose): # derived data are always up to date
+        return pose
 
     CA = ' CA '
 
@@ -274,159 +683,143 @@ def update_derived_data(pose):
 def renumber(pose):
     ''' set resids from 0 ---> N-1
     set chains from A,B,C,...Z
-    '''
-
-    resids, coords = pose['resids'], pose['coords']
-
-    old_chains = pose['chains']
-    new_chains = [chr(ord('A')+i) for i in range(len(old_chains))]
-
-    old2new = dict(zip(old_chains, new_chains))
 
-    new_resids = []
-    new_coords = {}
-
-    for ii,r in enumerate(resids):
-        new_r = (old2new[r[0]], f'{ii:4d} ')
-        new_resids.append(new_r)
-        new_coords[new_r] = copy.deepcopy(coords[r])
-
-    pose['resids'] = new_resids
-    pose['coords'] = new_coords
-
-    return update_derived_data(pose)
+    returns a new Pose (with its own copy of the coords)
+    '''
+    pose = to_pose(pose)
+    return set_chainbounds_and_renumber(pose, pose.chainbounds)
 
 def set_chainbounds_and_renumber(pose, chainbounds):
     ''' set resids from 0 ---> N-1
     set chains from A,B,C,...Z
-    '''
 
-    assert chainbounds[0] == 0 and chainbounds[-1] == len(pose['sequence'])
+    returns a new Pose (with its own copy of the coords)
+    '''
+    pose = to_pose(pose)
 
-    resids, coords = pose['resids'], pose['coords']
+    assert chainbounds[0] == 0 and chainbounds[-1] == len(pose.sequence)
 
     num_chains = len(chainbounds)-1
     new_chains = [chr(ord('A')+i) for i in range(num_chains)]
 
     new_resids = []
-    new_coords = {}
-
     for c, chain in enumerate(new_chains):
         assert chainbounds[c] < chainbounds[c+1]
         for ind in range(chainbounds[c], chainbounds[c+1]):
-            new_r = (chain, f'{ind:4d} ')
-            r = resids[ind]
-            new_resids.append(new_r)
-            new_coords[new_r] = copy.deepcopy(coords[r])
-
-    assert len(new_resids) == len(resids) == len(new_coords.keys())
+            new_resids.append((chain, f'{ind:4d} '))
 
-    pose['resids'] = new_resids
-    pose['coords'] = new_coords
+    assert len(new_resids) == len(pose.resids)
 
-    return update_derived_data(pose)
+    return pose._replace(xyz=pose.xyz.copy(), resids=new_resids)
 
 
 def apply_transform_Rx_plus_v(pose, R, v):
+    ''' returns a new pose with transformed coords; pose itself is not modified
+    '''
     assert R.shape==(3,3) and v.shape==(3,)
-    resids, coords = pose['resids'], pose['coords']
-    for r in resids:
-        coords[r] = {a:R@xyz + v for a,xyz in coords[r].items()}
-
-    pose['coords'] = coords # probably not necessary
-
-    # update since coords changed
-    return update_derived_data(pose)
+    pose = to_pose(pose)
+    return pose._replace(xyz=pose.xyz @ R.T + v)
 
 def delete_chains(pose, chain_nums):
-    ''' doesn't necessarily copy all the old data
+    ''' returns a new pose; pose itself is not modified
     '''
-    del_chains = [pose['chains'][c] for c in chain_nums]
-
-    resids, coords, sequence = pose['resids'], pose['coords'], pose['sequence']
-
-    new_resids = []
-    new_sequence = []
-    for r,a in zip(resids, sequence):
-        if r[0] in del_chains:
-            del coords[r]
-        else:
-            new_resids.append(r)
-            new_sequence.append(a)
-
-    pose['resids'] = new_resids
-    pose['sequence'] = ''.join(new_sequence)
-    pose['coords'] = coords
-
-    return update_derived_data(pose)
+    pose = to_pose(pose)
+    keep = ~np.isin(pose.residue_chain, chain_nums)
+    return pose.select_residues(np.nonzero(keep)[0])
 
 def append_chains(pose, src_pose, src_chain_nums):
+    ''' returns a new pose; neither pose nor src_pose is modified
+    '''
     assert pose is not src_pose
+    pose, src_pose = to_pose(pose), to_pose(src_pose)
 
+    ord0 = ord(max(pose.chains))+1
 
-    resids, coords = pose['resids'], pose['coords']
-    src_resids, src_coords, src_sequence = (src_pose['resids'], src_pose['coords'],
-                                            src_pose['sequence'])
-
-    ord0 = ord(max(pose['chains']))+1
-
-    sequence = list(pose['sequence'])
+    parts = [pose]
     for ii, chain_num in enumerate(src_chain_nums):
-        old_chain = src_pose['chains'][chain_num]
         new_chain = chr(ord0+ii)
-        for r,a in zip(src_resids, src_sequence):
-            if r[0] == old_chain:
-                new_r = (new_chain, r[1])
-                resids.append(new_r)
-                sequence.append(a)
-                coords[new_r] = copy.deepcopy(src_coords[r])
-    pose['resids'] = resids
-    pose['coords'] = coords
-    pose['sequence'] = ''.join(sequence)
+        part = src_pose.select_residues(
+            np.nonzero(src_pose.residue_chain == chain_num)[0])
+        parts.append(part._replace(resids=[(new_chain, r[1]) for r in part.resids]))
+
+    return concatenate_poses(parts)
+
+def concatenate_poses(poses):
+    ''' returns a new Pose with all the residues of poses, in order; resids
+    shouldn't overlap
+    '''
+    poses = [to_pose(x) for x in poses]
+    offsets = np.cumsum([0]+[x.xyz.shape[0] for x in poses[:-1]])
+    return Pose(
+        np.concatenate([x.xyz for x in poses]),
+        np.concatenate([x.atom_names for x in poses]),
+        np.concatenate([[0]]+[x.res_atom_bounds[1:]+o
+                              for x,o in zip(poses, offsets)]),
+        [r for x in poses for r in x.resids],
+        ''.join(x.sequence for x in poses),
+    )
+
 
-    return update_derived_data(pose)
+def freeze(pose):
+    ''' make the coordinate arrays of pose read-only, so that poses can share
+    coords safely
+    '''
+    if isinstance(pose, Pose):
+        pose.xyz.flags.writeable = False
+        if pose._ca_coords is not None and len(pose.resids):
+            pose._ca_coords.flags.writeable = False
+        return pose
+    for r in pose['resids']:
+        for xyz in pose['coords'][r].values():
+            xyz.flags.writeable = False
+    if len(pose['resids']):
+        pose['ca_coords'].flags.writeable = False
+    return pose
 
 
 
 def delete_residue_range(pose, start, stop):
-    ''' returns a new pose (that might share some data)
+    ''' returns a new pose
 
     deletes start through stop, inclusive of start but NOT stop!!!!!!!!!!!!
 
     start and stop are 0-indexed
 
     '''
-
-    newpose = {
-        'coords': pose['coords'],
-        'sequence': pose['sequence'][:start] + pose['sequence'][stop:],
-        'resids': pose['resids'][:start] + pose['resids'][stop:],
-    }
-
-    return update_derived_data(newpose)
+    pose = to_pose(pose)
+    nres = len(pose.resids)
+    keep = np.ones(nres, dtype=bool)
+    keep[start:stop] = False
+    return pose.select_residues(np.nonzero(keep)[0])
 
 
 def find_chainbreaks(pose, maxdis = 1.75, verbose=False):
     ''' assumes atom names have the usual PDB extra whitespace in them
     '''
-    N, C  = ' N  ', ' C  '
+    pose = to_pose(pose)
+    resids = pose.resids
+    c_inds, n_inds = pose.atom_index(' C  '), pose.atom_index(' N  ')
+
+    # consecutive residues in the same chain
+    same_chain = pose.residue_chain[:-1] == pose.residue_chain[1:]
+    ok = same_chain & (c_inds[:-1] >= 0) & (n_inds[1:] >= 0)
+    dists = np.full(len(ok), np.nan)
+    dists[ok] = np.sqrt(np.sum(np.square(
+        pose.xyz[c_inds[:-1][ok]] - pose.xyz[n_inds[1:][ok]]), axis=1))
 
-    resids, coords = pose['resids'], pose['coords']
     chainbreaks = []
-    for i, r1 in enumerate(resids[:-1]):
-        r2 = resids[i+1]
-        if r1[0] == r2[0]:
-            if C in coords[r1] and N in coords[r2]:
-                dis = np.sqrt(np.sum(np.square(coords[r1][C]-coords[r2][N])))
-                if dis >= maxdis:
-                    chainbreaks.append(i)
-                    if verbose:
-                        print('found intra-chain chainbreak:', r1, r2,
-                              dis,'>',maxdis)
-            else:
-                if C not in coords[r1]:
-                    print('missing C atom', r1)
-                if N not in coords[r2]:
-                    print('missing N atom', r2)
+    for i in np.nonzero(same_chain)[0].tolist():
+        r1, r2 = resids[i], resids[i+1]
+        if ok[i]:
+            if dists[i] >= maxdis:
+                chainbreaks.append(i)
+                if verbose:
+                    print('found intra-chain chainbreak:', r1, r2,
+                          dists[i],'>',maxdis)
+        else:
+            if c_inds[i] < 0:
+                print('missing C atom', r1)
+            if n_inds[i+1] < 0:
+                print('missing N atom', r2)
 
     return chainbreaks
@@ -5,10 +5,9 @@ import sys
 from os.path import exists
 from .tcrdist.all_genes import all_genes
 from .tcrdist.amino_acids import amino_acids
-from Bio import pairwise2
-from Bio.SubsMat import MatrixInfo as matlist
-from Bio.pairwise2 import format_alignment
-from .util import path_to_db
+from Bio import Align
+from Bio.Align import substitution_matrices
+from .util import path_to_db, imap_in_workers
 from . import docking_geometry
 from .docking_geometry import DockingGeometry
 from .tcrdock_info import TCRdockInfo
@@ -16,10 +15,12 @@ from . import tcrdist
 from . import superimpose
 from . import tcr_util
 from . import pdblite
+from . import template_db
+from . import cache
 import pandas as pd
 import numpy as np
 import random
-import copy
+from functools import partial, lru_cache
 from numpy.linalg import norm
 
 CLASS2_PEPLEN = 1+9+1
@@ -27,13 +28,18 @@ TCR_CORE_LEN = 13
 ALL_GENES_GAP_CHAR = '.'
 
 
-# human only
-human_structure_alignments = pd.read_table(path_to_db/'new_human_vg_alignments_v1.tsv')
-human_structure_alignments.set_index('v_gene', drop=True, inplace=True)
+def _read_structure_alignments():
+    # human only
+    human_structure_alignments = pd.read_table(
+        path_to_db/'new_human_vg_alignments_v1.tsv')
+    human_structure_alignments.set_index('v_gene', drop=True, inplace=True)
 
-# human and mouse
-both_structure_alignments = pd.read_table(path_to_db/'new_both_vg_alignments_v1.tsv')
-both_structure_alignments.set_index(['organism','v_gene'], drop=True, inplace=True)
+    # human and mouse
+    both_structure_alignments = pd.read_table(
+        path_to_db/'new_both_vg_alignments_v1.tsv')
+    both_structure_alignments.set_index(['organism','v_gene'], drop=True,
+                                        inplace=True)
+    return human_structure_alignments, both_structure_alignments
 
 def read_fasta(filename): # helper
     ''' return OrderedDict indexed by the ">" lines (everything after >)
@@ -54,38 +60,40 @@ def read_fasta(filename): # helper
 
 
 
-mhc_class_1_alfas = read_fasta(path_to_db / 'ClassI_prot.alfas')
-# add HLA-G 2022-04-30
-mhc_class_1_alfas.update(read_fasta(path_to_db / 'new_imgt_hla/G_prot.alfas'))
-# add HLA-E 2022-05-03
-mhc_class_1_alfas.update(read_fasta(path_to_db / 'new_imgt_hla/E_prot.alfas'))
+def _read_mhc_alfas():
+    mhc_class_1_alfas = read_fasta(path_to_db / 'ClassI_prot.alfas')
+    # add HLA-G 2022-04-30
+    mhc_class_1_alfas.update(read_fasta(path_to_db / 'new_imgt_hla/G_prot.alfas'))
+    # add HLA-E 2022-05-03
+    mhc_class_1_alfas.update(read_fasta(path_to_db / 'new_imgt_hla/E_prot.alfas'))
 
-ks = list(mhc_class_1_alfas.keys())
-lencheck = None
-for k in ks:
-    newseq = mhc_class_1_alfas[k].replace('-', ALL_GENES_GAP_CHAR)\
-             .replace('X',ALL_GENES_GAP_CHAR)
-    mhc_class_1_alfas[k] = newseq
-    if lencheck is None:
-        lencheck = len(newseq)
-    else:
-        assert lencheck == len(newseq)
+    ks = list(mhc_class_1_alfas.keys())
+    lencheck = None
+    for k in ks:
+        newseq = mhc_class_1_alfas[k].replace('-', ALL_GENES_GAP_CHAR)\
+                 .replace('X',ALL_GENES_GAP_CHAR)
+        mhc_class_1_alfas[k] = newseq
+        if lencheck is None:
+            lencheck = len(newseq)
+        else:
+            assert lencheck == len(newseq)
 
-# read mouse sequences (no gaps in them)
-# these mouse seqs are not the same length
-mhc_class_1_alfas.update(read_fasta(path_to_db / 'mouse_class1_align.fasta'))
+    # read mouse sequences (no gaps in them)
+    # these mouse seqs are not the same length
+    mhc_class_1_alfas.update(read_fasta(path_to_db / 'mouse_class1_align.fasta'))
 
-# v2 means new imgt hla class 2 human alignments/sequences:
-mhc_class_2_alfas = {
-    'A': read_fasta(path_to_db / 'both_class_2_A_chains_v2.alfas'),
-    'B': read_fasta(path_to_db / 'both_class_2_B_chains_v2.alfas'),
-}
+    # v2 means new imgt hla class 2 human alignments/sequences:
+    mhc_class_2_alfas = {
+        'A': read_fasta(path_to_db / 'both_class_2_A_chains_v2.alfas'),
+        'B': read_fasta(path_to_db / 'both_class_2_B_chains_v2.alfas'),
+    }
 
-assert all(all(all(x in amino_acids or x==ALL_GENES_GAP_CHAR
-                   for x in seq)
-               for seq in alfas.values())
-           for alfas in [mhc_class_1_alfas, mhc_class_2_alfas['A'],
-                         mhc_class_2_alfas['B']])
+    assert all(all(all(x in amino_acids or x==ALL_GENES_GAP_CHAR
+                       for x in seq)
+                   for seq in alfas.values())
+               for alfas in [mhc_class_1_alfas, mhc_class_2_alfas['A'],
+                             mhc_class_2_alfas['B']])
+    return mhc_class_1_alfas, mhc_class_2_alfas
 
 # the code below is now redundant since we moved the info files and had applied these
 # changes already
@@ -130,19 +138,108 @@ assert all(all(all(x in amino_acids or x==ALL_GENES_GAP_CHAR
 
 TCR, PMHC, TERNARY = 'tcr', 'pmhc', 'ternary'
 
-all_template_info = {}
-for tag in [TCR, PMHC, TERNARY]:
-    info = pd.read_table(path_to_db / f'{tag}_templates_v2.tsv')
-    if tag == TCR:
-        info.set_index(['pdbid','ab'], drop=False, inplace=True)
-    else:
-        info.set_index('pdbid', drop=False, inplace=True)
-    all_template_info[tag] = info
+def _read_template_info():
+    all_template_info = {}
+    for tag in [TCR, PMHC, TERNARY]:
+        info = pd.read_table(path_to_db / f'{tag}_templates_v2.tsv')
+        if tag == TCR:
+            info.set_index(['pdbid','ab'], drop=False, inplace=True)
+        else:
+            info.set_index('pdbid', drop=False, inplace=True)
+        all_template_info[tag] = info
+    return all_template_info
+
+# The tables above are parsed (and checked) once, then loaded from a pickled index
+# in the disk cache (see cache.py), which is much faster than re-parsing at every
+# import. The index is rebuilt if any of the db files change; bump DB_INDEX_VERSION
+# if the parsing code changes.
+DB_INDEX_VERSION = 1
+
+def _load_db_index():
+    dbfiles = (
+        ['new_human_vg_alignments_v1.tsv', 'new_both_vg_alignments_v1.tsv',
+         'ClassI_prot.alfas', 'new_imgt_hla/G_prot.alfas', 'new_imgt_hla/E_prot.alfas',
+         'mouse_class1_align.fasta', 'both_class_2_A_chains_v2.alfas',
+         'both_class_2_B_chains_v2.alfas'] +
+        [f'{tag}_templates_v2.tsv' for tag in [TCR, PMHC, TERNARY]])
+    key = cache.make_key('db_index', DB_INDEX_VERSION, pd.__version__,
+                         cache.db_fingerprint(*[path_to_db/x for x in dbfiles]))
+    index = cache.load_cached('db_index', key)
+    if index is None:
+        index = {}
+        (index['human_structure_alignments'],
+         index['both_structure_alignments']) = _read_structure_alignments()
+        index['mhc_class_1_alfas'], index['mhc_class_2_alfas'] = _read_mhc_alfas()
+        index['all_template_info'] = _read_template_info()
+        cache.save_cached('db_index', key, index)
+    return index
+
+_db_index = _load_db_index()
+human_structure_alignments = _db_index['human_structure_alignments']
+both_structure_alignments = _db_index['both_structure_alignments']
+mhc_class_1_alfas = _db_index['mhc_class_1_alfas']
+mhc_class_2_alfas = _db_index['mhc_class_2_alfas']
+all_template_info = _db_index['all_template_info']
 tcr_info = all_template_info[TCR]
 pmhc_info = all_template_info[PMHC]
 ternary_info = all_template_info[TERNARY]
 
-all_template_poses = {TCR:{}, PMHC:{}, TERNARY:{}}
+def encode_seqs_uint8(seqs):
+    ''' returns uint8 array of shape (len(seqs), maxlen) with the ascii codes,
+    padded at the end with 0s
+    '''
+    seqs = np.array([x.encode() for x in seqs], dtype=bytes)
+    return seqs.view(np.uint8).reshape(len(seqs), -1)
+
+def count_identities_uint8(trg_seq, tmp_seqs):
+    ''' number of positions where trg_seq matches each row of tmp_seqs, which
+    comes from encode_seqs_uint8; gap and '/' positions in trg_seq are ignored
+    '''
+    trg = np.frombuffer(trg_seq.encode(), dtype=np.uint8)
+    mask = (trg != ord(ALL_GENES_GAP_CHAR)) & (trg != ord('/'))
+    return ((tmp_seqs[:,:len(trg)] == trg) & mask).sum(axis=1)
+
+# pre-encoded template sequences for fast identity scoring in
+# _compute_pmhc_alignments; rows match the rows of pmhc_info and ternary_info
+pmhc_info_uint8 = {
+    'mhc_alignseq': encode_seqs_uint8(pmhc_info.mhc_alignseq),
+    'pep_seq': encode_seqs_uint8(pmhc_info.pep_seq),
+    'pep_ends': encode_seqs_uint8(x[:3]+x[-3:] for x in pmhc_info.pep_seq),
+}
+ternary_info_uint8 = { # for class 2; the mhc_alignseqs look like A/B
+    'mhc_alignseq_pep_seq': encode_seqs_uint8(ternary_info.mhc_alignseq.fillna('') +
+                                              ternary_info.pep_seq.fillna('')),
+}
+
+# parsed template poses and tdinfos, indexed by (complex_type, pdbid). This is an
+# LRU cache with a memory bound (TCRDOCK_TEMPLATE_CACHE_MB environment variable or
+# set_template_pose_cache_size) so a long setup run doesn't grow without limit;
+# all of the templates together come to roughly 300 MB
+TEMPLATE_POSE_CACHE_MB = float(os.environ.get('TCRDOCK_TEMPLATE_CACHE_MB', 1024))
+
+def _template_pose_nbytes(pose_and_tdinfo):
+    return pose_and_tdinfo[0].nbytes + 2000 # ~2K for the tdinfo
+
+template_pose_cache = cache.LRUCache(
+    int(TEMPLATE_POSE_CACHE_MB*2**20), _template_pose_nbytes)
+
+def set_template_pose_cache_size(max_mb):
+    ''' max_mb=None means no bound
+    '''
+    template_pose_cache.set_max_bytes(None if max_mb is None else int(max_mb*2**20))
+
+def get_template_pose_cache_stats():
+    ''' hits, misses, evictions, sizes (bytes), etc; see cache.LRUCache.stats
+    '''
+    return template_pose_cache.stats()
+
+def print_template_pose_cache_stats():
+    stats = get_template_pose_cache_stats()
+    print(f'template_pose_cache: pid= {os.getpid()} entries= {stats["entries"]} '
+          f'MB= {stats["nbytes"]/2**20:.1f} max_MB_seen= '
+          f'{stats["max_nbytes_seen"]/2**20:.1f} hits= {stats["hits"]} misses= '
+          f'{stats["misses"]} evictions= {stats["evictions"]} hit_rate= '
+          f'{stats["hit_rate"]:.3f}', flush=True)
 
 BAD_DGEOM_PDBIDS = '5sws 7jwi 4jry 4nhu 3tjh 4y19 4y1a 1ymm 2wbj 6uz1'.split()
 BAD_PMHC_PDBIDS = '3rgv 4ms8 6v1a 6v19 6v18 6v15 6v13 6v0y 2uwe 2jcc 2j8u 1lp9'.split()
@@ -179,6 +276,48 @@ def get_tcrdister(organism):
     return _cached_tcrdisters[organism]
 
 
+_blosum_aligners = {}
+def get_blosum_aligner(gap_open, gap_extend, global_align):
+    ''' returns a Bio.Align.PairwiseAligner with BLOSUM62 scoring
+    '''
+    key = (gap_open, gap_extend, global_align)
+    if key not in _blosum_aligners:
+        aligner = Align.PairwiseAligner()
+        aligner.substitution_matrix = substitution_matrices.load('BLOSUM62')
+        # a gap of length N scores gap_open + (N-1)*gap_extend, like pairwise2
+        aligner.open_gap_score = gap_open
+        aligner.extend_gap_score = gap_extend
+        aligner.mode = 'global' if global_align else 'local'
+        _blosum_aligners[key] = aligner
+    return _blosum_aligners[key]
+
+@lru_cache(maxsize=100000)
+def _blosum_align_cached(seq1, seq2, gap_open, gap_extend, global_align):
+    ''' returns the alignment (for verbose printing) and a tuple of
+    (pos1,pos2) pairs
+    '''
+    aligner = get_blosum_aligner(gap_open, gap_extend, global_align)
+    # just the first optimal alignment; don't enumerate them all
+    alignment = next(iter(aligner.align(seq1, seq2)))
+    blocks = list(zip(*alignment.aligned))
+    pairs = []
+    for (start1, stop1), (start2, stop2) in blocks:
+        assert stop1-start1 == stop2-start2
+        pairs.extend(zip(range(start1, stop1), range(start2, stop2)))
+    if not global_align and blocks:
+        # pairwise2 local alignments included the unaligned ends of the sequences,
+        # lined up against the aligned region (prefixes right-justified, suffixes
+        # left-justified), and we used to include those pairs in the mapping.
+        # Keep doing that, so the mappings don't change.
+        (start1, _), (start2, _) = blocks[0]
+        n = min(start1, start2)
+        prefix = list(zip(range(start1-n, start1), range(start2-n, start2)))
+        (_, stop1), (_, stop2) = blocks[-1]
+        n = min(len(seq1)-stop1, len(seq2)-stop2)
+        suffix = list(zip(range(stop1, stop1+n), range(stop2, stop2+n)))
+        pairs = prefix + pairs + suffix
+    return alignment, tuple(pairs)
+
 def blosum_align(
         seq1,
         seq2,
@@ -188,38 +327,17 @@ def blosum_align(
         verbose=False,
 ):
     ''' return 0-indexed dictionary mapping from seq1 to seq2 positions
-    '''
-
-    scorematrix = matlist.blosum62
 
-    if global_align:
-        alignments = pairwise2.align.globalds(
-            seq1, seq2, scorematrix, gap_open, gap_extend)
-    else:
-        alignments = pairwise2.align.localds(
-            seq1, seq2, scorematrix, gap_open, gap_extend)
-    # this is annoying, BioPython 1.76 these are vanilla tuples and 1.79 they are named
-    try:
-        alignment = max(alignments, key=lambda x:x.score)
-    except AttributeError:
-        assert len(alignments[0]) == 5 # seqA, seqB, score, start, end
-        alignment = max(alignments, key=lambda x:x[2])
-    alseq1, alseq2, score, begin, end = alignment
+    uses Bio.Align.PairwiseAligner (single best alignment, no traceback
+    enumeration), results are cached by sequence pair
+    '''
+    alignment, pairs = _blosum_align_cached(
+        seq1, seq2, gap_open, gap_extend, global_align)
 
     if verbose:
-        print(format_alignment(*alignment))
-
-    assert alseq1.replace('-','') == seq1
-    assert alseq2.replace('-','') == seq2
-
-    align = {}
-    for i,(a,b) in enumerate(zip(alseq1, alseq2)):
-        if a!= '-' and b!='-':
-            #assert begin <= i <= end
-            pos1 = i-alseq1[:i].count('-')
-            pos2 = i-alseq2[:i].count('-')
-            align[pos1] = pos2
-    return align
+        print(alignment)
+
+    return dict(pairs)
 
 
 # for building pmhc:TCR models from allele/v/j/cdr3 info
@@ -331,11 +449,8 @@ def align_chainseq_to_structure_msa(organism, chainseq, v_gene, msa_type='both')
     return chainseq_to_alseq
 
 _tcr_alignment_cache = None
-def align_tcr_info_pdb_chain_to_structure_msa(pdbid, ab, msa_type_in):
-    ''' pdbid,ab has to be in the tcr_info index
-    '''
+def _init_tcr_alignment_cache():
     global _tcr_alignment_cache
-    assert msa_type_in in ['both','human']
     if _tcr_alignment_cache is None:
         _tcr_alignment_cache = {
             'both' :{'A':{}, 'B':{}},
@@ -365,6 +480,12 @@ def align_tcr_info_pdb_chain_to_structure_msa(pdbid, ab, msa_type_in):
 
         print('DONE setting up cache for align_tcr_info_pdb_chain_to_structure_msa',
               'function')
+
+def align_tcr_info_pdb_chain_to_structure_msa(pdbid, ab, msa_type_in):
+    ''' pdbid,ab has to be in the tcr_info index
+    '''
+    assert msa_type_in in ['both','human']
+    _init_tcr_alignment_cache()
     return _tcr_alignment_cache[msa_type_in][ab][pdbid]
 
 
@@ -651,8 +772,9 @@ def get_template_pose_and_tdinfo(pdbid, complex_type):
     ''' returns pose, tdinfo
     complex_type should be in {TCR, TERNARY, PMHC}
     '''
-    info, poses = all_template_info[complex_type], all_template_poses[complex_type]
-    if pdbid not in poses:
+    info = all_template_info[complex_type]
+    pose_and_tdinfo = template_pose_cache.get((complex_type, pdbid))
+    if pose_and_tdinfo is None:
         pdbfile = set(info[info.pdbid==pdbid].pdbfile)
         if not pdbfile:
             # right now we only have class 1 in the special pmhc info...
@@ -660,16 +782,24 @@ def get_template_pose_and_tdinfo(pdbid, complex_type):
             info = all_template_info[TERNARY] # NOTE NOTE NOTE
             pdbfile = set(info[info.pdbid==pdbid].pdbfile)
         assert len(pdbfile) == 1
-        pdbfile = str(path_to_db) + '/' + pdbfile.pop()
-        #print('read:', pdbfile)
-        pose = pdblite.pose_from_pdb(pdbfile)
-        tdifile = pdbfile+'.tcrdock_info.json'
-        tdinfo = TCRdockInfo().from_string(open(tdifile,'r').read())
+        pdbfile = pdbfile.pop()
+        tdb = template_db.get_template_db()
+        if tdb is not None and pdbfile in tdb:
+            pose, tdinfo = tdb.load_pose_and_tdinfo(pdbfile)
+        else:
+            pdbfile = str(path_to_db) + '/' + pdbfile
+            #print('read:', pdbfile)
+            pose = pdblite.pose_from_pdb(pdbfile)
+            tdifile = pdbfile+'.tcrdock_info.json'
+            tdinfo = TCRdockInfo().from_string(open(tdifile,'r').read())
         #print('make tdinfo 0-indexed:', tdifile)
         #tdinfo.renumber({i+1:i for i in range(len(pose['sequence']))})
-        poses[pdbid] = (pose, tdinfo)
-    pose, tdinfo = poses[pdbid]
-    return copy.deepcopy(pose), TCRdockInfo().from_dict(tdinfo.to_dict())# return copies
+        pose_and_tdinfo = (pdblite.freeze(pose), tdinfo)
+        template_pose_cache.put((complex_type, pdbid), pose_and_tdinfo)
+    pose, tdinfo = pose_and_tdinfo
+    # the cached Pose is read-only and the pdblite transforms return new poses,
+    # so it can be shared (no copy of all the coords)
+    return pose, TCRdockInfo().from_dict(tdinfo.to_dict())
 
 def count_peptide_mismatches(a,b):
     if len(a)>len(b):
@@ -691,12 +821,85 @@ def count_peptide_mismatches(a,b):
         min_mismatches = mismatches
     return min_mismatches
 
+def _count_peptide_mismatches_uint8(short_seqs, long_seqs):
+    ''' short_seqs is (N,len1), long_seqs is (M,len2), with len1 <= len2
+
+    returns (N,M) min mismatches over the shifts and the middle bulge, as in
+    count_peptide_mismatches
+    '''
+    len1, len2 = short_seqs.shape[1], long_seqs.shape[1]
+    nt = len1//2
+    ct = len1 - nt
+    all_columns = [np.arange(shift, shift+len1) for shift in range(len2-len1+1)]
+    all_columns.append(np.r_[np.arange(nt), np.arange(len2-ct, len2)]) # bulge
+    short_seqs = short_seqs[:,None,:]
+    return np.min([(short_seqs != long_seqs[None,:,columns]).sum(axis=2)
+                   for columns in all_columns], axis=0)
+
+def count_peptide_mismatches_matrix(peptides1, peptides2):
+    ''' Batched count_peptide_mismatches: returns (len(peptides1), len(peptides2))
+    int array M with M[i,j] == count_peptide_mismatches(peptides1[i], peptides2[j])
+
+    The peptides are encoded with encode_seqs_uint8 and compared one pair of
+    peptide lengths at a time
+    '''
+    peptides1, peptides2 = list(peptides1), list(peptides2)
+    mismatches = np.zeros((len(peptides1), len(peptides2)), dtype=int)
+    if not peptides1 or not peptides2:
+        return mismatches
+    seqs1, seqs2 = encode_seqs_uint8(peptides1), encode_seqs_uint8(peptides2)
+    lens1 = np.array([len(x) for x in peptides1])
+    lens2 = np.array([len(x) for x in peptides2])
+    for len1 in np.unique(lens1):
+        rows1 = np.nonzero(lens1 == len1)[0]
+        for len2 in np.unique(lens2):
+            rows2 = np.nonzero(lens2 == len2)[0]
+            if len1 <= len2:
+                mismatches[np.ix_(rows1, rows2)] = _count_peptide_mismatches_uint8(
+                    seqs1[rows1,:len1], seqs2[rows2,:len2])
+            else:
+                mismatches[np.ix_(rows1, rows2)] = _count_peptide_mismatches_uint8(
+                    seqs2[rows2,:len2], seqs1[rows1,:len1]).T
+    return mismatches
+
 pep1 = 'DSIODJSJD' # sanity checking...
 pep2 = 'DSIXDJSJD'
 assert count_peptide_mismatches(pep1,pep1)==0
 assert count_peptide_mismatches(pep1,pep1[:-1])==0
 assert count_peptide_mismatches(pep1,pep2)==1
+assert count_peptide_mismatches_matrix([pep1, pep1[:-1]], [pep2, pep1]).tolist() == [
+    [1, 0], [1, 0]]
 
+_ternary_pdb_quality = None
+def get_ternary_pdb_quality():
+    ''' dataframe indexed by pdbid with resolution and (V-gene) mismatches columns,
+    parsed from the pdb_tcr logfiles once and then cached
+    '''
+    global _ternary_pdb_quality
+    if _ternary_pdb_quality is None:
+        pdbid2resolution = {}
+        pdbid2mismatches = {}
+        for organism in 'human mouse'.split():
+            # temporary hack...
+            logfile = path_to_db / f'tmp.pdb_tcr_{organism}.2023-06-02.log'
+            # logfile = path_to_db / f'tmp.pdb_tcr_{organism}.2021-08-05.log'
+            assert exists(logfile)
+            with open(logfile, 'r') as data:
+                for line in data:
+                    if not line.startswith('both'):
+                        continue
+                    l = line.split()
+                    pdbid = l[1]
+                    resolution = float(l[-2])
+                    v_mismatches = int(l[3]) + int(l[7])
+                    pdbid2resolution[pdbid] = resolution
+                    pdbid2mismatches[pdbid] = min(v_mismatches,
+                                                  pdbid2mismatches.get(pdbid,100))
+        _ternary_pdb_quality = pd.DataFrame({'resolution':pdbid2resolution,
+                                             'mismatches':pdbid2mismatches})
+    return _ternary_pdb_quality
+
+_clean_ternary_tcrs_cache = {}
 def get_clean_and_nonredundant_ternary_tcrs_df(
         min_peptide_mismatches = 3,
         min_tcrdist = 120.5,
@@ -715,10 +918,16 @@ def get_clean_and_nonredundant_ternary_tcrs_df(
     '''
     assert peptide_tcrdist_logical in ['or','and']
 
+    # results for the default ternary_info are cached; callers get a copy
+    cache_key = None
     if tcrs is None:
-        tcrs = ternary_info.copy()
-    else:
-        tcrs = tcrs.copy()
+        if not verbose:
+            cache_key = (min_peptide_mismatches, min_tcrdist,
+                         peptide_tcrdist_logical, drop_HLA_E, skip_redundancy_check,
+                         filter_BAD_DGEOM_PDBIDS, filter_BAD_PMHC_PDBIDS)
+            if cache_key in _clean_ternary_tcrs_cache:
+                return _clean_ternary_tcrs_cache[cache_key].copy()
+        tcrs = ternary_info
 
     bad_pdbids = set()
     if filter_BAD_DGEOM_PDBIDS:
@@ -732,24 +941,12 @@ def get_clean_and_nonredundant_ternary_tcrs_df(
     if drop_HLA_E: # drop HLA-E
         tcrs = tcrs[~tcrs.mhc_allele.str.startswith('E*')]
 
+    tcrs = tcrs.copy()
+
     # need to add resolution
-    pdbid2resolution = {}
-    pdbid2mismatches = {}
-    for organism in 'human mouse'.split():
-        # temporary hack...
-        logfile = path_to_db / f'tmp.pdb_tcr_{organism}.2023-06-02.log'
-        # logfile = path_to_db / f'tmp.pdb_tcr_{organism}.2021-08-05.log'
-        assert exists(logfile)
-        for line in os.popen(f'grep ^both {logfile}'):
-            l = line.split()
-            pdbid = l[1]
-            resolution = float(l[-2])
-            v_mismatches = int(l[3]) + int(l[7])
-            pdbid2resolution[pdbid] = resolution
-            pdbid2mismatches[pdbid] = min(v_mismatches, pdbid2mismatches.get(pdbid,100))
-
-    tcrs['resolution'] = tcrs.pdbid.map(pdbid2resolution)
-    tcrs['mismatches'] = tcrs.pdbid.map(pdbid2mismatches)
+    pdb_quality = get_ternary_pdb_quality()
+    tcrs['resolution'] = tcrs.pdbid.map(pdb_quality.resolution)
+    tcrs['mismatches'] = tcrs.pdbid.map(pdb_quality.mismatches)
     assert tcrs.resolution.isna().sum()==0
 
     ## remove redundancy
@@ -764,44 +961,63 @@ def get_clean_and_nonredundant_ternary_tcrs_df(
     tcrs.sort_values('neg_quality', inplace=True)
 
     if not skip_redundancy_check:
-        tdist = {'human': tcrdist.tcr_distances.TcrDistCalculator('human'),
-                 'mouse': tcrdist.tcr_distances.TcrDistCalculator('mouse')}
-
         tcr_tuples = [((l.va, l.ja, l.cdr3a), (l.vb, l.jb, l.cdr3b))
                       for l in tcrs.itertuples()]
 
-        is_redundant = [False]*tcrs.shape[0]
+        # only tcrs with the same organism and mhc_class can be redundant
+        tcrds = np.full((tcrs.shape[0], tcrs.shape[0]), np.inf)
+        for organism in ['human','mouse']:
+            inds = np.nonzero((tcrs.organism==organism).values)[0]
+            org_tuples = [tcr_tuples[i] for i in inds]
+            tcrds[np.ix_(inds,inds)] = get_tcrdister(organism).distance_matrix(
+                org_tuples, org_tuples)
+        same_class = (tcrs.mhc_class.values[:,None] == tcrs.mhc_class.values[None,:])
+        tcrds[~same_class] = np.inf
+
+        pep_red = count_peptide_mismatches_matrix(
+            tcrs.pep_seq, tcrs.pep_seq) < min_peptide_mismatches
+        tcr_red = tcrds < min_tcrdist
+        if peptide_tcrdist_logical == 'or':
+            pair_red = (pep_red | tcr_red) & np.isfinite(tcrds)
+        else:
+            pair_red = pep_red & tcr_red
+
+        is_redundant = np.zeros((tcrs.shape[0],), dtype=bool)
 
         for i, irow in enumerate(tcrs.itertuples()):
-            # check to see if i is too close to any previous tcr
-            for j in range(i):
-                jrow = tcrs.iloc[j]
-                if is_redundant[j]:
-                    continue
-
-                pep_mms = count_peptide_mismatches(irow.pep_seq, jrow.pep_seq)
-                if (irow.organism == jrow.organism and
-                    irow.mhc_class == jrow.mhc_class):
-                    tcrd = tdist[irow.organism](tcr_tuples[i], tcr_tuples[j])
-                    pep_red = (pep_mms < min_peptide_mismatches)
-                    tcr_red = (tcrd < min_tcrdist)
-                    if ((peptide_tcrdist_logical=='or' and
-                         (pep_red or tcr_red)) or
-                        (peptide_tcrdist_logical=='and' and
-                         (pep_red and tcr_red))):
-
-                        # redundant
-                        is_redundant[i] = True
-                        if verbose:
-                            print('skip:', i, irow.org_pep, irow.neg_quality,
-                                  tcr_tuples[i])
-                        break
+            # check to see if i is too close to any previous non-redundant tcr
+            if np.any(pair_red[i,:i] & ~is_redundant[:i]):
+                is_redundant[i] = True
+                if verbose:
+                    print('skip:', i, irow.org_pep, irow.neg_quality,
+                          tcr_tuples[i])
 
         tcrs['is_redundant'] = is_redundant
 
         tcrs = tcrs[~tcrs.is_redundant].copy()
+
+    if cache_key is not None:
+        _clean_ternary_tcrs_cache[cache_key] = tcrs.copy()
     return tcrs
 
+def get_template_tcrs(templates):
+    ''' paired tcr tuples for the TcrDistCalculator('human_and_mouse')
+    '''
+    return [((l.organism[0]+l.va, None, l.cdr3a), (l.organism[0]+l.vb, None, l.cdr3b))
+            for l in templates.itertuples()]
+
+_ternary_tcrdist_matrix = None
+def get_ternary_tcrdist_matrix():
+    ''' paired TCRdist matrix for the ternary templates; rows and columns are in
+    the same order as the rows of ternary_info. Computed once, then cached
+    '''
+    global _ternary_tcrdist_matrix
+    if _ternary_tcrdist_matrix is None:
+        tcrs = get_template_tcrs(ternary_info)
+        _ternary_tcrdist_matrix = get_tcrdister('human_and_mouse').distance_matrix(
+            tcrs, tcrs)
+    return _ternary_tcrdist_matrix
+
 def filter_templates_by_tcrdist(
         templates, # dataframe
         organism, va, cdr3a, vb, cdr3b,
@@ -815,21 +1031,15 @@ def filter_templates_by_tcrdist(
     '''
     tcrdister = get_tcrdister('human_and_mouse')
 
-    template_tcrs = [
-        ((l.organism[0]+l.va, None, l.cdr3a), (l.organism[0]+l.vb, None, l.cdr3b))
-        for l in templates.itertuples()]
+    template_tcrs = get_template_tcrs(templates)
 
     target_tcr = ((organism[0]+va, None, cdr3a), (organism[0]+vb, None, cdr3b))
 
-    templates['paired_tcrdist'] = np.array(
-        [tcrdister(target_tcr,x) for x in template_tcrs])
-
-    for iab, ab in enumerate('AB'):
-        templates[ab+'_tcrdist'] = np.array(
-            [tcrdister.single_chain_distance(target_tcr[iab], x[iab])
-             for x in template_tcrs])
+    for ab in ['AB','A','B']:
+        templates[ab+'_tcrdist'] = tcrdister.distance_matrix(
+            [target_tcr], template_tcrs, chains=ab)[0]
 
-    templates['AB_tcrdist'] = templates.paired_tcrdist
+    templates['paired_tcrdist'] = templates.AB_tcrdist
 
     templates['singlechain_tcrdist'] = np.minimum(
         templates.A_tcrdist, templates.B_tcrdist)
@@ -854,9 +1064,8 @@ def filter_templates_by_peptide_mismatches(
     if not peptides_for_filtering:
         return templates.copy()
 
-    templates['filt_peptide_mismatches'] = np.array(
-        [min(count_peptide_mismatches(p, l.pep_seq) for p in peptides_for_filtering)
-             for l in templates.itertuples()])
+    templates['filt_peptide_mismatches'] = count_peptide_mismatches_matrix(
+        peptides_for_filtering, templates.pep_seq).min(axis=0)
     too_close_mask = ((templates.organism==organism) &
                       (templates.mhc_class==mhc_class) &
                       (templates.filt_peptide_mismatches<min_peptide_mismatches))
@@ -906,8 +1115,6 @@ def pick_dgeom_templates(
           min_singlechain_tcrdist, min_template_template_paired_tcrdist,
           peptides_for_filtering)
 
-    tcrdister = get_tcrdister('human_and_mouse')
-
     # sorts by pep-count, resolution, mismatches
     # excludes BAD_DGEOM_PDBIDS but not BAD_PMHC_PDBIDS
     templates = get_clean_and_nonredundant_ternary_tcrs_df(
@@ -928,47 +1135,38 @@ def pick_dgeom_templates(
     )
 
     # currently unused...
-    templates['peptide_mismatches'] = np.array(
-        [count_peptide_mismatches(peptide, l.pep_seq)
-         for l in templates.itertuples()])
-
-    def calc_chain_tcrdist(row1, row2, chain, tcrdister=tcrdister):
-        tcr1 = ((row1.organism[0]+row1.va, None, row1.cdr3a),
-                (row1.organism[0]+row1.vb, None, row1.cdr3b))
-        tcr2 = ((row2.organism[0]+row2.va, None, row2.cdr3a),
-                (row2.organism[0]+row2.vb, None, row2.cdr3b))
-        if chain == 'AB':
-            return tcrdister(tcr1, tcr2)
-        else:
-            assert chain in ['A','B']
-            ich = 'AB'.index(chain)
-            return tcrdister.single_chain_distance(tcr1[ich], tcr2[ich])
+    templates['peptide_mismatches'] = count_peptide_mismatches_matrix(
+        [peptide], templates.pep_seq)[0]
 
+    # template-template paired tcrdists, for redundancy filtering
+    template_tcrdists = get_ternary_tcrdist_matrix()
 
     all_templates = {}
     for chain in ['A','B','AB']:
         # sort by
         templates.sort_values(chain+'_tcrdist', inplace=True)
 
-        dfl = []
-        for _, row1 in templates.iterrows():
+        # rows of template_tcrdists
+        inds = ternary_info.index.get_indexer(templates.index)
+        assert np.all(inds>=0)
+
+        picks = [] # row numbers in templates
+        for i, ind in enumerate(inds):
             # check for redundancy
-            redundant = False
-            for row2 in dfl:
-                if (calc_chain_tcrdist(row1, row2, 'AB') <
-                    min_template_template_paired_tcrdist):
-                    redundant = True
-                    print('redundant template:', chain, row1.pdbid, row2.pdbid)
-                    break
-            if redundant:
+            redundant = (template_tcrdists[ind, inds[picks]] <
+                         min_template_template_paired_tcrdist)
+            if redundant.any():
+                print('redundant template:', chain, templates.pdbid.iloc[i],
+                      templates.pdbid.iloc[picks[np.argmax(redundant)]])
                 continue
-            dfl.append(row1.copy())
-            print('new_dgeom_template:', chain, len(dfl), row1[chain+'_tcrdist'],
+            picks.append(i)
+            row1 = templates.iloc[i]
+            print('new_dgeom_template:', chain, len(picks), row1[chain+'_tcrdist'],
                   row1.organism, row1.mhc_class, row1.mhc_allele, row1.pep_seq,
                   row1.va, row1.cdr3a, row1.vb, row1.cdr3b)
-            if len(dfl)>=num_templates:
+            if len(picks)>=num_templates:
                 break
-        all_templates[chain] = pd.DataFrame(dfl)
+        all_templates[chain] = templates.iloc[picks].copy()
 
     return all_templates
 
@@ -1066,83 +1264,77 @@ def align_vgene_to_structure_msas(organism, v_gene):
     return msa_alignments
 
 
-def make_templates_for_alphafold(
+_pmhc_alignments_cache = {}
+def get_pmhc_alignments(
         organism,
-        va,
-        ja,
-        cdr3a,
-        vb,
-        jb,
-        cdr3b,
         mhc_class,
-        mhc_allele,
+        mhc_allele, # for class 1 human, already trimmed to 4 digits
         peptide,
-        outfile_prefix,
-        num_runs=5, # match default in setup_for_alphafold
-        num_templates_per_run=4,
-        exclude_self_peptide_docking_geometries=False,
-        exclude_docking_geometry_peptides=None, # None or list of peptides
-        # below is only applied if exclude_docking_geometry_peptides is nonempty
-        #   or exclude_self_peptide_docking_geometries
-        min_dgeom_peptide_mismatches=3, # not used if exclude_* are False/None
-        min_dgeom_paired_tcrdist=-1,
-        min_dgeom_singlechain_tcrdist=-1,
-        min_single_chain_tcrdist=-1,
-        min_pmhc_peptide_mismatches=-1,
-        next_best_identity_threshold_mhc=0.98,
-        next_best_identity_threshold_tcr=0.98,
-        ternary_bonus=0.05, # for tcr templates, in frac identities
-        alt_self_peptides=None, # or list of peptides
-        verbose=False,
-        pick_dgeoms_using_tcrdist=False, # implies num_runs=3
-        use_same_pmhc_dgeoms=False,
+        num_templates_per_run,
         exclude_pdbids=None,
         force_pmhc_pdbids=None,
-        use_opt_dgeoms=False,
+        alt_self_peptides=None,
+        min_pmhc_peptide_mismatches=-1,
+        next_best_identity_threshold=0.98,
+        verbose=False,
 ):
-    ''' Makes num_templates_per_run * num_runs template pdb files
-
-    Make num_runs alignfiles <outfile_prefix>_<run>_alignments.tsv
-
-    returns df with lines for "targets.tsv" file, last 2 columns are
-    <alignfile> and <target_chainseq>
+    ''' Find the pmhc templates for make_templates_for_alphafold
 
-    returns None for failure
+    returns a list of tuples:
+    (identities_for_sorting, pdbid, trg_to_tmp, trg_pmhc_seq, tmp_pmhc_seq, identities)
 
+    This only depends on the pmhc part of the target, so it's memoized (in memory
+    and on disk, see cache.py) for screening many TCRs against the same pmhc.
+    Don't modify the returned alignments.
     '''
-    from .pdblite import (apply_transform_Rx_plus_v, delete_chains, append_chains,
-                          dump_pdb)
+    exclude_pdbids = tuple(sorted(set(exclude_pdbids or [])))
+    if force_pmhc_pdbids:
+        force_pmhc_pdbids = tuple(sorted(set(force_pmhc_pdbids)))
+    alt_self_peptides = tuple(alt_self_peptides or [])
 
-    if exclude_pdbids is None:
-        exclude_pdbids = []
+    if mhc_class == 1:
+        trg_alseqs = (get_mhc_class_1_alseq(mhc_allele),)
     else:
-        exclude_pdbids = frozenset(exclude_pdbids)
-        print(f'will exclude {len(exclude_pdbids)} pdbids')
-
-    # check arguments
-    if mhc_class == 2:
-        assert len(peptide) == CLASS2_PEPLEN
-        assert mhc_allele.count(',') == 1
-
-    if pick_dgeoms_using_tcrdist:
-        assert num_runs == 3 # AB, A, B
-
-    if use_opt_dgeoms:
-        assert num_runs == 1
-
-    if exclude_docking_geometry_peptides is None:
-        exclude_docking_geometry_peptides = []
-    if alt_self_peptides is None:
-        alt_self_peptides = []
-
-    if exclude_self_peptide_docking_geometries:
-        # dont modify the passed-in list
-        exclude_docking_geometry_peptides = (
-            exclude_docking_geometry_peptides+[peptide]+alt_self_peptides)
-
-    tcrdister = get_tcrdister('human_and_mouse')
+        trg_alseqs = (get_mhc_class_2_alseq('A', mhc_allele.split(',')[0]),
+                      get_mhc_class_2_alseq('B', mhc_allele.split(',')[1]))
+
+    key = cache.make_key(
+        'pmhc_alignments', organism, mhc_class, mhc_allele, trg_alseqs, peptide,
+        num_templates_per_run, exclude_pdbids, force_pmhc_pdbids, alt_self_peptides,
+        min_pmhc_peptide_mismatches, next_best_identity_threshold,
+        tuple(BAD_PMHC_PDBIDS),
+        cache.db_fingerprint(path_to_db / f'{PMHC}_templates_v2.tsv',
+                             path_to_db / f'{TERNARY}_templates_v2.tsv'),
+    )
+    if key not in _pmhc_alignments_cache:
+        pmhc_alignments = cache.load_cached('pmhc_alignments', key)
+        if pmhc_alignments is None:
+            pmhc_alignments = _compute_pmhc_alignments(
+                organism, mhc_class, mhc_allele, peptide, num_templates_per_run,
+                frozenset(exclude_pdbids), force_pmhc_pdbids, list(alt_self_peptides),
+                min_pmhc_peptide_mismatches, next_best_identity_threshold, verbose)
+            cache.save_cached('pmhc_alignments', key, pmhc_alignments)
+        else:
+            print('using cached pmhc_alignments:', organism, mhc_allele, peptide)
+        _pmhc_alignments_cache[key] = pmhc_alignments
+    return list(_pmhc_alignments_cache[key])
 
 
+def _compute_pmhc_alignments(
+        organism,
+        mhc_class,
+        mhc_allele,
+        peptide,
+        num_templates_per_run,
+        exclude_pdbids,
+        force_pmhc_pdbids,
+        alt_self_peptides,
+        min_pmhc_peptide_mismatches,
+        next_best_identity_threshold,
+        verbose,
+):
+    ''' helper for get_pmhc_alignments, does the actual work
+    '''
     def show_alignment(al,seq1,seq2):
         if verbose:
             for i,j in sorted(al.items()):
@@ -1152,53 +1344,48 @@ def make_templates_for_alphafold(
             idents = sum(seq1[i] == seq2[j] for i,j in al.items())/len(seq1)
             print(f'idents: {idents:6.3f}')
 
-    core_len = TCR_CORE_LEN
-
     if mhc_class == 1:
-        if organism=='human':
-            # now adding HLA-E 2022-05-03
-            assert mhc_allele[0] in 'ABCE' and mhc_allele[1]=='*' and ':' in mhc_allele
-            mhc_allele = ':'.join(mhc_allele.split(':')[:2]) # just the 4 digits
-        else:
-            assert mhc_allele.startswith('H2') and mhc_allele in mhc_class_1_alfas
-
-        # first: MHC part
         trg_mhc_alseq = get_mhc_class_1_alseq(mhc_allele)
         trg_mhc_seq = trg_mhc_alseq.replace(ALL_GENES_GAP_CHAR,'')
 
-        sortl = []
-
         # use new pmhc-only data
-        for l in pmhc_info.itertuples():
-            if (l.organism!=organism or l.mhc_class!=mhc_class or
-                l.pdbid in BAD_PMHC_PDBIDS or l.pdbid in exclude_pdbids or
-                (force_pmhc_pdbids and l.pdbid not in force_pmhc_pdbids)):
-                continue
-
-            tmp_mhc_alseq = l.mhc_alignseq
-            assert len(trg_mhc_alseq) == len(tmp_mhc_alseq)
-
-            mhc_idents = sum(a==b and a!=ALL_GENES_GAP_CHAR
-                             for a,b in zip(trg_mhc_alseq, tmp_mhc_alseq))
-
-            if len(peptide) == len(l.pep_seq):
-                pep_idents = sum(a==b for a,b in zip(peptide,l.pep_seq))
-            else:
-                pep_idents = sum(a==b for a,b in zip(peptide[:3]+peptide[-3:],
-                                                     l.pep_seq[:3]+l.pep_seq[-3:]))
-            mismatches_for_excluding = min(
-                count_peptide_mismatches(x, l.pep_seq)
-                for x in [peptide]+alt_self_peptides)
-            if mismatches_for_excluding < min_pmhc_peptide_mismatches:
-                if verbose:
-                    print('peptide too close:', peptide, l.pep_seq,
+        # score all the templates at once, using the pre-encoded sequences
+        mask = ((pmhc_info.organism==organism) & (pmhc_info.mhc_class==mhc_class) &
+                ~pmhc_info.pdbid.isin(BAD_PMHC_PDBIDS) &
+                ~pmhc_info.pdbid.isin(exclude_pdbids))
+        if force_pmhc_pdbids:
+            mask &= pmhc_info.pdbid.isin(force_pmhc_pdbids)
+        rows = np.nonzero(mask.values)[0]
+        templates = pmhc_info.iloc[rows]
+
+        assert all(templates.mhc_alignseq.str.len() == len(trg_mhc_alseq))
+        mhc_idents = count_identities_uint8(
+            trg_mhc_alseq, pmhc_info_uint8['mhc_alignseq'][rows])
+
+        same_len = (templates.pep_seq.str.len() == len(peptide)).values
+        pep_idents = count_identities_uint8(
+            peptide[:3]+peptide[-3:], pmhc_info_uint8['pep_ends'][rows])
+        if same_len.any():
+            pep_idents[same_len] = count_identities_uint8(
+                peptide, pmhc_info_uint8['pep_seq'][rows[same_len]])
+
+        if min_pmhc_peptide_mismatches > 0: # mismatches are always >= 0
+            all_mismatches_for_excluding = count_peptide_mismatches_matrix(
+                [peptide]+alt_self_peptides, templates.pep_seq).min(axis=0)
+            keep = all_mismatches_for_excluding >= min_pmhc_peptide_mismatches
+            if verbose:
+                for tmp_pep_seq, mismatches_for_excluding in zip(
+                        templates.pep_seq[~keep], all_mismatches_for_excluding[~keep]):
+                    print('peptide too close:', peptide, tmp_pep_seq,
                           'mismatches_for_excluding:', mismatches_for_excluding,
                           alt_self_peptides)
-                continue
-            assert len(peptide)-pep_idents >= min_pmhc_peptide_mismatches #sanity
-            total = len(peptide)+len(trg_mhc_seq)
-            frac = (mhc_idents+pep_idents)/total - 0.01*l.mhc_total_chainbreak
-            sortl.append((frac, l.Index))
+            rows, templates = rows[keep], templates[keep]
+            mhc_idents, pep_idents = mhc_idents[keep], pep_idents[keep]
+        assert all(len(peptide)-pep_idents >= min_pmhc_peptide_mismatches) #sanity
+        total = len(peptide)+len(trg_mhc_seq)
+        fracs = ((mhc_idents+pep_idents)/total -
+                 0.01*templates.mhc_total_chainbreak.values)
+        sortl = list(zip(fracs.tolist(), templates.index))
 
         sortl.sort(reverse=True)
         max_idents = sortl[0][0]
@@ -1208,7 +1395,7 @@ def make_templates_for_alphafold(
 
         pmhc_alignments = []
         for (idents, pdbid) in sortl[:num_templates_per_run]:
-            if idents < next_best_identity_threshold_tcr*max_idents:
+            if idents < next_best_identity_threshold*max_idents:
                 break
             templatel = pmhc_info.loc[pdbid]
             tmp_mhc_alseq = templatel.mhc_alignseq
@@ -1265,27 +1452,33 @@ def make_templates_for_alphafold(
         trg_mhcb_seq = trg_mhcb_alseq.replace(ALL_GENES_GAP_CHAR,'')
         trg_pmhc_seq = trg_mhca_seq + trg_mhcb_seq + peptide
 
-        sortl = []
-        for l in ternary_info.itertuples():
-            if (l.organism!=organism or l.mhc_class!=mhc_class or
-                l.pdbid in BAD_PMHC_PDBIDS or l.pdbid in exclude_pdbids):
-                continue
-            mismatches_for_excluding = min(
-                count_peptide_mismatches(x, l.pep_seq)
-                for x in [peptide]+alt_self_peptides)
-
-            if mismatches_for_excluding < min_pmhc_peptide_mismatches:
-                if verbose:
-                    print('peptide too close:', peptide, l.pep_seq,
+        mask = ((ternary_info.organism==organism) &
+                (ternary_info.mhc_class==mhc_class) &
+                ~ternary_info.pdbid.isin(BAD_PMHC_PDBIDS) &
+                ~ternary_info.pdbid.isin(exclude_pdbids))
+        rows = np.nonzero(mask.values)[0]
+        templates = ternary_info.iloc[rows]
+
+        if min_pmhc_peptide_mismatches > 0: # mismatches are always >= 0
+            all_mismatches_for_excluding = count_peptide_mismatches_matrix(
+                [peptide]+alt_self_peptides, templates.pep_seq).min(axis=0)
+            keep = all_mismatches_for_excluding >= min_pmhc_peptide_mismatches
+            if verbose:
+                for tmp_pep_seq, mismatches_for_excluding in zip(
+                        templates.pep_seq[~keep], all_mismatches_for_excluding[~keep]):
+                    print('peptide too close:', peptide, tmp_pep_seq,
                           mismatches_for_excluding, alt_self_peptides)
-                continue
-            tmp_mhca_alseq, tmp_mhcb_alseq = l.mhc_alignseq.split('/')
-            idents = 0
-            for a,b in zip([trg_mhca_alseq, trg_mhcb_alseq, peptide],
-                           [tmp_mhca_alseq, tmp_mhcb_alseq, l.pep_seq]):
-                assert len(a) == len(b)
-                idents += sum(x==y for x,y in zip(a,b) if x!=ALL_GENES_GAP_CHAR)
-            sortl.append((idents/len(trg_pmhc_seq), l.pdbid))
+            rows, templates = rows[keep], templates[keep]
+
+        # score all the templates at once: A/B/peptide have to line up
+        trg_alseq = trg_mhca_alseq + '/' + trg_mhcb_alseq + peptide
+        assert all(templates.mhc_alignseq.str.len() ==
+                   len(trg_mhca_alseq)+1+len(trg_mhcb_alseq))
+        assert all(templates.mhc_alignseq.str.find('/') == len(trg_mhca_alseq))
+        assert all(templates.pep_seq.str.len() == len(peptide))
+        idents = count_identities_uint8(
+            trg_alseq, ternary_info_uint8['mhc_alignseq_pep_seq'][rows])
+        sortl = list(zip((idents/len(trg_pmhc_seq)).tolist(), templates.pdbid))
         sortl.sort(reverse=True)
         max_idents = sortl[0][0]
         print(f'mhc max_idents: {max_idents:.3f}', mhc_allele, peptide,
@@ -1294,7 +1487,7 @@ def make_templates_for_alphafold(
 
         pmhc_alignments = []
         for (idents, pdbid) in sortl[:num_templates_per_run]:
-            if idents < next_best_identity_threshold_tcr*max_idents:
+            if idents < next_best_identity_threshold*max_idents:
                 break
             templatel = ternary_info.loc[pdbid]
             tmp_mhca_alseq, tmp_mhcb_alseq = templatel.mhc_alignseq.split('/')
@@ -1334,77 +1527,281 @@ def make_templates_for_alphafold(
                                     idents,
             ))
 
+    return pmhc_alignments
 
 
+_tcr_chain_alignments_cache = {}
+def get_tcr_chain_alignments(
+        ab,
+        organism,
+        trg_v,
+        trg_j,
+        trg_cdr3,
+        num_templates_per_run,
+        exclude_pdbids=None,
+        min_single_chain_tcrdist=-1,
+        ternary_bonus=0.05,
+        next_best_identity_threshold=0.98,
+):
+    ''' Find the TCR templates for one chain ('A' or 'B') for
+    make_templates_for_alphafold
 
+    returns a list of tuples:
+    (identities_for_sorting, pdbid, trg_to_tmp, trg_chainseq, tmp_chainseq,
+     closest_dist, identities)
 
-    tcr_alignments = {'A':[], 'B':[]}
+    memoized in memory and on disk (see cache.py), since the same TCR chains get
+    reused for many targets (peptide scans, specificity benchmarks, etc).
+    Don't modify the returned alignments.
+    '''
+    exclude_pdbids = tuple(sorted(set(exclude_pdbids or [])))
+
+    key = cache.make_key(
+        'tcr_chain_alignments', ab, organism, trg_v, trg_j, trg_cdr3,
+        num_templates_per_run, exclude_pdbids, min_single_chain_tcrdist,
+        ternary_bonus, next_best_identity_threshold,
+        cache.db_fingerprint(path_to_db / f'{TCR}_templates_v2.tsv',
+                             path_to_db / 'new_human_vg_alignments_v1.tsv',
+                             path_to_db / 'new_both_vg_alignments_v1.tsv',
+                             tcrdist.all_genes.db_file),
+    )
+    if key not in _tcr_chain_alignments_cache:
+        alignments = cache.load_cached('tcr_chain_alignments', key)
+        if alignments is None:
+            alignments = _compute_tcr_chain_alignments(
+                ab, organism, trg_v, trg_j, trg_cdr3, num_templates_per_run,
+                frozenset(exclude_pdbids), min_single_chain_tcrdist, ternary_bonus,
+                next_best_identity_threshold)
+            cache.save_cached('tcr_chain_alignments', key, alignments)
+        else:
+            print('using cached tcr_chain_alignments:', organism, ab, trg_v, trg_j,
+                  trg_cdr3)
+        _tcr_chain_alignments_cache[key] = alignments
+    return list(_tcr_chain_alignments_cache[key])
 
-    # compute single-chain tcrdists to candidate template chains
+
+def _compute_tcr_chain_alignments(
+        ab,
+        organism,
+        trg_v,
+        trg_j,
+        trg_cdr3,
+        num_templates_per_run,
+        exclude_pdbids,
+        min_single_chain_tcrdist,
+        ternary_bonus,
+        next_best_identity_threshold,
+):
+    ''' helper for get_tcr_chain_alignments, does the actual work
+    '''
+    tcrdister = get_tcrdister('human_and_mouse')
 
     # drop out of the loop if vdist hits this value and we've already got enough
     # templates
     big_v_dist=50
 
-    for ab, trg_v, trg_j, trg_cdr3 in  [['A',va,ja,cdr3a],['B',vb,jb,cdr3b]]:
-        trg_tcr = (organism[0]+trg_v, trg_j, trg_cdr3)
-
-        trg_msa_alignments = align_vgene_to_structure_msas(organism, trg_v)
-
-        templates = tcr_info[tcr_info.ab==ab]
-        templates = templates[~templates.pdbid.isin(exclude_pdbids)]
-        template_tcrs = [
-            (x.organism[0]+x.v_gene, None, x.cdr3) for x in templates.itertuples()]
-        #templates['v_gene j_gene cdr3'.split()].itertuples(index=False))
-        closest_tcrs = [(x[0],x[1],trg_cdr3) for x in template_tcrs] # tmp v, trg cdr3
-        sortl = sorted(
-            [(tcrdister.single_chain_distance(trg_tcr,x),
-              tcrdister.single_chain_distance(trg_tcr,y),
-              i)
-             for i,(x,y) in enumerate(zip(closest_tcrs, template_tcrs))])
-
-        alignments = []
-        for closest_dist, dist, ind in sortl:
-            if dist < min_single_chain_tcrdist:
-                #print('too close:', dist, trg_v, trg_j, trg_cdr3, template_tcrs[ind])
-                continue
-            if closest_dist > big_v_dist and len(alignments)>=num_templates_per_run:
-                #print('too far:', closest_dist)
-                break
+    trg_tcr = (organism[0]+trg_v, trg_j, trg_cdr3)
+
+    trg_msa_alignments = align_vgene_to_structure_msas(organism, trg_v)
+
+    templates = tcr_info[tcr_info.ab==ab]
+    templates = templates[~templates.pdbid.isin(exclude_pdbids)]
+    template_tcrs = [
+        (x.organism[0]+x.v_gene, None, x.cdr3) for x in templates.itertuples()]
+    #templates['v_gene j_gene cdr3'.split()].itertuples(index=False))
+    closest_tcrs = [(x[0],x[1],trg_cdr3) for x in template_tcrs] # tmp v, trg cdr3
+    sortl = sorted(
+        [(tcrdister.single_chain_distance(trg_tcr,x),
+          tcrdister.single_chain_distance(trg_tcr,y),
+          i)
+         for i,(x,y) in enumerate(zip(closest_tcrs, template_tcrs))])
+
+    alignments = []
+    for closest_dist, dist, ind in sortl:
+        if dist < min_single_chain_tcrdist:
+            #print('too close:', dist, trg_v, trg_j, trg_cdr3, template_tcrs[ind])
+            continue
+        if closest_dist > big_v_dist and len(alignments)>=num_templates_per_run:
+            #print('too far:', closest_dist)
+            break
+
+        templatel = templates.iloc[ind]
+
+        # if templatel.organism == 'human' and organism == 'human':
+        #     msa_type = 'human'
+        # else:
+        #     msa_type = 'both'
+
+        trg_to_tmp, trg_chainseq = align_vgene_to_template_pdb_chain(
+            ab, organism, trg_v, trg_j, trg_cdr3, trg_msa_alignments,
+            templatel.pdbid,
+        )
 
-            templatel = templates.iloc[ind]
+        # tmp_chainseq_to_msa = align_tcr_info_pdb_chain_to_structure_msa(
+        #     templatel.pdbid, templatel.ab, msa_type)
 
-            # if templatel.organism == 'human' and organism == 'human':
-            #     msa_type = 'human'
-            # else:
-            #     msa_type = 'both'
+        identities = sum(trg_chainseq[i]==templatel.chainseq[j]
+                         for i,j in trg_to_tmp.items()) / len(trg_chainseq)
 
-            trg_to_tmp, trg_chainseq = align_vgene_to_template_pdb_chain(
-                ab, organism, trg_v, trg_j, trg_cdr3, trg_msa_alignments,
-                templatel.pdbid,
-            )
+        identities_for_sorting = identities + ternary_bonus * templatel.ternary
 
-            # tmp_chainseq_to_msa = align_tcr_info_pdb_chain_to_structure_msa(
-            #     templatel.pdbid, templatel.ab, msa_type)
+        alignments.append(
+            (identities_for_sorting,
+             templatel.pdbid,
+             trg_to_tmp,
+             trg_chainseq,
+             templatel.chainseq,
+             closest_dist,
+             identities,
+            ))
+    alignments.sort(reverse=True)
+    max_idents = alignments[0][0]
+    return [x for x in alignments[:num_templates_per_run]
+            if x[0] >= next_best_identity_threshold*max_idents]
 
-            identities = sum(trg_chainseq[i]==templatel.chainseq[j]
-                             for i,j in trg_to_tmp.items()) / len(trg_chainseq)
 
-            identities_for_sorting = identities + ternary_bonus * templatel.ternary
+_dgeom_reps_cache = {}
+def get_docking_geometry_rep_indices(dgeom_info, dgeoms, num_reps):
+    ''' Returns docking_geometry.pick_docking_geometry_reps rep indices for the
+    docking geometries of the ternary templates in dgeom_info
 
-            alignments.append(
-                (identities_for_sorting,
-                 templatel.pdbid,
-                 trg_to_tmp,
-                 trg_chainseq,
-                 templatel.chainseq,
-                 closest_dist,
-                 identities,
-                ))
-        alignments.sort(reverse=True)
-        max_idents = alignments[0][0]
-        tcr_alignments[ab] = [x for x in alignments[:num_templates_per_run]
-                              if x[0] >= next_best_identity_threshold_tcr*max_idents]
+    The clustering only depends on which templates are in dgeom_info (and their
+    order), which is often the same from one target to the next, so it's memoized
+    (in memory and on disk, see cache.py)
+    '''
+    assert len(dgeoms) == dgeom_info.shape[0]
+    dummy_organism = 'human' # just used for avg cdr coords
+    key = cache.make_key(
+        'dgeom_reps', tuple(dgeom_info.pdbid), num_reps, dummy_organism,
+        cache.db_fingerprint(path_to_db / f'{TERNARY}_templates_v2.tsv'),
+    )
+    if key not in _dgeom_reps_cache:
+        rep_indices = cache.load_cached('dgeom_reps', key)
+        if rep_indices is None:
+            _, rep_indices = docking_geometry.pick_docking_geometry_reps(
+                dummy_organism, dgeoms, num_reps)
+            rep_indices = [int(x) for x in rep_indices]
+            cache.save_cached('dgeom_reps', key, rep_indices)
+        _dgeom_reps_cache[key] = rep_indices
+    return _dgeom_reps_cache[key][:]
+
+def make_templates_for_alphafold(
+        organism,
+        va,
+        ja,
+        cdr3a,
+        vb,
+        jb,
+        cdr3b,
+        mhc_class,
+        mhc_allele,
+        peptide,
+        outfile_prefix,
+        num_runs=5, # match default in setup_for_alphafold
+        num_templates_per_run=4,
+        exclude_self_peptide_docking_geometries=False,
+        exclude_docking_geometry_peptides=None, # None or list of peptides
+        # below is only applied if exclude_docking_geometry_peptides is nonempty
+        #   or exclude_self_peptide_docking_geometries
+        min_dgeom_peptide_mismatches=3, # not used if exclude_* are False/None
+        min_dgeom_paired_tcrdist=-1,
+        min_dgeom_singlechain_tcrdist=-1,
+        min_single_chain_tcrdist=-1,
+        min_pmhc_peptide_mismatches=-1,
+        next_best_identity_threshold_mhc=0.98,
+        next_best_identity_threshold_tcr=0.98,
+        ternary_bonus=0.05, # for tcr templates, in frac identities
+        alt_self_peptides=None, # or list of peptides
+        verbose=False,
+        pick_dgeoms_using_tcrdist=False, # implies num_runs=3
+        use_same_pmhc_dgeoms=False,
+        exclude_pdbids=None,
+        force_pmhc_pdbids=None,
+        use_opt_dgeoms=False,
+        template_format='pdb', # 'pdb', 'npz' (atom37, see save_template_npz), 'both'
+                               # or None (no template files)
+        return_template_poses=False, # add a template_pose column with the poses
+):
+    ''' Makes num_templates_per_run * num_runs template pdb (and/or npz) files
+
+    Make num_runs alignfiles <outfile_prefix>_<run>_alignments.tsv
+
+    returns df with lines for "targets.tsv" file, last 2 columns are
+    <alignfile> and <target_chainseq>
+
+    returns None for failure
+
+    '''
+    from .pdblite import (apply_transform_Rx_plus_v, delete_chains, append_chains,
+                          dump_pdb, save_template_npz)
+    assert template_format in ['pdb', 'npz', 'both', None]
+
+    if exclude_pdbids is None:
+        exclude_pdbids = []
+    else:
+        exclude_pdbids = frozenset(exclude_pdbids)
+        print(f'will exclude {len(exclude_pdbids)} pdbids')
+
+    # check arguments
+    if mhc_class == 2:
+        assert len(peptide) == CLASS2_PEPLEN
+        assert mhc_allele.count(',') == 1
+
+    if pick_dgeoms_using_tcrdist:
+        assert num_runs == 3 # AB, A, B
+
+    if use_opt_dgeoms:
+        assert num_runs == 1
+
+    if exclude_docking_geometry_peptides is None:
+        exclude_docking_geometry_peptides = []
+    if alt_self_peptides is None:
+        alt_self_peptides = []
+
+    if exclude_self_peptide_docking_geometries:
+        # dont modify the passed-in list
+        exclude_docking_geometry_peptides = (
+            exclude_docking_geometry_peptides+[peptide]+alt_self_peptides)
+
+
+    core_len = TCR_CORE_LEN
+
+    if mhc_class == 1:
+        if organism=='human':
+            # now adding HLA-E 2022-05-03
+            assert mhc_allele[0] in 'ABCE' and mhc_allele[1]=='*' and ':' in mhc_allele
+            mhc_allele = ':'.join(mhc_allele.split(':')[:2]) # just the 4 digits
+        else:
+            assert mhc_allele.startswith('H2') and mhc_allele in mhc_class_1_alfas
+        trg_mhc_seq = get_mhc_class_1_alseq(mhc_allele).replace(ALL_GENES_GAP_CHAR,'')
+    else:
+        trg_mhca_seq = get_mhc_class_2_alseq('A', mhc_allele.split(',')[0]).replace(
+            ALL_GENES_GAP_CHAR,'')
+        trg_mhcb_seq = get_mhc_class_2_alseq('B', mhc_allele.split(',')[1]).replace(
+            ALL_GENES_GAP_CHAR,'')
+
+    pmhc_alignments = get_pmhc_alignments(
+        organism, mhc_class, mhc_allele, peptide, num_templates_per_run,
+        exclude_pdbids = exclude_pdbids,
+        force_pmhc_pdbids = force_pmhc_pdbids,
+        alt_self_peptides = alt_self_peptides,
+        min_pmhc_peptide_mismatches = min_pmhc_peptide_mismatches,
+        next_best_identity_threshold = next_best_identity_threshold_tcr,
+        verbose = verbose,
+    )
+
+    tcr_alignments = {'A':[], 'B':[]}
+
+    # compute single-chain tcrdists to candidate template chains
+
+    for ab, trg_v, trg_j, trg_cdr3 in  [['A',va,ja,cdr3a],['B',vb,jb,cdr3b]]:
+        tcr_alignments[ab] = get_tcr_chain_alignments(
+            ab, organism, trg_v, trg_j, trg_cdr3, num_templates_per_run,
+            exclude_pdbids = exclude_pdbids,
+            min_single_chain_tcrdist = min_single_chain_tcrdist,
+            ternary_bonus = ternary_bonus,
+            next_best_identity_threshold = next_best_identity_threshold_tcr,
+        )
 
     # docking geometries
     # exclude same-epitope geoms
@@ -1439,9 +1836,9 @@ def make_templates_for_alphafold(
             rep_dgeom_indices = np.random.permutation(len(dgeoms))
             rep_dgeoms = [dgeoms[x] for x in rep_dgeom_indices]
         else:
-            dummy_organism = 'human' # just used for avg cdr coords
-            rep_dgeoms, rep_dgeom_indices = docking_geometry.pick_docking_geometry_reps(
-                dummy_organism, dgeoms, num_runs*num_templates_per_run)
+            rep_dgeom_indices = get_docking_geometry_rep_indices(
+                dgeom_info, dgeoms, num_runs*num_templates_per_run)
+            rep_dgeoms = [dgeoms[x] for x in rep_dgeom_indices]
     elif use_opt_dgeoms:
         rep_dgeoms = docking_geometry.load_opt_dgeoms(mhc_class)
         assert len(rep_dgeoms) == 4
@@ -1467,9 +1864,9 @@ def make_templates_for_alphafold(
             rep_dgeom_indices = np.random.permutation(len(dgeoms))
             rep_dgeoms = [dgeoms[x] for x in rep_dgeom_indices]
         else:
-            dummy_organism = 'human' # just used for avg cdr coords
-            rep_dgeoms, rep_dgeom_indices = docking_geometry.pick_docking_geometry_reps(
-                dummy_organism, dgeoms, num_runs*num_templates_per_run)
+            rep_dgeom_indices = get_docking_geometry_rep_indices(
+                dgeom_info, dgeoms, num_runs*num_templates_per_run)
+            rep_dgeoms = [dgeoms[x] for x in rep_dgeom_indices]
 
     #print('dgeoms:', len(dgeoms), len(rep_dgeoms))
 
@@ -1609,9 +2006,13 @@ def make_templates_for_alphafold(
                         print(f'{i:4d} {j:4d} {a} {star} {b}')
 
             outpdbfile = f'{outfile_prefix}_{run}_{itmp}.pdb'
-            #pmhc_pose.dump_pdb(outpdbfile)
-            dump_pdb(pmhc_pose, outpdbfile)
-            #print('made:', outpdbfile)
+            outnpzfile = f'{outfile_prefix}_{run}_{itmp}.npz'
+            if template_format in ['pdb', 'both']:
+                #pmhc_pose.dump_pdb(outpdbfile)
+                dump_pdb(pmhc_pose, outpdbfile)
+                #print('made:', outpdbfile)
+            if template_format in ['npz', 'both']:
+                save_template_npz(pmhc_pose, outnpzfile, trg_to_tmp)
 
             trg_pmhc_seqs = ([trg_mhc_seq, peptide] if mhc_class==1 else
                              [trg_mhca_seq, trg_mhcb_seq, peptide])
@@ -1649,6 +2050,12 @@ def make_templates_for_alphafold(
                 target_len=len(trg_fullseq),
                 template_len=len(tmp_fullseq),
             )
+            if template_format in ['npz', 'both']:
+                outl['template_npzfile'] = outnpzfile
+            if template_format not in ['pdb', 'both']:
+                del outl['template_pdbfile']
+            if return_template_poses:
+                outl['template_pose'] = pmhc_pose
             dfl.append(outl)
     assert len(dfl) == num_runs * num_templates_per_run
     return pd.DataFrame(dfl)
@@ -1704,6 +2111,28 @@ def check_genes_for_modeling(tcr_db):
     return all_ok
 
 
+def prepare_tcr_db_for_alphafold(tcr_db, organism=None):
+    ''' returns a copy of tcr_db with the mhc_peptide column (used in the targetids)
+    and the organism column filled in
+    '''
+    required_cols = 'va ja cdr3a vb jb cdr3b mhc_class mhc peptide'.split()
+    if organism is None:
+        required_cols.append('organism')
+    for col in required_cols:
+        assert col in tcr_db.columns
+
+    tcr_db = tcr_db.copy()
+    tcr_db['mhc_peptide'] = (
+        tcr_db.mhc.str.replace('*','',regex=False).str.replace(':','',regex=False)+
+        '_'+tcr_db.peptide)
+    if organism is not None:
+        if 'organism' in tcr_db.columns:
+            assert all(tcr_db.organism==organism)
+        else:
+            tcr_db['organism'] = organism
+    return tcr_db
+
+
 def setup_for_alphafold(
         tcr_db,
         outdir,
@@ -1718,37 +2147,34 @@ def setup_for_alphafold(
         exclude_pdbids_column=None, # this column should be comma-separated
         targetid_prefix_suffix='',
         use_opt_dgeoms=False,
+        num_workers=1, # >1 means farm the targets out to a process pool
+        resume=False, # skip targets whose alignfiles and template pdbs exist
+        dedup_targets=False, # only set up the first of any duplicate targets
+        template_cache_mb=None, # memory bound for template_pose_cache, per process
         **kwargs,
 ):
-    '''
+    ''' if dedup_targets, rows of tcr_db that are duplicates of an earlier row (see
+    get_duplicate_targets) don't get their own templates; their rows in targets.tsv
+    point to the earlier row's alignfiles, and the 'dedup_targetid' column tells
+    run_prediction.py to copy the results rather than model them again
     '''
     assert outdir.endswith('/')
     if use_opt_dgeoms:
         assert num_runs == 1
-    required_cols = 'va ja cdr3a vb jb cdr3b mhc_class mhc peptide'.split()
-    if organism is None:
-        required_cols.append('organism')
-    for col in required_cols:
-        assert col in tcr_db.columns
+
+    if template_cache_mb is not None: # before forking, so the workers inherit it
+        set_template_pose_cache_size(template_cache_mb)
 
     #assert not any(tcr_db.mhc.str.startswith('E*'))
 
-    tcr_db = tcr_db.copy()
-    tcr_db['mhc_peptide'] = (
-        tcr_db.mhc.str.replace('*','',regex=False).str.replace(':','',regex=False)+
-        '_'+tcr_db.peptide)
-    if organism is not None:
-        if 'organism' in tcr_db.columns:
-            assert all(tcr_db.organism==organism)
-        else:
-            tcr_db['organism'] = organism
+    tcr_db = prepare_tcr_db_for_alphafold(tcr_db, organism)
 
     # doesnt do anything if init has already been called (I don't think)
 
     if not exists(outdir):
         os.mkdir(outdir)
     else:
-        assert clobber, 'outdir already exists: '+outdir
+        assert clobber or resume, 'outdir already exists: '+outdir
 
     #optionally filter to peptide mhc combos with min/max counts ##########
     if min_pmhc_count is not None or max_pmhc_count is not None:
@@ -1788,65 +2214,367 @@ def setup_for_alphafold(
             assert False
             exit()
 
-    targets_dfl = []
-    for index, targetl in tcr_db.iterrows():
-        targetid_prefix = f'T{index:05d}_{targetl.mhc_peptide}{targetid_prefix_suffix}'
-        print('START', index, tcr_db.shape[0], targetid_prefix)
-        outfile_prefix = f'{outdir}{targetid_prefix}'
-        if exclude_self_peptide_docking_geometries:
-            exclude_docking_geometry_peptides = [targetl.peptide]
-        else:
-            exclude_docking_geometry_peptides = []
-        if alt_self_peptides_column is not None:
-            assert exclude_docking_geometry_peptides
-            alt_self_peptides = targetl[alt_self_peptides_column].split(',')
-            if exclude_self_peptide_docking_geometries:
-                exclude_docking_geometry_peptides.extend(alt_self_peptides)
+    setup_target = partial(
+        _setup_single_target,
+        outdir=outdir,
+        num_runs=num_runs,
+        exclude_self_peptide_docking_geometries=exclude_self_peptide_docking_geometries,
+        alt_self_peptides_column=alt_self_peptides_column,
+        exclude_pdbids_column=exclude_pdbids_column,
+        targetid_prefix_suffix=targetid_prefix_suffix,
+        use_opt_dgeoms=use_opt_dgeoms,
+        num_targets=tcr_db.shape[0],
+        **kwargs,
+    )
+
+    if dedup_targets:
+        duplicates = get_duplicate_targets(
+            tcr_db, num_runs, alt_self_peptides_column=alt_self_peptides_column,
+            exclude_pdbids_column=exclude_pdbids_column)
+        print('setup_for_alphafold: dedup_targets: found', len(duplicates),
+              'duplicates out of', tcr_db.shape[0], 'targets')
+    else:
+        duplicates = {}
+
+    # look for targets that were finished by a previous, interrupted setup run
+    finished_rows = {}
+    if resume:
+        for index, targetl in tcr_db.iterrows():
+            if index in duplicates:
+                continue
+            target_rows = _load_finished_target_rows(
+                targetl, outdir, _get_targetid_prefix(
+                    index, targetl, targetid_prefix_suffix), num_runs)
+            if target_rows is not None:
+                finished_rows[index] = target_rows
+        print('setup_for_alphafold: resume: skipping', len(finished_rows),
+              'finished targets out of', tcr_db.shape[0])
+    todo_targets = ((index, targetl) for index, targetl in tcr_db.iterrows()
+                    if index not in finished_rows and index not in duplicates)
+
+    # imap_in_workers returns the results in input order, so targets.tsv is the
+    # same regardless of num_workers
+    if num_workers > 1:
+        print('setup_for_alphafold: num_workers=', num_workers)
+        # fill the slow caches before forking so the workers share them
+        get_tcrdister('human_and_mouse')
+        _init_tcr_alignment_cache()
+        all_target_rows = imap_in_workers(setup_target, todo_targets, num_workers)
+    else:
+        all_target_rows = map(setup_target, todo_targets)
+
+    # append-only and line-buffered, so partial work is saved as we go
+    # without rewriting the whole file after each target
+    outfile = outdir+'targets.tsv'
+    columns = list(tcr_db.columns) + [
+        'targetid', 'target_chainseq', 'templates_alignfile']
+    if dedup_targets:
+        columns.append('dedup_targetid')
+    all_rows = {}
+    # dont leave the workers running if something goes wrong (a worker that dies
+    # raises RuntimeError in next(all_target_rows), see imap_in_workers)
+    try:
+        with open(outfile, 'w', buffering=1) as out:
+            out.write('\t'.join(columns)+'\n')
+            for index, targetl in tcr_db.iterrows():
+                if index in duplicates:
+                    target_rows = make_duplicate_target_rows(
+                        index, targetl, all_rows[duplicates[index]],
+                        targetid_prefix_suffix=targetid_prefix_suffix)
+                elif index in finished_rows:
+                    target_rows = finished_rows[index]
+                else:
+                    target_rows = next(all_target_rows)
+                if dedup_targets:
+                    for row in target_rows:
+                        if index not in duplicates:
+                            row['dedup_targetid'] = row.targetid
+                    all_rows[index] = target_rows
+                pd.DataFrame(target_rows)[columns].to_csv(
+                    out, sep='\t', index=False, header=False)
+                sys.stdout.flush()
+    finally:
+        if num_workers > 1:
+            all_target_rows.close() # terminates any workers that are still running
+
+    print('made:', outfile)
+
+
+def get_target_dedup_key(
+        targetl,
+        num_runs,
+        alt_self_peptides_column=None,
+        exclude_pdbids_column=None,
+):
+    ''' targets with the same key get the same templates (up to the random choices
+    in the template selection), so they only need to be set up and modeled once
+
+    the key is the normalized (organism, mhc_class, mhc, peptide, va, ja, cdr3a,
+    vb, jb, cdr3b, num_runs) plus the per-target filter columns, if any
+    '''
+    mhc = ','.join(x.strip() for x in targetl.mhc.split(','))
+    if int(targetl.mhc_class) == 1 and targetl.organism.strip() == 'human':
+        mhc = ':'.join(mhc.split(':')[:2]) # make_templates_for_alphafold does this
+    filters = []
+    for col in [alt_self_peptides_column, exclude_pdbids_column]:
+        if col is None or pd.isna(targetl[col]):
+            filters.append(None)
         else:
-            alt_self_peptides=None
+            filters.append(tuple(sorted(x.strip() for x in targetl[col].split(','))))
+    return (targetl.organism.strip(), int(targetl.mhc_class), mhc,
+            targetl.peptide.strip().upper(), targetl.va.strip(), targetl.ja.strip(),
+            targetl.cdr3a.strip().upper(), targetl.vb.strip(), targetl.jb.strip(),
+            targetl.cdr3b.strip().upper(), num_runs, *filters)
 
-        if exclude_pdbids_column is not None:
-            exclude_pdbids = targetl[exclude_pdbids_column]
-            if pd.isna(exclude_pdbids):
-                exclude_pdbids = None
-            else:
-                exclude_pdbids = exclude_pdbids.split(',')
+
+def get_duplicate_targets(
+        tcr_db,
+        num_runs,
+        alt_self_peptides_column=None,
+        exclude_pdbids_column=None,
+):
+    ''' returns {index: first_index} for each row of tcr_db that has the same
+    get_target_dedup_key as an earlier row (first_index)
+    '''
+    first_indices = {}
+    duplicates = {}
+    for index, targetl in tcr_db.iterrows():
+        key = get_target_dedup_key(
+            targetl, num_runs, alt_self_peptides_column=alt_self_peptides_column,
+            exclude_pdbids_column=exclude_pdbids_column)
+        if key in first_indices:
+            duplicates[index] = first_indices[key]
         else:
+            first_indices[key] = index
+    return duplicates
+
+
+def make_duplicate_target_rows(
+        index,
+        targetl,
+        first_target_rows,
+        targetid_prefix_suffix='',
+):
+    ''' targets.tsv rows for a duplicate target (see get_duplicate_targets)
+
+    first_target_rows are the rows for the first copy; these rows share its
+    target_chainseq and alignfiles, and have its targetid as their dedup_targetid
+    '''
+    targetid_prefix = _get_targetid_prefix(index, targetl, targetid_prefix_suffix)
+    target_rows = []
+    for run, first_row in enumerate(first_target_rows):
+        row = _make_target_row(targetl, f'{targetid_prefix}_{run}',
+                               first_row.target_chainseq,
+                               first_row.templates_alignfile)
+        row['dedup_targetid'] = first_row.targetid
+        target_rows.append(row)
+    return target_rows
+
+
+def _get_targetid_prefix(index, targetl, targetid_prefix_suffix):
+    return f'T{index:05d}_{targetl.mhc_peptide}{targetid_prefix_suffix}'
+
+def _make_target_row(targetl, targetid, trg_cbseq, alignfile):
+    outl = pd.Series(targetl)
+    outl['targetid'] = targetid
+    outl['target_chainseq'] = trg_cbseq
+    outl['templates_alignfile'] = alignfile
+    return outl
+
+def _load_finished_target_rows(targetl, outdir, targetid_prefix, num_runs):
+    ''' returns the targets.tsv rows for this target if all of its alignfiles and
+    template pdb/npz files already exist, otherwise None
+    '''
+    target_rows = []
+    for run in range(num_runs):
+        targetid = f'{targetid_prefix}_{run}'
+        alignfile = f'{outdir}{targetid}_alignments.tsv'
+        if not exists(alignfile):
+            return None
+        info = pd.read_table(alignfile)
+        template_files = [x for col in ['template_pdbfile', 'template_npzfile']
+                          if col in info.columns for x in info[col]]
+        if (info.shape[0] != 4 or # num templates
+            not template_files or not all(exists(x) for x in template_files)):
+            return None
+        trg_cbseq = set(info.target_chainseq).pop()
+        target_rows.append(_make_target_row(targetl, targetid, trg_cbseq, alignfile))
+    return target_rows
+
+
+def _setup_single_target(
+        index_and_targetl, # tuple from tcr_db.iterrows()
+        outdir,
+        num_runs,
+        exclude_self_peptide_docking_geometries,
+        alt_self_peptides_column,
+        exclude_pdbids_column,
+        targetid_prefix_suffix,
+        use_opt_dgeoms,
+        num_targets,
+        **kwargs,
+):
+    ''' helper for setup_for_alphafold, module-level so it can go to a process pool
+
+    makes the template pdbs and alignfiles for a single target
+
+    returns list of rows (pd.Series) for the targets.tsv file, one per run
+    '''
+    index, targetl = index_and_targetl
+    targetid_prefix = _get_targetid_prefix(index, targetl, targetid_prefix_suffix)
+    try:
+        all_run_info = _make_target_templates(
+            index, targetl, outdir, targetid_prefix, num_runs,
+            exclude_self_peptide_docking_geometries, alt_self_peptides_column,
+            exclude_pdbids_column, use_opt_dgeoms, num_targets, **kwargs)
+    except SystemExit as e:
+        # make_templates_for_alphafold calls exit() on some errors, which would
+        # kill a worker process
+        raise RuntimeError(f'setup failed for target {index} {targetid_prefix}') from e
+    target_rows = _write_target_alignfiles(
+        targetl, outdir, targetid_prefix, num_runs, all_run_info)
+    print_template_pose_cache_stats()
+    return target_rows
+
+
+def _make_target_templates(
+        index,
+        targetl,
+        outdir,
+        targetid_prefix,
+        num_runs,
+        exclude_self_peptide_docking_geometries,
+        alt_self_peptides_column,
+        exclude_pdbids_column,
+        use_opt_dgeoms,
+        num_targets,
+        **kwargs,
+):
+    ''' calls make_templates_for_alphafold for a single row of the tcr_db
+
+    returns the make_templates_for_alphafold dataframe
+    '''
+    print('START', index, num_targets, targetid_prefix)
+    outfile_prefix = f'{outdir}{targetid_prefix}'
+    if exclude_self_peptide_docking_geometries:
+        exclude_docking_geometry_peptides = [targetl.peptide]
+    else:
+        exclude_docking_geometry_peptides = []
+    if alt_self_peptides_column is not None:
+        assert exclude_docking_geometry_peptides
+        alt_self_peptides = targetl[alt_self_peptides_column].split(',')
+        if exclude_self_peptide_docking_geometries:
+            exclude_docking_geometry_peptides.extend(alt_self_peptides)
+    else:
+        alt_self_peptides=None
+
+    if exclude_pdbids_column is not None:
+        exclude_pdbids = targetl[exclude_pdbids_column]
+        if pd.isna(exclude_pdbids):
             exclude_pdbids = None
+        else:
+            exclude_pdbids = exclude_pdbids.split(',')
+    else:
+        exclude_pdbids = None
+
+    return make_templates_for_alphafold(
+        targetl.organism, targetl.va, targetl.ja, targetl.cdr3a,
+        targetl.vb, targetl.jb, targetl.cdr3b,
+        targetl.mhc_class, targetl.mhc, targetl.peptide, outfile_prefix,
+        exclude_docking_geometry_peptides=exclude_docking_geometry_peptides,
+        num_runs = num_runs,
+        alt_self_peptides=alt_self_peptides,
+        exclude_pdbids = exclude_pdbids,
+        use_opt_dgeoms = use_opt_dgeoms,
+        **kwargs,
+    )
 
-        all_run_info = make_templates_for_alphafold(
-            targetl.organism, targetl.va, targetl.ja, targetl.cdr3a,
-            targetl.vb, targetl.jb, targetl.cdr3b,
-            targetl.mhc_class, targetl.mhc, targetl.peptide, outfile_prefix,
-            exclude_docking_geometry_peptides=exclude_docking_geometry_peptides,
-            num_runs = num_runs,
-            alt_self_peptides=alt_self_peptides,
-            exclude_pdbids = exclude_pdbids,
-            use_opt_dgeoms = use_opt_dgeoms,
-            **kwargs,
-        )
 
-        for run in range(num_runs):
-            info = all_run_info[all_run_info.run==run]
-            assert info.shape[0] == 4#num templates
-            targetid = f'{targetid_prefix}_{run}'
-            trg_cbseq = set(info.target_chainseq).pop()
-            alignfile = f'{outdir}{targetid}_alignments.tsv'
-            info.to_csv(alignfile, sep='\t', index=False)
-            outl = pd.Series(targetl)
-            outl['targetid'] = targetid
-            outl['target_chainseq'] = trg_cbseq
-            outl['templates_alignfile'] = alignfile
-            targets_dfl.append(outl)
-        sys.stdout.flush()
-
-        # save partial work... since this is so freakin slow
-        outfile = outdir+'targets.tsv'
-        pd.DataFrame(targets_dfl).to_csv(outfile, sep='\t', index=False)
+def _write_target_alignfiles(targetl, outdir, targetid_prefix, num_runs, all_run_info):
+    ''' writes the <outdir><targetid>_alignments.tsv files, one per run
 
-    outfile = outdir+'targets.tsv'
-    pd.DataFrame(targets_dfl).to_csv(outfile, sep='\t', index=False)
-    print('made:', outfile)
+    returns list of rows (pd.Series) for the targets.tsv file, one per run
+    '''
+    target_rows = []
+    for run in range(num_runs):
+        info = all_run_info[all_run_info.run==run]
+        assert info.shape[0] == 4#num templates
+        targetid = f'{targetid_prefix}_{run}'
+        trg_cbseq = set(info.target_chainseq).pop()
+        alignfile = f'{outdir}{targetid}_alignments.tsv'
+        # write then rename, so an alignfile on disk is always complete (for resume)
+        info.to_csv(alignfile+'.tmp', sep='\t', index=False)
+        os.replace(alignfile+'.tmp', alignfile)
+        target_rows.append(_make_target_row(targetl, targetid, trg_cbseq, alignfile))
+    return target_rows
+
+
+def make_alphafold_template_bundles(
+        index_and_targetl, # tuple from tcr_db.iterrows()
+        outdir,
+        num_runs,
+        exclude_self_peptide_docking_geometries=False,
+        alt_self_peptides_column=None,
+        exclude_pdbids_column=None,
+        targetid_prefix_suffix='',
+        use_opt_dgeoms=False,
+        num_targets=None, # just for logging
+        template_format=None, # None means don't write any files
+        **kwargs,
+):
+    ''' In-memory version of the setup for a single target, for the fused
+    setup+prediction pipeline in run_pipeline.py
+
+    if template_format is not None, the template files and alignfiles are also
+    written to outdir, just like setup_for_alphafold does
+
+    returns a list of "template bundles", one per run. Each is a dict with keys
+
+    targetl: row for the targets.tsv file (pd.Series)
+    templates: list of dicts, one per template, with keys template_sequence,
+       all_positions, all_positions_mask (from pdblite.pose_to_atom37),
+       target_to_template_alignment (dict), identities, template_len
+    '''
+    from .pdblite import pose_to_atom37
+
+    index, targetl = index_and_targetl
+    targetid_prefix = _get_targetid_prefix(index, targetl, targetid_prefix_suffix)
+    all_run_info = _make_target_templates(
+        index, targetl, outdir, targetid_prefix, num_runs,
+        exclude_self_peptide_docking_geometries, alt_self_peptides_column,
+        exclude_pdbids_column, use_opt_dgeoms, num_targets,
+        template_format=template_format, return_template_poses=True, **kwargs)
+    template_poses = all_run_info.template_pose
+    all_run_info = all_run_info.drop(columns='template_pose')
+    if template_format is None:
+        target_rows = [
+            _make_target_row(targetl, f'{targetid_prefix}_{run}',
+                             set(all_run_info[all_run_info.run==run].target_chainseq)
+                             .pop(), None)
+            for run in range(num_runs)]
+    else:
+        target_rows = _write_target_alignfiles(
+            targetl, outdir, targetid_prefix, num_runs, all_run_info)
+
+    bundles = []
+    for run, target_row in enumerate(target_rows):
+        info = all_run_info[all_run_info.run==run]
+        templates = []
+        for ind, l in info.iterrows():
+            positions, mask = pose_to_atom37(template_poses[ind])
+            templates.append(dict(
+                template_sequence = template_poses[ind].sequence,
+                all_positions = positions,
+                all_positions_mask = mask,
+                target_to_template_alignment = {
+                    int(x.split(':')[0]):int(x.split(':')[1])
+                    for x in l.target_to_template_alignstring.split(';')},
+                identities = l.identities,
+                template_len = l.template_len,
+            ))
+        bundles.append(dict(targetl=target_row, templates=templates))
+    print_template_pose_cache_stats()
+    return bundles
 
 
 def get_mhc_chain_trim_positions(chainseq, organism, mhc_class, mhc_allele, chain=None):
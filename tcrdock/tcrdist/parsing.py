@@ -5,14 +5,21 @@ import random
 from collections import OrderedDict, Counter
 import pandas as pd
 from .basic import path_to_db
-from os import system
-from os.path import exists
+from functools import partial
 from . import translation
-from .all_genes import all_genes, gap_character
+from .all_genes import all_genes, gap_character, db_file
 from .genetic_code import genetic_code, reverse_genetic_code
 from . import logo_tools
-from ..blast import (blast_sequence_and_read_hits, setup_query_to_hit_map,
-                     path_to_blast_executables)
+from ..blast import (blast_sequence_and_read_hits, blast_sequences_and_read_hits,
+                     setup_query_to_hit_map, ensure_blast_dbs)
+from . import vj_align
+from .. import cache
+import copy
+import os
+
+# how to find the V and J genes in parse_tcr_sequence: 'blast' (run blastp) or
+# 'numpy' (the in-process Smith-Waterman aligner in vj_align.py)
+vj_aligner = os.environ.get('TCRDOCK_VJ_ALIGNER', 'blast')
 
 def get_blast_db_path(organism, ab, vj):
     ''' This is the protein sequence db
@@ -62,26 +69,25 @@ def get_core_positions_0x(organism, v_gene):
         core_positions_0x.append(pos - alseq[:pos].count(gap_character))
     return core_positions_0x
 
-def make_blast_dbs():
-    makeblastdb_exe = str(path_to_blast_executables / 'makeblastdb')
+def _write_blast_db_fasta(organism, ab, vj, filename):
+    with open(filename, 'w') as out:
+        for id, g in all_genes[organism].items():
+            if g.chain == ab and g.region == vj:
+                out.write(f'>{id}\n{g.protseq}\n')
+
+def _check_for_blast_dbs(organism, chain, force=False):
+    for vj in 'VJ':
+        ensure_blast_dbs(
+            get_blast_db_path(organism, chain, vj),
+            write_fasta=partial(_write_blast_db_fasta, organism, chain, vj),
+            force=force)
 
-    # protein sequences
+def make_blast_dbs(force=False):
+    ''' Make all the V and J protein blast dbs (if they aren't already there)
+    '''
     for organism in all_genes:
         for ab in 'AB':
-            for vj in 'VJ':
-                pname = get_blast_db_path(organism, ab, vj)
-                out = open(pname, 'w')
-                for id, g in all_genes[organism].items():
-                    if g.chain == ab and g.region == vj:
-                        out.write(f'>{id}\n{g.protseq}\n')
-                out.close()
-                print('made:', pname)
-
-                # format the db
-                cmd = f'{makeblastdb_exe} -in {pname} -dbtype prot'
-                print(cmd)
-                system(cmd)
-
+            _check_for_blast_dbs(organism, ab, force)
 
 
 
@@ -199,22 +205,75 @@ def parse_tcr_sequence(organism, chain, sequence):
 
     returns None upon parse failure
 
+    results are cached on disk (see tcrdock/cache.py), since this means 2 BLAST runs
+
+    '''
+    assert chain in 'AB'
+
+    key = _parse_tcr_sequence_key(organism, chain, sequence)
+    result = cache.sqlite_load_cached('parse_tcr_sequence', key)
+    if result is cache.MISSING:
+        result = _parse_tcr_sequence(organism, chain, sequence)
+        cache.sqlite_save_cached('parse_tcr_sequence', key, result)
+    return copy.deepcopy(result)
+
+def _parse_tcr_sequence_key(organism, chain, sequence):
+    return cache.make_key(organism, chain, sequence, cache.db_fingerprint(db_file),
+                          vj_aligner)
+
+def parse_tcr_sequences(organism, chain, sequences, num_threads=1):
+    ''' batched version of parse_tcr_sequence: one BLAST run against the V db and
+    one against the J db for all the uncached sequences (with vj_aligner='numpy'
+    there's no BLAST, so this is just a loop)
+
+    returns list of results (and saves them in the cache)
     '''
     assert chain in 'AB'
+    todo = [seq for seq in sequences
+            if cache.sqlite_load_cached(
+                'parse_tcr_sequence', _parse_tcr_sequence_key(organism, chain, seq))
+            is cache.MISSING]
+    if todo and vj_aligner == 'blast':
+        _check_for_blast_dbs(organism, chain)
+        all_hits = {vj:blast_sequences_and_read_hits(
+            todo, get_blast_db_path(organism, chain, vj), num_threads=num_threads)
+                    for vj in 'VJ'}
+        for seq in dict.fromkeys(todo):
+            result = _parse_tcr_sequence(
+                organism, chain, seq, {vj:all_hits[vj][seq] for vj in 'VJ'})
+            cache.sqlite_save_cached(
+                'parse_tcr_sequence', _parse_tcr_sequence_key(organism, chain, seq),
+                result)
+    return [parse_tcr_sequence(organism, chain, seq) for seq in sequences]
+
+def _parse_tcr_sequence(organism, chain, sequence, hits_by_vj=None):
+    ''' hits_by_vj (optional) is a dict {'V':hits, 'J':hits} of BLAST hits for
+    sequence, e.g. from a batched BLAST run
+    '''
+    if hits_by_vj is None and vj_aligner == 'numpy':
+        top_hits = [vj_align.get_top_hit(organism, chain, vj, sequence)
+                    for vj in 'VJ']
+        return _parse_tcr_sequence_from_top_hits(
+            organism, chain, sequence, [x for x in top_hits if x is not None])
 
-    tmpdbfile = get_blast_db_path(organism, chain, 'V')
-    if not exists(tmpdbfile):
-        make_blast_dbs() # only need to do this once
-        assert exists(tmpdbfile)
+    assert vj_aligner == 'blast' or hits_by_vj is not None
+    if hits_by_vj is None:
+        _check_for_blast_dbs(organism, chain)
 
     top_hits = []
     for vj in 'VJ':
-        dbfile = get_blast_db_path(organism, chain, vj)
-        hits = blast_sequence_and_read_hits(sequence, dbfile)
+        if hits_by_vj is None:
+            dbfile = get_blast_db_path(organism, chain, vj)
+            hits = blast_sequence_and_read_hits(sequence, dbfile)
+        else:
+            hits = hits_by_vj[vj]
 
         if hits.shape[0]:
             top_hits.append(get_top_blast_hit_with_allele_sorting(hits))
 
+    return _parse_tcr_sequence_from_top_hits(organism, chain, sequence, top_hits)
+
+def _parse_tcr_sequence_from_top_hits(organism, chain, sequence, top_hits):
     if len(top_hits) == 2:
         v_hit, j_hit = top_hits
 
@@ -260,3 +319,43 @@ def parse_tcr_sequence(organism, chain, sequence):
     else:
         print('failed to find v and j matches')
         return None
+
+
+def check_vj_aligner_against_blast(organism, chain, sequences, verbose=True):
+    ''' Compare the V and J top hits from vj_align.get_top_hit to the BLAST
+    top hits (as chosen by get_top_blast_hit_with_allele_sorting)
+
+    returns a DataFrame with one row per (sequence, V/J), with columns
+    'same_gene' and 'same_alignment' (the query-to-gene position maps agree)
+    '''
+    _check_for_blast_dbs(organism, chain)
+    dfl = []
+    for sequence in sequences:
+        for vj in 'VJ':
+            hits = blast_sequence_and_read_hits(
+                sequence, get_blast_db_path(organism, chain, vj))
+            blast_hit = (get_top_blast_hit_with_allele_sorting(hits)
+                         if hits.shape[0] else None)
+            sw_hit = vj_align.get_top_hit(organism, chain, vj, sequence)
+            blast_gene = None if blast_hit is None else blast_hit.saccver
+            sw_gene = None if sw_hit is None else sw_hit.saccver
+            same_alignment = blast_gene == sw_gene and (
+                blast_hit is None or
+                setup_query_to_hit_map(blast_hit) == setup_query_to_hit_map(sw_hit))
+            dfl.append(dict(
+                organism=organism, chain=chain, vj=vj, sequence=sequence,
+                blast_gene=blast_gene, sw_gene=sw_gene,
+                blast_bitscore=None if blast_hit is None else blast_hit.bitscore,
+                sw_bitscore=None if sw_hit is None else sw_hit.bitscore,
+                same_gene=blast_gene == sw_gene,
+                same_alignment=same_alignment,
+            ))
+            if verbose and not same_alignment:
+                print('check_vj_aligner_against_blast: mismatch', organism, chain,
+                      vj, blast_gene, sw_gene, sequence)
+    results = pd.DataFrame(dfl)
+    if verbose:
+        print('check_vj_aligner_against_blast: num_checks=', results.shape[0],
+              'same_gene=', results.same_gene.sum(),
+              'same_alignment=', results.same_alignment.sum())
+    return results
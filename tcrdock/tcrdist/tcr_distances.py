@@ -1,4 +1,5 @@
 from .basic import *
+import numpy as np
 from .all_genes import all_genes, gap_character
 from .amino_acids import amino_acids
 from .tcr_distances_blosum import blosum, bsd4
@@ -160,6 +161,69 @@ def weighted_cdr3_distance( seq1, seq2 ):
     ##
     return  WEIGHT_CDR3_REGION * best_dist + lendiff * GAP_PENALTY_CDR3_REGION
 
+_distance_matrix_array = None
+def _get_distance_matrix_array():
+    ''' DISTANCE_MATRIX as a 256x256 array indexed by ascii codes; nan for missing
+    '''
+    global _distance_matrix_array
+    if _distance_matrix_array is None:
+        _distance_matrix_array = np.full((256,256), np.nan)
+        for (a,b),d in DISTANCE_MATRIX.items():
+            _distance_matrix_array[ord(a),ord(b)] = d
+    return _distance_matrix_array
+
+def _encode_cdr3s( seqs, maxlen ):
+    ''' returns uint8 arrays (front-aligned, back-aligned), padded with 0s
+    '''
+    front = np.zeros((len(seqs), maxlen), dtype=np.uint8)
+    back = np.zeros((len(seqs), maxlen), dtype=np.uint8)
+    for i,seq in enumerate(seqs):
+        codes = np.frombuffer(seq.encode(), dtype=np.uint8)
+        front[i,:len(seq)] = codes
+        back[i,:len(seq)] = codes[::-1]
+    return front, back
+
+def weighted_cdr3_distance_matrix( seqs1, seqs2 ):
+    ''' numpy version of weighted_cdr3_distance for all pairs of seqs1 and seqs2
+
+    returns array D of shape (len(seqs1), len(seqs2)) with
+    D[i,j] = weighted_cdr3_distance(seqs1[i], seqs2[j])
+    '''
+    if ALIGN_CDR3S: # not vectorized
+        return np.array([[weighted_cdr3_distance(a,b) for b in seqs2] for a in seqs1])
+
+    ntrim = 3 if TRIM_CDR3S else 0
+    ctrim = 2 if TRIM_CDR3S else 0
+
+    lens1 = np.array([len(x) for x in seqs1], dtype=int)
+    lens2 = np.array([len(x) for x in seqs2], dtype=int)
+    if not len(lens1) or not len(lens2):
+        return np.zeros((len(lens1), len(lens2)))
+    maxlen = max(lens1.max(), lens2.max())
+    front1, back1 = _encode_cdr3s(seqs1, maxlen)
+    front2, back2 = _encode_cdr3s(seqs2, maxlen)
+
+    lenshort = np.minimum(lens1[:,None], lens2[None,:])
+    assert lenshort.min() > 1
+    if TRIM_CDR3S:
+        assert lenshort.min() >= 3+2
+    gappos = np.minimum( 6, 3 + (lenshort-5)//2 ) # see weighted_cdr3_distance
+    remainder = lenshort - gappos
+
+    # the alignment only depends on the length of the shorter sequence: the first
+    # gappos positions are aligned from the N-terminus, the rest from the C-terminus
+    pos = np.arange(maxlen)
+    front_mask = (pos >= ntrim) & (pos < gappos[:,:,None])
+    back_mask = (pos >= ctrim) & (pos < remainder[:,:,None])
+
+    dmat = _get_distance_matrix_array()
+    dists = (np.where(front_mask, dmat[front1[:,None,:], front2[None,:,:]], 0.).sum(2) +
+             np.where(back_mask, dmat[back1[:,None,:], back2[None,:,:]], 0.).sum(2))
+    assert not np.isnan(dists).any() # unrecognized amino acid
+
+    lendiff = np.abs(lens1[:,None] - lens2[None,:])
+    return WEIGHT_CDR3_REGION * dists + lendiff * GAP_PENALTY_CDR3_REGION
+
 def compute_all_v_region_distances( organism ):
     rep_dists = {}
     for chain in 'AB': # don't compute inter-chain distances
@@ -251,6 +315,31 @@ class TcrDistCalculator:
         '''
         return self.rep_dists[chain1[0]][chain2[0]] + weighted_cdr3_distance(chain1[2], chain2[2])
 
+    def distance_matrix(self, tcrs1, tcrs2, chains='AB'):
+        ''' vectorized version of __call__ (chains='AB') or single_chain_distance
+        (chains='A' or 'B')
+
+        tcrs1 and tcrs2 are lists of paired tcrs, in the same format as for __call__
+
+        returns numpy array D of shape (len(tcrs1), len(tcrs2)), where D[i,j] is the
+        distance between tcrs1[i] and tcrs2[j]
+        '''
+        if not hasattr(self, 'v_genes'): # set up the V-region distance array
+            self.v_genes = {x:i for i,x in enumerate(self.rep_dists)}
+            self.v_dists = np.array([[self.rep_dists[x].get(y, np.nan)
+                                      for y in self.v_genes] for x in self.v_genes])
+
+        dists = np.zeros((len(tcrs1), len(tcrs2)))
+        for ich, chain in enumerate('AB'):
+            if chain not in chains:
+                continue
+            vinds1 = [self.v_genes[x[ich][0]] for x in tcrs1]
+            vinds2 = [self.v_genes[x[ich][0]] for x in tcrs2]
+            dists += self.v_dists[np.ix_(vinds1, vinds2)]
+            dists += weighted_cdr3_distance_matrix(
+                [x[ich][2] for x in tcrs1], [x[ich][2] for x in tcrs2])
+        return dists
+
 
 
 
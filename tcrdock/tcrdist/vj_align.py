@@ -0,0 +1,212 @@
+######################################################################################88
+''' In-process alternative to the blastp runs in parsing.parse_tcr_sequence
+
+The V and J protein "databases" are tiny (a few hundred sequences per organism and
+chain), so rather than forking blastp twice per chain we can Smith-Waterman align
+the query against all the genes at once with numpy, using blastp's default scoring
+(BLOSUM62, gap existence 11, gap extension 1).
+
+The DP loops over gene positions and is vectorized over genes and query positions.
+Gaps in the gene direction come from a running max (np.maximum.accumulate) down
+the column, which is OK for affine gaps since opening a new gap right after a gap
+is never better than extending it.
+
+get_top_hit returns something that looks like a row of the
+blast.blast_sequence_and_read_hits output (saccver, bitscore, qstart, qseq, sstart,
+sseq, ...) so it can be passed to blast.setup_query_to_hit_map. Ties are broken
+the same way as parsing.get_top_blast_hit_with_allele_sorting (lowest allele
+number).
+
+This is not exactly blastp: there's no composition-based score adjustment and no
+seeding heuristics, and the evalue is the simple m*n*2^-bitscore estimate, so
+see parsing.check_vj_aligner_against_blast for comparing the two.
+'''
+import re
+import math
+import numpy as np
+import pandas as pd
+from Bio.Align import substitution_matrices
+
+from .all_genes import all_genes
+
+gap_open = 11 # blastp defaults for BLOSUM62
+gap_extend = 1
+lambda_gapped, K_gapped = 0.267, 0.041 # for BLOSUM62 11/1, as in blast
+
+_NEG = -10**6 # "minus infinity" that won't overflow int32
+
+_score_table = None
+_char2index = None
+def _get_score_table():
+    ''' BLOSUM62 as an int32 array, plus an extra row/column for padding the gene
+    sequences (scores very badly against everything)
+    '''
+    global _score_table, _char2index
+    if _score_table is None:
+        matrix = substitution_matrices.load('BLOSUM62')
+        alphabet = matrix.alphabet
+        n = len(alphabet)
+        _score_table = np.full((n+1, n+1), -1000, dtype=np.int32)
+        _score_table[:n,:n] = np.array(matrix, dtype=np.int32)
+        _char2index = np.full(256, alphabet.index('X'), dtype=np.int32)
+        for i, a in enumerate(alphabet):
+            _char2index[ord(a)] = i
+    return _score_table, _char2index
+
+
+def _encode(seq):
+    _, char2index = _get_score_table()
+    return char2index[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+
+_gene_dbs = {}
+def get_gene_db(organism, chain, vj):
+    ''' returns (ids, protseqs, padded gene index array (num_genes,maxlen), db_size)
+
+    same genes as in parsing.get_blast_db_path(organism, chain, vj)
+    '''
+    dbkey = (organism, chain, vj)
+    if dbkey not in _gene_dbs:
+        score_table, _ = _get_score_table()
+        pad = score_table.shape[0]-1
+        ids = [id for id, g in all_genes[organism].items()
+               if g.chain == chain and g.region == vj]
+        protseqs = [all_genes[organism][id].protseq for id in ids]
+        maxlen = max(len(x) for x in protseqs)
+        genes = np.full((len(ids), maxlen), pad, dtype=np.int32)
+        for ii, seq in enumerate(protseqs):
+            genes[ii,:len(seq)] = _encode(seq)
+        db_size = sum(len(x) for x in protseqs)
+        _gene_dbs[dbkey] = (ids, protseqs, genes, db_size)
+    return _gene_dbs[dbkey]
+
+
+def _smith_waterman(qidx, genes, keep_matrices=False):
+    ''' qidx is the encoded query (L,), genes is (G,N)
+
+    returns best local alignment score for each gene, shape (G,)
+
+    if keep_matrices, also returns the H, E, F matrices, shape (G,L+1,N+1)
+    (E: gap in the query, F: gap in the gene)
+    '''
+    score_table, _ = _get_score_table()
+    G, N = genes.shape
+    L = qidx.shape[0]
+    profile = score_table[:, qidx] # (alphabet+1, L)
+    offsets = np.arange(L+1, dtype=np.int32) * gap_extend
+    opening = gap_open + gap_extend
+
+    H_prev = np.zeros((G, L+1), dtype=np.int32)
+    E = np.full((G, L+1), _NEG, dtype=np.int32)
+    best = np.zeros(G, dtype=np.int32)
+    if keep_matrices:
+        Hs, Es, Fs = [H_prev], [E], [np.full((G, L+1), _NEG, dtype=np.int32)]
+
+    for j in range(N):
+        E = np.maximum(H_prev - opening, E - gap_extend)
+        H = np.zeros((G, L+1), dtype=np.int32)
+        H[:,1:] = np.maximum(H_prev[:,:-1] + profile[genes[:,j]], 0)
+        np.maximum(H, E, out=H)
+        # F[i] = max over k<i of H[k] - gap_open - (i-k)*gap_extend
+        runmax = np.maximum.accumulate(H + offsets, axis=1)
+        F = np.full((G, L+1), _NEG, dtype=np.int32)
+        F[:,1:] = runmax[:,:-1] - gap_open - offsets[1:]
+        np.maximum(H, F, out=H)
+        np.maximum(best, H.max(axis=1), out=best)
+        H_prev = H
+        if keep_matrices:
+            Hs.append(H)
+            Es.append(E)
+            Fs.append(F)
+
+    if keep_matrices:
+        return best, [np.stack(x, axis=2) for x in [Hs, Es, Fs]]
+    return best
+
+
+def _traceback(qseq, sseq, H, E, F):
+    ''' H, E, F are (L+1,N+1) for the single gene sseq
+
+    returns qstart, sstart (1-indexed), qalign, salign (with '-' for gaps)
+    '''
+    score_table, _ = _get_score_table()
+    qidx, sidx = _encode(qseq), _encode(sseq)
+    opening = gap_open + gap_extend
+    i, j = np.unravel_index(np.argmax(H), H.shape) # first max cell
+    i, j = int(i), int(j)
+    qal, sal = [], []
+    state = 'H'
+    while True:
+        if state == 'H':
+            h = H[i,j]
+            if i and j and h == H[i-1,j-1] + score_table[qidx[i-1], sidx[j-1]]:
+                qal.append(qseq[i-1])
+                sal.append(sseq[j-1])
+                i, j = i-1, j-1
+                if H[i,j] == 0:
+                    break
+            elif h == E[i,j]:
+                state = 'E'
+            else:
+                assert h == F[i,j]
+                state = 'F'
+        elif state == 'E':
+            qal.append('-')
+            sal.append(sseq[j-1])
+            if E[i,j] == H[i,j-1] - opening:
+                state = 'H'
+            j -= 1
+        else:
+            qal.append(qseq[i-1])
+            sal.append('-')
+            if F[i,j] == H[i-1,j] - opening:
+                state = 'H'
+            i -= 1
+    return i+1, j+1, ''.join(reversed(qal)), ''.join(reversed(sal))
+
+
+def get_top_hit(organism, chain, vj, sequence, evalue=1e-3):
+    ''' returns a pd.Series that looks like a row of blast hits, or None if no
+    gene aligns with an evalue <= evalue
+
+    ties (equal raw score) go to the lowest allele number, then to the first gene
+    in the db
+    '''
+    ids, protseqs, genes, db_size = get_gene_db(organism, chain, vj)
+    qidx = _encode(sequence)
+    scores = _smith_waterman(qidx, genes)
+
+    bitscores = (lambda_gapped * scores - math.log(K_gapped))/math.log(2)
+    evalues = len(sequence) * db_size * np.power(2.0, -bitscores)
+    ok = evalues <= evalue
+    if not ok.any():
+        return None
+    top_score = scores[ok].max()
+    ties = np.nonzero(ok & (scores == top_score))[0]
+    ind = min(ties, key=lambda x:(int(ids[x].split('*')[-1]), x))
+
+    sseq = protseqs[ind]
+    _, (H, E, F) = _smith_waterman(qidx, genes[ind:ind+1,:len(sseq)],
+                                   keep_matrices=True)
+    qstart, sstart, qal, sal = _traceback(sequence, sseq, H[0], E[0], F[0])
+    length = len(qal)
+    identities = sum(a==b for a,b in zip(qal, sal))
+    return pd.Series(dict(
+        evalue = evalues[ind],
+        bitscore = round(bitscores[ind], 1),
+        qaccver = 'tmp',
+        saccver = ids[ind],
+        pident = round(100.0 * identities / length, 3),
+        length = length,
+        mismatch = sum(a!=b and '-' not in (a,b) for a,b in zip(qal, sal)),
+        gapopen = sum(len(re.findall('-+', x)) for x in [qal, sal]),
+        qstart = qstart,
+        qend = qstart + len(qal) - qal.count('-') - 1,
+        qlen = len(sequence),
+        qseq = qal,
+        sstart = sstart,
+        send = sstart + len(sal) - sal.count('-') - 1,
+        slen = len(sseq),
+        sseq = sal,
+        score = int(scores[ind]),
+    ))
@@ -176,3 +176,29 @@ class TCRdockInfo():
     def from_string(self, info):
         return self.from_dict(json.loads(info))
 
+
+
+def prefetch_sequence_annotations(
+        organism,
+        mhc_class, # None if tcr_only
+        sequences, # list of (mhc_aseq, mhc_bseq, tcr_aseq, tcr_bseq) tuples
+        num_threads=1,
+):
+    ''' For bulk parsing: run the BLAST searches needed by
+    TCRdockInfo.from_sequences for many complexes at once (one multi-query blastp
+    run per database, instead of ~6 blastp runs per complex), and save the results
+    in the cache (see cache.py), so the from_sequences calls afterward don't run
+    BLAST at all.
+
+    mhc_bseq is ignored for class 1 (pass None or '')
+    '''
+    if mhc_class == 1:
+        mhc_util.get_mhc_alleles([x[0] for x in sequences], organism, num_threads)
+    elif mhc_class == 2:
+        mhc_util.get_mhc_core_positions_class2_batch(
+            [(x[0], x[1]) for x in sequences], num_threads)
+        mhc_util.get_mhc_alleles([x[0] for x in sequences]+[x[1] for x in sequences],
+                                 organism, num_threads)
+    for ii, chain in zip([2,3], 'AB'):
+        tcrdist.parsing.parse_tcr_sequences(
+            organism, chain, [x[ii] for x in sequences], num_threads)
@@ -0,0 +1,195 @@
+######################################################################################88
+''' Precompiled binary store for the template pdbs under tcrdock/db/pdb
+
+Parsing the ~1500 template pdbfiles (plus their .tcrdock_info.json files) is a big
+part of the setup time. build_template_db() parses them all once and writes the
+coordinates, sequences, and chain info into a handful of flat .npy arrays plus a
+small json index; these are opened with mmap_mode='r' so loading a template is
+just slicing, and forked worker processes share the pages.
+
+Build it with the build_template_db.py script (or by calling build_template_db).
+If it hasn't been built, get_template_pose_and_tdinfo falls back to reading the
+pdbfiles.
+
+arrays:
+  atom_xyz         float64 (num_atoms,3)
+  atom_names       S4      (num_atoms,)  with the PDB whitespace, e.g. ' CA '
+  res_atom_bounds  int64   (num_res+1,)  atoms for residue i: [b[i], b[i+1])
+  res_chains       S1      (num_res,)
+  res_resids       S5      (num_res,)    the pdb resid: line[22:27]
+  res_name1s       S1      (num_res,)
+  tmpl_res_bounds  int64   (num_templates+1,)
+
+index.json has the version, the list of pdbfiles (relative to path_to_db, as in
+the *_templates_v2.tsv files), the tcrdock_info json strings, and a fingerprint of
+the source files (see get_template_source_fingerprint). If the template files
+change after the store was built, get_template_db notices the fingerprint
+mismatch and returns None (so the pdbfiles are read instead) until it's rebuilt.
+'''
+import os
+import json
+import hashlib
+import shutil
+from os.path import exists
+import numpy as np
+import pandas as pd
+
+from .util import path_to_db
+from . import pdblite
+from .tcrdock_info import TCRdockInfo
+
+TEMPLATE_DB_VERSION = 1
+
+path_to_template_db = path_to_db / f'template_db_v{TEMPLATE_DB_VERSION}'
+
+_array_names = ('atom_xyz atom_names res_atom_bounds res_chains res_resids '
+                'res_name1s tmpl_res_bounds'.split())
+
+def get_all_template_pdbfiles():
+    ''' sorted list of the pdbfiles (relative to path_to_db) in the template info
+    '''
+    pdbfiles = set()
+    for tag in ['tcr', 'pmhc', 'ternary']:
+        info = pd.read_table(path_to_db / f'{tag}_templates_v2.tsv')
+        pdbfiles.update(info.pdbfile)
+    return sorted(pdbfiles)
+
+
+def get_template_source_fingerprint(pdbfiles=None):
+    ''' md5 of the contents of the *_templates_v2.tsv files plus the sizes and
+    mtimes of all the template pdbfiles and their .tcrdock_info.json files
+    '''
+    if pdbfiles is None:
+        pdbfiles = get_all_template_pdbfiles()
+    md5 = hashlib.md5()
+    for tag in ['tcr', 'pmhc', 'ternary']:
+        with open(path_to_db / f'{tag}_templates_v2.tsv', 'rb') as data:
+            md5.update(data.read())
+    for pdbfile in pdbfiles:
+        fullpath = str(path_to_db) + '/' + pdbfile
+        for filename in [fullpath, fullpath+'.tcrdock_info.json']:
+            stat = os.stat(filename)
+            md5.update(f'{pdbfile} {stat.st_size} {stat.st_mtime_ns}\n'.encode())
+    return md5.hexdigest()
+
+
+def build_template_db(outdir=path_to_template_db, verbose=False):
+    ''' parse all the template pdbfiles and write the binary store to outdir
+
+    writes to a temporary dir first and then renames, so a half-built store is
+    never picked up
+    '''
+    pdbfiles = get_all_template_pdbfiles()
+    print('build_template_db: num_pdbfiles=', len(pdbfiles))
+
+    all_xyz, all_names = [], []
+    res_atom_counts, res_chains, res_resids, res_name1s = [], [], [], []
+    tmpl_res_counts, tdinfos = [], []
+    for ii, pdbfile in enumerate(pdbfiles):
+        if verbose or ii%100==0:
+            print('build_template_db:', ii, pdbfile, flush=True)
+        fullpath = str(path_to_db) + '/' + pdbfile
+        pose = pdblite.pose_from_pdb(fullpath)
+        with open(fullpath+'.tcrdock_info.json', 'r') as data:
+            tdinfos.append(TCRdockInfo().from_string(data.read()).to_string())
+
+        all_xyz.append(pose.xyz)
+        all_names.append(pose.atom_names)
+        res_atom_counts.append(np.diff(pose.res_atom_bounds))
+        res_chains.extend(r[0] for r in pose.resids)
+        res_resids.extend(r[1] for r in pose.resids)
+        res_name1s.extend(pose.sequence)
+        tmpl_res_counts.append(len(pose.resids))
+
+    arrays = dict(
+        atom_xyz = np.concatenate(all_xyz).astype(np.float64),
+        atom_names = np.concatenate(all_names).astype('S4'),
+        res_atom_bounds = np.concatenate([[0]]+res_atom_counts).cumsum().astype(
+            np.int64),
+        res_chains = np.array(res_chains, dtype='S1'),
+        res_resids = np.array(res_resids, dtype='S5'),
+        res_name1s = np.array(res_name1s, dtype='S1'),
+        tmpl_res_bounds = np.cumsum([0]+tmpl_res_counts, dtype=np.int64),
+    )
+
+    outdir = str(outdir)
+    tmpdir = outdir+'.tmp'
+    if exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.mkdir(tmpdir)
+    for name in _array_names:
+        np.save(f'{tmpdir}/{name}.npy', arrays[name])
+    index = {'version':TEMPLATE_DB_VERSION, 'pdbfiles':pdbfiles, 'tdinfos':tdinfos,
+             'source_fingerprint':get_template_source_fingerprint(pdbfiles)}
+    with open(f'{tmpdir}/index.json', 'w') as out:
+        json.dump(index, out)
+    if exists(outdir):
+        shutil.rmtree(outdir)
+    os.rename(tmpdir, outdir)
+    print('made:', outdir, 'num_templates=', len(pdbfiles),
+          'num_atoms=', arrays['atom_xyz'].shape[0])
+
+
+class TemplateDB():
+    ''' read-only, memory-mapped view of the binary store made by build_template_db
+    '''
+    def __init__(self, dbdir=path_to_template_db):
+        dbdir = str(dbdir)
+        with open(dbdir+'/index.json', 'r') as data:
+            index = json.load(data)
+        assert index['version'] == TEMPLATE_DB_VERSION
+        self.pdbfiles = index['pdbfiles']
+        self.source_fingerprint = index.get('source_fingerprint') # None: old store
+        self.tdinfos = index['tdinfos']
+        self.pdbfile2index = {x:i for i,x in enumerate(self.pdbfiles)}
+        for name in _array_names:
+            setattr(self, name, np.load(f'{dbdir}/{name}.npy', mmap_mode='r'))
+
+    def __contains__(self, pdbfile):
+        return pdbfile in self.pdbfile2index
+
+    def load_pose_and_tdinfo(self, pdbfile):
+        ''' pdbfile should be relative to path_to_db, as in the info tsv files
+
+        returns pose, tdinfo -- pose is the same as pdblite.pose_from_pdb would give
+        '''
+        ind = self.pdbfile2index[pdbfile]
+        rstart, rstop = self.tmpl_res_bounds[ind:ind+2]
+        res_atom_bounds = self.res_atom_bounds[rstart:rstop+1]
+        astart, astop = res_atom_bounds[0], res_atom_bounds[-1]
+        res_atom_bounds = res_atom_bounds - astart
+
+        # copy out of the memmap, just this template
+        xyz = np.array(self.atom_xyz[astart:astop])
+        names = self.atom_names[astart:astop].astype('U4')
+        chains = self.res_chains[rstart:rstop].astype(str).tolist()
+        resids = list(zip(chains, self.res_resids[rstart:rstop].astype(str).tolist()))
+        sequence = ''.join(self.res_name1s[rstart:rstop].astype(str).tolist())
+
+        pose = pdblite.Pose(xyz, names, res_atom_bounds, resids, sequence)
+        tdinfo = TCRdockInfo().from_string(self.tdinfos[ind])
+        return pose, tdinfo
+
+
+def template_db_is_current(tdb):
+    return tdb.source_fingerprint == get_template_source_fingerprint()
+
+
+_template_db = None
+_template_db_checked = False
+def get_template_db():
+    ''' returns the TemplateDB, or None if it hasn't been built or is out of date
+    with respect to the template files
+    '''
+    global _template_db, _template_db_checked
+    if not _template_db_checked:
+        _template_db_checked = True
+        if exists(path_to_template_db / 'index.json'):
+            tdb = TemplateDB()
+            if template_db_is_current(tdb):
+                _template_db = tdb
+            else:
+                print('WARNING: the template files have changed since the template '
+                      'db was built, reading the pdbfiles instead. Rebuild it by '
+                      'running build_template_db.py:', path_to_template_db)
+    return _template_db
@@ -5,6 +5,9 @@ import os.path
 from os import system, popen
 from os.path import exists
 from pathlib import Path
+import multiprocessing
+import queue as queue_module
+import traceback
 import numpy as np
 
 path_to_tcrdock = Path(__file__).parent
@@ -58,6 +61,84 @@ def read_fields(filename):
     return pd.read_csv(filename, sep='\s+', names = names, usecols=usecols)
 
 
+def _imap_worker(func, tasks, results, worker):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        i, item = task
+        try:
+            results.put((worker, i, func(item), None))
+        except Exception:
+            results.put((worker, i, None, traceback.format_exc()))
+    results.put((worker, None, None, None))
+
+
+def imap_in_workers(func, items, num_workers, poll_timeout=30):
+    ''' like multiprocessing.Pool.imap: yields func(item) for each of items, in
+    order, computed in num_workers forked processes (started on the first next())
+
+    a Pool replaces a worker that dies (exit(), OOM kill, signal) and the task it
+    was running is lost, so imap waits forever. Here the parent polls the results
+    queue every poll_timeout seconds and raises RuntimeError if a worker has died.
+    An exception in func is also re-raised in the parent as a RuntimeError, with
+    the worker traceback. Any workers still running are terminated when the
+    generator is closed (or garbage collected) before it finishes.
+    '''
+    items = list(items)
+    tasks, results = multiprocessing.Queue(), multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_imap_worker, daemon=True,
+                                       args=(func, tasks, results, worker))
+               for worker in range(num_workers)]
+    finished_workers = set()
+    pending = {} # i -> (worker, result, error), for results that came in early
+    next_i = 0
+    try:
+        for worker in workers:
+            worker.start()
+        for task in enumerate(items):
+            tasks.put(task)
+        for _ in workers:
+            tasks.put(None)
+
+        while len(finished_workers) < num_workers:
+            try:
+                worker, i, result, error = results.get(timeout=poll_timeout)
+            except queue_module.Empty:
+                # a worker's results are flushed to the queue before it exits, so
+                # once the queue is empty, a dead worker that didn't send its done
+                # message isn't coming back
+                dead = [(worker, process.exitcode)
+                        for worker, process in enumerate(workers)
+                        if worker not in finished_workers and not process.is_alive()]
+                if dead and results.empty():
+                    raise RuntimeError(
+                        f'imap_in_workers: worker {dead[0][0]} died with exitcode '
+                        f'{dead[0][1]}')
+                continue
+            if i is None:
+                finished_workers.add(worker)
+                continue
+            pending[i] = (worker, result, error)
+            while next_i in pending:
+                worker, result, error = pending.pop(next_i)
+                if error is not None:
+                    raise RuntimeError(f'imap_in_workers: worker {worker} failed '
+                                       f'on item {next_i}:\n{error}')
+                yield result
+                next_i += 1
+        if next_i < len(items):
+            raise RuntimeError(
+                f'imap_in_workers: no result for item {next_i}')
+    finally:
+        for worker in workers:
+            if worker.pid is None: # never started
+                continue
+            if worker.is_alive() and next_i < len(items):
+                worker.terminate()
+            worker.join()
+
+
 # from
 # https://stackoverflow.com/questions/47222585/matplotlib-generic-colormap-from-tab10
 # still not quite right for gray, and the bright_first option doesnt work...
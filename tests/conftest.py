@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# so the tests can import tcrdock (and the top-level scripts' modules) from a
+# source checkout
+sys.path.insert(0, str(Path(__file__).parents[1]))
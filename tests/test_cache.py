@@ -0,0 +1,63 @@
+''' Checks for the in-memory LRUCache
+'''
+import pytest
+
+try:
+    import tcrdock
+except AssertionError as e: # BLAST hasn't been downloaded
+    pytest.skip(str(e), allow_module_level=True)
+
+from tcrdock.cache import LRUCache
+
+
+def test_lru_eviction_order():
+    cache = LRUCache(30, len)
+    cache.put('a', 'x'*10)
+    cache.put('b', 'x'*10)
+    cache.put('c', 'x'*10)
+    assert cache.get('a') == 'x'*10 # now 'b' is the least recently used
+    cache.put('d', 'x'*10)
+    assert 'b' not in cache
+    assert all(key in cache for key in 'acd')
+    assert cache.get('b') is None
+
+
+def test_lru_stays_under_max_bytes():
+    cache = LRUCache(100, len)
+    for i in range(50):
+        cache.put(i, 'x'*(7 + i%13))
+        assert cache.nbytes <= 100
+        assert cache.nbytes == sum(len(cache.get(key)) for key in list(cache._data))
+    cache.set_max_bytes(40)
+    assert cache.nbytes <= 40
+
+    # a value that's too big by itself is still kept, on its own
+    cache.put('big', 'x'*500)
+    assert len(cache) == 1 and cache.nbytes == 500
+
+
+def test_lru_replace_value():
+    cache = LRUCache(None, len)
+    cache.put('a', 'x'*10)
+    cache.put('a', 'x'*3)
+    assert len(cache) == 1 and cache.nbytes == 3
+
+
+def test_lru_stats():
+    cache = LRUCache(20, len)
+    cache.put('a', 'x'*10)
+    cache.put('b', 'x'*10)
+    cache.get('a')
+    cache.get('a')
+    cache.get('c')
+    cache.put('c', 'x'*10) # evicts 'b'
+    stats = cache.stats()
+    assert stats['entries'] == 2
+    assert stats['nbytes'] == 20
+    assert stats['max_nbytes_seen'] == 30
+    assert stats['max_bytes'] == 20
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 1, 1)
+    assert stats['hit_rate'] == pytest.approx(2/3)
+
+    cache.clear()
+    assert len(cache) == 0 and cache.stats()['nbytes'] == 0
@@ -0,0 +1,55 @@
+''' Checks for the array-based Pose against the old-style dict poses
+'''
+from pathlib import Path
+import numpy as np
+import pytest
+
+try:
+    import tcrdock
+except AssertionError as e: # BLAST hasn't been downloaded
+    pytest.skip(str(e), allow_module_level=True)
+
+from tcrdock import pdblite
+
+pdbfile = Path(__file__).parents[1] / 'examples/parsing/1qsf.pdb'
+
+
+@pytest.fixture(scope='module')
+def pose():
+    return pdblite.pose_from_pdb(str(pdbfile))
+
+
+def assert_same_pose(pose1, pose2):
+    assert np.array_equal(pose1.xyz, pose2.xyz)
+    assert np.array_equal(pose1.atom_names, pose2.atom_names)
+    assert np.array_equal(pose1.res_atom_bounds, pose2.res_atom_bounds)
+    assert pose1.resids == pose2.resids
+    assert pose1.sequence == pose2.sequence
+
+
+def test_dict_round_trip(pose):
+    dict_pose = pose.to_dict()
+    assert isinstance(dict_pose, dict)
+    assert_same_pose(pdblite.Pose.from_dict(dict_pose), pose)
+    assert_same_pose(pdblite.to_pose(dict_pose), pose)
+
+
+def test_dict_pose_matches_mapping(pose):
+    dict_pose = pose.to_dict()
+    assert set(dict_pose.keys()) == set(pose.keys())
+    for key in ['resids', 'sequence', 'chains', 'chainseq', 'chainbounds']:
+        assert list(dict_pose[key]) == list(pose[key]), key
+    assert np.array_equal(dict_pose['ca_coords'], pose['ca_coords'])
+    for r in pose['resids'][::10]:
+        assert list(dict_pose['coords'][r]) == list(pose['coords'][r])
+        for atom, xyz in pose['coords'][r].items():
+            assert np.array_equal(dict_pose['coords'][r][atom], xyz)
+
+
+def test_to_dict_copies_coords(pose):
+    dict_pose = pose.to_dict()
+    r = pose['resids'][0]
+    dict_pose['coords'][r][' CA '] += 1.0
+    assert not np.array_equal(dict_pose['coords'][r][' CA '], pose['coords'][r][' CA '])
+    moved = pdblite.Pose.from_dict(dict_pose)
+    assert np.array_equal(moved['coords'][r][' CA '], pose['coords'][r][' CA ']+1.0)
@@ -0,0 +1,67 @@
+''' Checks for the batched sequtil helpers against the one-at-a-time versions
+'''
+import random
+import numpy as np
+import pandas as pd
+import pytest
+
+try:
+    import tcrdock
+except AssertionError as e: # BLAST hasn't been downloaded
+    pytest.skip(str(e), allow_module_level=True)
+
+from tcrdock import sequtil
+
+
+def random_peptides(num_peptides, seed=0):
+    ''' small alphabet, so there are plenty of near matches
+    '''
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACDEG') for _ in range(rng.randint(8, 15)))
+            for _ in range(num_peptides)]
+
+
+def test_count_peptide_mismatches_matrix():
+    peptides1 = random_peptides(40, seed=1)
+    peptides2 = random_peptides(30, seed=2) + peptides1[:5]
+    mismatches = sequtil.count_peptide_mismatches_matrix(peptides1, peptides2)
+    assert mismatches.shape == (len(peptides1), len(peptides2))
+    for i, a in enumerate(peptides1):
+        for j, b in enumerate(peptides2):
+            assert mismatches[i,j] == sequtil.count_peptide_mismatches(a, b), (a, b)
+
+
+def test_count_peptide_mismatches_matrix_empty():
+    assert sequtil.count_peptide_mismatches_matrix([], ['ACDEGACDE']).shape == (0,1)
+
+
+@pytest.mark.parametrize('len1,len2', [(9,9), (9,10), (8,13)])
+def test_count_peptide_mismatches_uint8(len1, len2):
+    peptides = random_peptides(200, seed=3)
+    short = [x for x in peptides if len(x) == len1][:10]
+    long = [x for x in peptides if len(x) == len2][:10]
+    mismatches = sequtil._count_peptide_mismatches_uint8(
+        sequtil.encode_seqs_uint8(short), sequtil.encode_seqs_uint8(long))
+    expected = [[sequtil.count_peptide_mismatches(a, b) for b in long]
+                for a in short]
+    assert np.array_equal(mismatches, expected)
+
+
+def test_get_duplicate_targets():
+    tcr = dict(organism='human', mhc_class=1, va='TRAV21*01', ja='TRAJ28*01',
+               cdr3a='CAVRPGGAGPFFVVF', vb='TRBV5-1*01', jb='TRBJ2-7*01',
+               cdr3b='CASSFNMATGQYF')
+    tcr_db = pd.DataFrame([
+        dict(tcr, mhc='A*01:01', peptide='ESDPIVAQY'),
+        dict(tcr, mhc='A*01:01:01', peptide='esdpivaqy '), # same as 0
+        dict(tcr, mhc='A*01:01', peptide='EVDPIGHLY'),
+        dict(tcr, mhc='A*01:01', peptide='ESDPIVAQY', cdr3b='CASSFNMATGQYW'),
+        dict(tcr, mhc='A*01:01', peptide='EVDPIGHLY'), # same as 2
+        dict(tcr, mhc='A*01:01', peptide='ESDPIVAQY'), # same as 0
+    ], index=[10,11,12,13,14,15])
+    assert sequtil.get_duplicate_targets(tcr_db, 3) == {11:10, 14:12, 15:10}
+
+    # the per-target filter columns are part of the key
+    tcr_db['exclude_pdbids'] = [None, None, None, None, '5bs0', '5bs0,1ao7']
+    assert sequtil.get_duplicate_targets(
+        tcr_db, 3, exclude_pdbids_column='exclude_pdbids') == {11:10}
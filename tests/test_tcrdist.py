@@ -0,0 +1,51 @@
+''' Checks for the vectorized TCRdist against the one-pair-at-a-time version
+'''
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pytest
+
+try:
+    import tcrdock
+except AssertionError as e: # BLAST hasn't been downloaded
+    pytest.skip(str(e), allow_module_level=True)
+
+from tcrdock.tcrdist.tcr_distances import (
+    TcrDistCalculator, weighted_cdr3_distance, weighted_cdr3_distance_matrix)
+
+tcrs_tsvfile = Path(__file__).parents[1] / 'examples/tcrdist/human_tcrs.tsv'
+
+
+@pytest.fixture(scope='module')
+def tcrs():
+    df = pd.read_table(tcrs_tsvfile).iloc[::7] # 41 tcrs, a range of cdr3 lengths
+    return [((l.va, None, l.cdr3a), (l.vb, None, l.cdr3b))
+            for l in df.itertuples()]
+
+
+@pytest.fixture(scope='module')
+def tcrdister():
+    return TcrDistCalculator('human')
+
+
+def test_weighted_cdr3_distance_matrix(tcrs):
+    cdr3s1 = [x[0][2] for x in tcrs] + [x[1][2] for x in tcrs]
+    cdr3s2 = cdr3s1[::3]
+    dists = weighted_cdr3_distance_matrix(cdr3s1, cdr3s2)
+    expected = [[weighted_cdr3_distance(a, b) for b in cdr3s2] for a in cdr3s1]
+    assert np.array_equal(dists, expected)
+
+
+def test_distance_matrix(tcrdister, tcrs):
+    tcrs2 = tcrs[::2]
+    dists = tcrdister.distance_matrix(tcrs, tcrs2)
+    expected = [[tcrdister(a, b) for b in tcrs2] for a in tcrs]
+    assert np.array_equal(dists, expected)
+
+
+@pytest.mark.parametrize('ich,chain', [(0,'A'), (1,'B')])
+def test_single_chain_distance_matrix(tcrdister, tcrs, ich, chain):
+    dists = tcrdister.distance_matrix(tcrs, tcrs, chains=chain)
+    expected = [[tcrdister.single_chain_distance(a[ich], b[ich]) for b in tcrs]
+                for a in tcrs]
+    assert np.array_equal(dists, expected)
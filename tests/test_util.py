@@ -0,0 +1,45 @@
+''' Checks for util.imap_in_workers
+'''
+import os
+import pytest
+
+try:
+    import tcrdock
+except AssertionError as e: # BLAST hasn't been downloaded
+    pytest.skip(str(e), allow_module_level=True)
+
+from tcrdock.util import imap_in_workers
+
+
+def square(x):
+    return x*x
+
+
+def fail_on_3(x):
+    if x == 3:
+        raise ValueError('bad item')
+    return x
+
+
+def die_on_3(x):
+    if x == 3:
+        os._exit(7) # like an OOM kill, no exception
+    return x
+
+
+def test_imap_in_workers_order():
+    assert list(imap_in_workers(square, range(20), 3)) == [x*x for x in range(20)]
+    assert list(imap_in_workers(square, [], 2)) == []
+
+
+def test_imap_in_workers_error():
+    results = []
+    with pytest.raises(RuntimeError, match='bad item'):
+        for result in imap_in_workers(fail_on_3, range(10), 2):
+            results.append(result)
+    assert results == [0, 1, 2] # the results before the error still come through
+
+
+def test_imap_in_workers_dead_worker():
+    with pytest.raises(RuntimeError, match='died with exitcode 7'):
+        list(imap_in_workers(die_on_3, range(10), 2, poll_timeout=0.5))
@@ -0,0 +1,62 @@
+''' Checks for the numpy V/J aligner (tcrdock/tcrdist/vj_align.py)
+
+The BLAST cross-check is skipped unless the blastp from download_blast.py runs.
+'''
+import subprocess
+import pytest
+
+try:
+    import tcrdock
+except AssertionError as e: # BLAST hasn't been downloaded
+    pytest.skip(str(e), allow_module_level=True)
+
+from Bio import Align
+from Bio.Align import substitution_matrices
+from tcrdock import blast
+from tcrdock.sequtil import tcr_info
+from tcrdock.tcrdist import parsing, vj_align
+
+
+def blastp_works():
+    try:
+        result = subprocess.run([blast.blastp_exe, '-version'],
+                                capture_output=True, text=True)
+    except OSError:
+        return False
+    return result.returncode == 0 and result.stdout.startswith('blastp')
+
+
+def get_test_chains(organism, ab, num_chains=6):
+    ''' a fixed set of TCR chain sequences from the tcr templates
+    '''
+    info = tcr_info[(tcr_info.organism==organism) & (tcr_info.ab==ab)]
+    info = info.sort_values('chainseq').drop_duplicates('chainseq')
+    return list(info.chainseq[:num_chains])
+
+
+def test_smith_waterman_scores_match_biopython():
+    aligner = Align.PairwiseAligner()
+    aligner.mode = 'local'
+    aligner.substitution_matrix = substitution_matrices.load('BLOSUM62')
+    # blast gap costs are gap_open + length*gap_extend
+    aligner.open_gap_score = -(vj_align.gap_open + vj_align.gap_extend)
+    aligner.extend_gap_score = -vj_align.gap_extend
+
+    for chain in 'AB':
+        sequence = get_test_chains('human', chain, 1)[0]
+        for vj in 'VJ':
+            ids, protseqs, genes, _ = vj_align.get_gene_db('human', chain, vj)
+            scores = vj_align._smith_waterman(vj_align._encode(sequence), genes)
+            for ind in range(0, len(ids), 10):
+                assert scores[ind] == aligner.score(sequence, protseqs[ind]), ids[ind]
+
+
+@pytest.mark.skipif(not blastp_works(), reason='needs blastp (see download_blast.py)')
+@pytest.mark.parametrize('organism', ['human', 'mouse'])
+@pytest.mark.parametrize('chain', ['A', 'B'])
+def test_vj_aligner_against_blast(organism, chain):
+    results = parsing.check_vj_aligner_against_blast(
+        organism, chain, get_test_chains(organism, chain), verbose=False)
+    assert results.shape[0] > 0
+    assert results.same_gene.all(), results[~results.same_gene]
+    assert results.same_alignment.all(), results[~results.same_alignment]